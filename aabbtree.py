@@ -1,8 +1,32 @@
 """Class definitions and methods for the AABB and AABBTree."""
 
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from array import array
 from collections import deque
 
-__all__ = ['AABB', 'AABBTree']
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    shared_memory = None
+
+__all__ = ['AABB', 'AABBTree', 'CompiledAABBTree', 'AsyncAABBIndex',
+           'OverlapCursor', 'SnapshotAABBTree', 'SweepAndPrune', 'GridIndex',
+           'ShardedAABBIndex', 'overlaps_many', 'distance_many',
+           'overlap_volume_many', 'merge_many', 'volume_many', 'corners_many',
+           'perimeter_many']
 __author__ = 'Kenneth (Kip) Hart'
 
 
@@ -121,19 +145,23 @@ class AABB(object):  # pylint: disable=useless-object-inheritance
             p_3 &= 2 (l_1 l_2 + l_2 l_3 + l_1 l_3) \\
             p_n &= 2 \sum_{i=1}^n \prod_{j=1\neq i}^n l_j
 
+        The products are found with running products from each end of the
+        side lengths, so the cost is linear in the number of dimensions.
         """
         if len(self.limits) == 1:
             return 0
 
-        perim = 0
         side_lens = [ub - lb for lb, ub in self.limits]
-        n_dim = len(side_lens)
-        for i in range(n_dim):
-            p_edge = 1
-            for j in range(n_dim):
-                if j != i:
-                    p_edge *= side_lens[j]
-            perim += p_edge
+        suffixes = [1]
+        for side in reversed(side_lens[1:]):
+            suffixes.append(suffixes[-1] * side)
+        suffixes.reverse()
+
+        perim = 0
+        prefix = 1
+        for side, suffix in zip(side_lens, suffixes):
+            perim += prefix * suffix
+            prefix *= side
         return 2 * perim
 
     @property
@@ -158,18 +186,26 @@ class AABB(object):  # pylint: disable=useless-object-inheritance
 
     @property
     def corners(self):
-        """list: corner points of AABB"""
+        """list: corner points of AABB
+
+        Corner ``i`` takes the upper bound in dimension ``d`` if bit
+        ``n - 1 - d`` of ``i`` is set, and the lower bound otherwise.
+        """
+        return [list(corner) for corner in self.iter_corners()]
+
+    def iter_corners(self):
+        """Iterate over corner points of AABB
+
+        This function generates the corners one at a time, in the same
+        order as :attr:`corners`, for boxes with too many corners to hold
+        in memory.
 
-        n_dim = len(self.limits)
-        fmt = '{:0' + str(n_dim) + 'b}'
+        *New in version 2.9.0*
 
-        n_corners = 2 ** n_dim
-        corners = []
-        for i in range(n_corners):
-            inds = [int(s) for s in fmt.format(i)]  # convert i to binary list
-            corner = [self.limits[d][ind] for d, ind in enumerate(inds)]
-            corners.append(corner)
-        return corners
+        Returns:
+            iterator: Tuples of corner coordinates
+        """
+        return itertools.product(*self.limits)
 
     def overlaps(self, aabb, closed=False):
         """Determine if two AABBs overlap
@@ -212,6 +248,27 @@ class AABB(object):  # pylint: disable=useless-object-inheritance
 
 
 
+    def contains(self, aabb):
+        """Determine if an AABB is inside this AABB
+
+        An AABB touching the boundary from the inside is contained.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to check
+
+        Returns:
+            bool: Flag set to true if the AABB is inside this AABB
+        """
+        if (self.limits is None) or (aabb.limits is None):
+            return False
+
+        for (min1, max1), (min2, max2) in zip(self.limits, aabb.limits):
+            if min2 < min1 or max2 > max1:
+                return False
+        return True
+
     def overlap_volume(self, aabb):
         r"""Determine volume of overlap between AABBs
 
@@ -244,29 +301,138 @@ class AABB(object):  # pylint: disable=useless-object-inheritance
             volume *= overlap_max - overlap_min
         return volume
 
+    def distance(self, aabb, metric='euclidean'):
+        """Determine distance between AABBs
+
+        The distance is between the closest points of the two AABBs, so
+        overlapping or touching AABBs are at distance 0.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to calculate distance to
+            metric (str): {'euclidean'|'chebyshev'} Distance metric.
+                Defaults to 'euclidean'.
+
+        Returns:
+            float: Distance between AABBs
+        """
+        _check_metric(metric)
+        gaps = [max(min2 - max1, min1 - max2, 0) for (min1, max1), (min2, max2)
+                in zip(self.limits, aabb.limits)]
+        if metric == 'chebyshev':
+            return max(gaps) if gaps else 0
+        return math.sqrt(sum(gap * gap for gap in gaps))
+
+    def entry_time(self, aabb, displacement, closed=False):
+        """Determine when a moving AABB first overlaps another
+
+        This AABB moves by *displacement* over times 0 to 1, and the time of
+        overlap in each dimension is found with the slab test.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The stationary AABB to check.
+            displacement (iterable): Displacement of this AABB from time 0
+                to time 1.
+            closed (bool): Flag for closed overlap between AABBs. For the
+                case where one box is [-1, 0] and the other is [0, 0], the
+                two boxes are overlapping if closed is set to True. The two
+                boxes are NOT overlapping if closed is set to False.
+
+        Returns:
+            float: Time of first overlap between 0 and 1, or None if the
+            AABBs do not overlap during the motion.
+        """
+        if (self.limits is None) or (aabb.limits is None):
+            return None
+
+        t_enter = 0
+        t_exit = 1
+        for (min1, max1), (min2, max2), disp in zip(self.limits, aabb.limits,
+                                                    displacement):
+            if disp == 0:
+                if closed and (min1 > max2 or min2 > max1):
+                    return None
+                if not closed and (min1 >= max2 or min2 >= max1):
+                    return None
+                continue
+            t1 = (min2 - max1) / disp
+            t2 = (max2 - min1) / disp
+            t_enter = max(t_enter, min(t1, t2))
+            t_exit = min(t_exit, max(t1, t2))
+
+        if t_enter > t_exit or (not closed and t_enter == t_exit):
+            return None
+        return t_enter
+
 
 class AABBTree(object):  # pylint: disable=useless-object-inheritance
     """Static AABB Tree
 
     An AABB tree where the bounds of each AABB do not change.
 
+    *New in version 2.9.0*
+
+    Setting *leaf_size* above 1 makes each leaf a bucket of up to that many
+    AABBs and values, stored in the *bucket* attribute as
+    ``(aabb, value)`` pairs. The AABB of a bucket leaf bounds its contents
+    and its value is None.
+
+    Attributes of the values, added with :meth:`add_attribute`, are kept in
+    the *attributes* dictionary of the tree they are added to, and
+    reductions added with :meth:`add_aggregate` in the *aggregates*
+    dictionary. Their values for each node are found when first needed by a
+    query and kept until the node changes.
+
     Args:
         aabb (AABB): An AABB
         value: The value associated with the AABB
         left (AABBTree, optional): The left branch of the tree
         right (AABBTree, optional): The right branch of the tree
+        leaf_size (int, optional): The maximum number of AABBs in a leaf.
+            Defaults to 1.
+        bucket (list, optional): The (AABB, value) pairs of a bucket leaf,
+            used instead of *aabb* and *value*. Defaults to None.
 
     """  # NOQA: E501
-    def __init__(self, aabb=AABB(), value=None, left=None, right=None):
+    def __init__(self, aabb=AABB(), value=None, left=None, right=None,
+                 leaf_size=1, bucket=None):
+        if leaf_size < 1:
+            e_str = 'leaf_size should be at least 1, not ' + str(leaf_size)
+            raise ValueError(e_str)
+        if bucket is not None and (leaf_size < 2 or len(bucket) > leaf_size):
+            e_str = 'bucket of ' + str(len(bucket)) + ' AABBs does not fit '
+            e_str += 'leaf_size ' + str(leaf_size)
+            raise ValueError(e_str)
 
         self.aabb = aabb
         self.value = value
         self.left = left
         self.right = right
+        self.leaf_size = leaf_size
+        self.bucket = None
+        self._lows = None
+        self._highs = None
+        self._attributes = None
+        self._reductions = None
+        self._aggregates = None
+        self._optimize_path = None
+        if leaf_size > 1 and self.is_leaf:
+            if bucket is not None:
+                entries = bucket
+            elif aabb == AABB():
+                entries = []
+            else:
+                entries = [(aabb, value)]
+            _fill_bucket(self, entries)
 
     def __repr__(self):
         inp_strs = []
-        if self.aabb != AABB():
+        if self.bucket:
+            inp_strs.append('bucket=' + repr(self.bucket))
+        elif self.aabb != AABB():
             inp_strs.append('aabb=' + repr(self.aabb))
 
         if self.value is not None:
@@ -278,6 +444,9 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         if self.right is not None:
             inp_strs.append('right=' + repr(self.right))
 
+        if self.leaf_size != 1:
+            inp_strs.append('leaf_size=' + repr(self.leaf_size))
+
         return 'AABBTree(' + ', '.join(inp_strs) + ')'
 
     def __str__(self, n=0):
@@ -290,6 +459,8 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
             aabb_str += str(self.aabb)
 
         value_str = pre + 'Value: ' + str(self.value)
+        if self.bucket is not None:
+            value_str += '\n' + pre + 'Bucket: ' + str(self.bucket)
 
         left_str = pre + 'Left:'
         if self.left is None:
@@ -315,6 +486,10 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         if self.is_leaf != aabbtree.is_leaf:
             return False
 
+        if self.is_leaf:
+            boxes = [box for box, _ in _leaf_entries(self)]
+            return boxes == [box for box, _ in _leaf_entries(aabbtree)]
+
         return (self.left == aabbtree.left) and (self.right == aabbtree.right)
 
     def __ne__(self, aabbtree):
@@ -322,7 +497,7 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
 
     def __len__(self):
         if self.is_leaf:
-            return int(self.aabb != AABB())
+            return len(_leaf_entries(self))
         return len(self.left) + len(self.right)
 
     @property
@@ -337,6 +512,20 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
             return 0
         return 1 + max(self.left.depth, self.right.depth)
 
+    @property
+    def attributes(self):
+        """dict: Attributes added with :meth:`add_attribute`, by name"""
+        if self._attributes is None:
+            return {}
+        return self._attributes
+
+    @property
+    def aggregates(self):
+        """dict: Reductions added with :meth:`add_aggregate`, by name"""
+        if self._reductions is None:
+            return {}
+        return self._reductions
+
     def add(self, aabb, value=None, method='volume'):
         r"""Add node to tree
 
@@ -351,6 +540,10 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         The cost of each option is calculated based on the *method* keyword,
         and the option with the lowest cost is chosen.
 
+        If the tree has a *leaf_size* above 1, AABBs reaching a leaf are
+        added to its bucket. A full bucket is split in two at the median
+        of the AABB centers, along the axis where the centers spread most.
+
         Args:
             aabb (AABB): The AABB to add.
             value: The value associated with the AABB. Defaults to None.
@@ -398,47 +591,40 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         .. _`AABBTree repository`: https://github.com/kip-hart/AABBTree
 
         """  # NOQA: E501
-        if self.aabb == AABB():
+        self._aggregates = None
+        if self.bucket is not None:
+            entries = self.bucket + [(aabb, value)]
+            if len(entries) <= self.leaf_size:
+                _fill_bucket(self, entries)
+            else:
+                left_entries, right_entries = _split_entries(entries)
+                self.left = _build(left_entries, self.leaf_size)
+                self.right = _build(right_entries, self.leaf_size)
+                self.aabb = AABB.merge(self.left.aabb, self.right.aabb)
+                self.bucket = None
+                self._lows = None
+                self._highs = None
+
+        elif self.aabb == AABB():
             self.aabb = aabb
             self.value = value
 
         elif self.is_leaf:
-            self.left = AABBTree(self.aabb, value=self.value, left=self.left, right=self.right)
+            self.left = AABBTree(self.aabb, value=self.value,
+                                 left=self.left, right=self.right)
             self.right = AABBTree(aabb, value)
 
             self.aabb = AABB.merge(self.aabb, aabb)
             self.value = None
         else:
-            if method == 'volume':
-                # Define merged AABBs
-                branch_merge = AABB.merge(self.aabb, aabb)
-                left_merge = AABB.merge(self.left.aabb, aabb)
-                right_merge = AABB.merge(self.right.aabb, aabb)
-
-                # Calculate the change in the sum of the bounding volumes
-                branch_cost = branch_merge.volume
-
-                left_cost = branch_merge.volume - self.aabb.volume
-                left_cost += left_merge.volume - self.left.aabb.volume
-
-                right_cost = branch_merge.volume - self.aabb.volume
-                right_cost += right_merge.volume - self.right.aabb.volume
-
-                # Calculate amount of overlap
-                branch_olap_cost = self.aabb.overlap_volume(aabb)
-                left_olap_cost = left_merge.overlap_volume(self.right.aabb)
-                right_olap_cost = right_merge.overlap_volume(self.left.aabb)
-
-                # Calculate total cost
-                branch_cost += branch_olap_cost
-                left_cost += left_olap_cost
-                right_cost += right_olap_cost
-            else:
-                raise ValueError('Unrecognized method: ' + str(method))
+            costs = _insertion_costs(self, aabb, method)
+            branch_cost, left_cost, right_cost = costs
 
             if branch_cost < left_cost and branch_cost < right_cost:
-                self.left = AABBTree(self.aabb, value=self.value, left=self.left, right=self.right)
-                self.right = AABBTree(aabb, value)
+                self.left = AABBTree(self.aabb, value=self.value,
+                                     left=self.left, right=self.right,
+                                     leaf_size=self.leaf_size)
+                self.right = AABBTree(aabb, value, leaf_size=self.leaf_size)
                 self.value = None
             elif left_cost < right_cost:
                 self.left.add(aabb, value)
@@ -446,7 +632,359 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
                 self.right.add(aabb, value)
             self.aabb = AABB.merge(self.left.aabb, self.right.aabb)
 
-    def does_overlap(self, aabb, method='DFS', closed=False):
+    def add_many(self, aabbs, values=None, method='volume'):
+        """Add many nodes to tree
+
+        This function inserts a batch of AABBs into the tree, like calling
+        :meth:`add` for each one.
+        The AABBs descend the tree together: at each branch, the insertion
+        costs of :meth:`add` are found for the whole group against the
+        current branch, and the group is split between the left side, the
+        right side, and a new branch holding the AABBs that become a new
+        leaf there.
+        When a group is large compared to the subtree it reaches, the
+        subtree is rebuilt with the group, as in :meth:`from_aabbs`.
+
+        The gain over calling :meth:`add` for each AABB depends on the size
+        of the tree. A batch of 10,000 AABBs is added about 13 times faster
+        to an empty tree, but only about 4 times faster to a tree that
+        already holds 10,000 to 50,000 AABBs, since most of the batch still
+        descends the tree one level at a time.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs to add.
+            values (iterable, optional): The value associated with each AABB.
+                Defaults to None for every AABB.
+            method (str): The method for deciding how to build the tree.
+                See :meth:`add`. Defaults to 'volume'.
+        """
+        aabbs = list(aabbs)
+        values = len(aabbs) * [None] if values is None else list(values)
+        if len(aabbs) != len(values):
+            e_str = 'Number of AABBs and values differ: ' + str(len(aabbs))
+            e_str += ' and ' + str(len(values))
+            raise ValueError(e_str)
+        if method != 'volume':
+            raise ValueError('Unrecognized method: ' + str(method))
+        _add_entries(self, list(zip(aabbs, values)))
+
+    @classmethod
+    def from_aabbs(cls, aabbs, values=None, leaf_size=1):
+        """Build tree from many AABBs
+
+        This function builds a tree from all of the AABBs at once, rather
+        than adding them one at a time.
+        The AABBs are split in two at the median of their centers, along the
+        axis where the centers spread most, until each group fits in a leaf.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs to add.
+            values (iterable, optional): The value associated with each AABB.
+                Defaults to None for every AABB.
+            leaf_size (int, optional): The maximum number of AABBs in a leaf.
+                Defaults to 1.
+
+        Returns:
+            AABBTree: A tree containing the AABBs.
+        """
+        aabbs = list(aabbs)
+        values = len(aabbs) * [None] if values is None else list(values)
+        if len(aabbs) != len(values):
+            e_str = 'Number of AABBs and values differ: ' + str(len(aabbs))
+            e_str += ' and ' + str(len(values))
+            raise ValueError(e_str)
+        if leaf_size < 1:
+            e_str = 'leaf_size should be at least 1, not ' + str(leaf_size)
+            raise ValueError(e_str)
+        return _build(list(zip(aabbs, values)), leaf_size)
+
+    @classmethod
+    def merge_trees(cls, tree1, tree2):
+        """Merge two trees
+
+        This function grafts two trees together without adding their AABBs
+        again.
+        The top few levels of both trees are removed, and the subtrees below
+        them are joined by new branches, split at the median of their
+        centers as in :meth:`from_aabbs`.
+        This way, trees covering the same region are interleaved near the
+        root instead of overlapping below a single new branch.
+
+        The merged tree shares subtrees with the input trees, so the input
+        trees should not be modified after merging.
+
+        *New in version 2.9.0*
+
+        Args:
+            tree1 (AABBTree): The first tree.
+            tree2 (AABBTree): The second tree.
+
+        Returns:
+            AABBTree: A tree containing the AABBs of both trees.
+        """
+        if tree1.leaf_size != tree2.leaf_size:
+            e_str = 'Trees have different leaf sizes: '
+            e_str += str(tree1.leaf_size) + ' and ' + str(tree2.leaf_size)
+            raise ValueError(e_str)
+
+        subtrees = []
+        for tree in (tree1, tree2):
+            stack = [(tree, 0)]
+            while stack:
+                node, depth = stack.pop()
+                if node.is_leaf and node.aabb == AABB():
+                    continue
+                if node.is_leaf or depth == _GRAFT_DEPTH:
+                    subtrees.append(node)
+                else:
+                    stack.append((node.right, depth + 1))
+                    stack.append((node.left, depth + 1))
+
+        if len(subtrees) > 1:
+            return _graft(subtrees, _centers((node.aabb, None)
+                                             for node in subtrees))
+
+        # A lone leaf is copied, so adding to the result leaves the input
+        # trees unchanged
+        if not subtrees:
+            return cls(leaf_size=tree1.leaf_size)
+        leaf = subtrees[0]
+        return cls(leaf.aabb, leaf.value, leaf_size=leaf.leaf_size,
+                   bucket=leaf.bucket)
+
+    def split(self, k):
+        """Split tree into spatial shards
+
+        This function partitions the AABBs in the tree into *k* groups of
+        about the same size, by repeatedly splitting along the axis where
+        the AABB centers spread most.
+        Each group is built into its own tree, as in :meth:`from_aabbs`.
+        The tree itself is not modified.
+
+        *New in version 2.9.0*
+
+        Args:
+            k (int): Number of shards.
+
+        Returns:
+            list: (AABBTree, AABB) pairs of each shard and its bounds. If the
+            tree has fewer than *k* AABBs, there is one shard per AABB.
+        """
+        if k < 1:
+            raise ValueError('k should be at least 1, not ' + str(k))
+
+        entries = _subtree_entries(self)
+        groups = []
+        stack = [(entries, _centers(entries), min(k, len(entries)))]
+        while stack:
+            group, centers, n_shards = stack.pop()
+            if n_shards <= 1:
+                groups.append((group, centers))
+                continue
+            n_left = n_shards // 2
+            left, right = _median_split(centers,
+                                        len(group) * n_left // n_shards)
+            stack.append(([group[i] for i in right],
+                          [centers[i] for i in right], n_shards - n_left))
+            stack.append(([group[i] for i in left],
+                          [centers[i] for i in left], n_left))
+
+        shards = []
+        for group, centers in groups:
+            if group:
+                tree = _build(group, self.leaf_size, centers)
+                shards.append((tree, tree.aabb))
+        return shards
+
+    def optimize(self, max_nodes=1024, max_time=None):
+        r"""Rebuild degraded subtrees
+
+        This function finds the subtrees where the children overlap the
+        most and rebuilds them, worst first, with the same median split as
+        :meth:`from_aabbs`.
+        The degradation of a branch :math:`p` with children :math:`l` and
+        :math:`r` is :math:`V(l \cap r) / V(p)`, the fraction of its volume
+        where the children overlap.
+        A rebuilt subtree is kept only if it lowers the total cost
+        :math:`\sum_p V(p) + V(l \cap r)` over the branches of the subtree,
+        the quantities minimized by :meth:`add`.
+
+        Calling this function between updates spreads the maintenance of a
+        long-lived tree over time.
+        The search for degraded subtrees also counts against *max_time*.
+        When the time runs out, the search stops and the next call resumes
+        it where it stopped, so that repeated calls cover the whole tree.
+
+        *New in version 2.9.0*
+
+        Args:
+            max_nodes (int): The maximum number of nodes to rebuild in
+                this call. Defaults to 1024.
+            max_time (float, optional): The time budget for this call, in
+                seconds. Defaults to None, for no time limit.
+
+        Returns:
+            int: The number of subtrees rebuilt.
+        """
+        start = time.perf_counter()
+        deadline = None
+        if max_time is not None:
+            deadline = start + 0.5 * max_time
+        if max_nodes <= 0:
+            return 0
+
+        candidates, self._optimize_path = _scan_branches(
+            self, max_nodes, self._optimize_path, deadline)
+        candidates.sort(key=lambda c: c[:2])
+
+        n_rebuilt = 0
+        budget = max_nodes
+        chosen = []
+        for _, i, size, node in candidates:
+            if max_time is not None and time.perf_counter() - start > max_time:
+                break
+            if size > budget:
+                continue
+            if any(j <= i < j + n or i <= j < i + size for j, n in chosen):
+                continue
+
+            new = _build(_subtree_entries(node), node.leaf_size)
+            budget -= size
+            if _subtree_cost(new) < _subtree_cost(node):
+                chosen.append((i, size))
+                _replace_node(node, new)
+                n_rebuilt += 1
+        return n_rebuilt
+
+    def add_attribute(self, name, func, kind='mask'):
+        """Add attribute for filtering queries
+
+        This function names an integer attribute of the values, found with
+        ``func(value)``, that queries can filter on with their *where*
+        argument.
+        Each node of the tree keeps an aggregate of the attribute over the
+        values below it, so that a query skips the nodes where no value can
+        meet the condition.
+
+        The *kind* of the attribute sets its aggregate and condition:
+
+            * **mask**: The attribute is a bitmask, such as ``1 << layer``,
+              and nodes keep the bitwise OR of the masks below them. The
+              condition ``where={name: mask}`` matches values whose
+              attribute shares a bit with *mask*.
+            * **range**: The attribute is a number, such as a timestamp, and
+              nodes keep the minimum and maximum below them. The condition
+              ``where={name: (lower, upper)}`` matches values whose attribute
+              is between *lower* and *upper*, inclusive.
+
+        A *where* filter with more than one attribute matches values that
+        meet every condition.
+
+        *New in version 2.9.0*
+
+        Args:
+            name (str): Name of the attribute.
+            func (callable): Function from a value to its attribute.
+            kind (str): {'mask'|'range'} Kind of attribute. Defaults to
+                'mask'.
+        """
+        if kind not in ('mask', 'range'):
+            e_str = "kind should be 'mask' or 'range', not " + str(kind)
+            raise ValueError(e_str)
+        if self._attributes is None:
+            self._attributes = {}
+        self._attributes[name] = (func, kind)
+        _clear_aggregates(self, ('attribute', name))
+
+    def add_aggregate(self, name, func=None, combine='sum'):
+        """Add aggregate for range reductions
+
+        This function names a reduction of the values, such as the total
+        weight or the highest priority, that :meth:`aggregate` finds over
+        the AABBs overlapping a region.
+        Each node of the tree keeps the reduction over the values below it,
+        so that a node inside the region is reduced in one step.
+
+        The reduction applies *combine* to ``func(value)`` for each value.
+        Built-in reductions are 'sum', 'min', 'max', and 'count', which
+        counts the values and does not need *func*. Any other associative
+        function of two arguments may be given instead.
+
+        *New in version 2.9.0*
+
+        Args:
+            name (str): Name of the aggregate.
+            func (callable, optional): Function from a value to the number
+                to reduce. Required except for 'count'.
+            combine (str or callable): {'sum'|'min'|'max'|'count'} or a
+                function of two arguments. Defaults to 'sum'.
+        """
+        if combine == 'count':
+            func = _count_one
+        elif not callable(combine) and combine not in _REDUCTIONS:
+            e_str = "combine should be 'sum', 'min', 'max', 'count', or a "
+            e_str += 'function, not ' + str(combine)
+            raise ValueError(e_str)
+        if func is None:
+            raise ValueError('func is required for ' + str(combine))
+
+        if self._reductions is None:
+            self._reductions = {}
+        self._reductions[name] = (func, combine)
+        _clear_aggregates(self, ('aggregate', name))
+
+    def aggregate(self, aabb, name, closed=False):
+        """Reduce the values of overlapping AABBs
+
+        This function finds the aggregate from :meth:`add_aggregate` over
+        each AABB in the tree that overlaps the input, including copies of
+        the same AABB.
+        When the input covers a node of the tree, the kept reduction of the
+        node is used without visiting the AABBs below it.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to check.
+            name (str): Name of the aggregate.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+
+        Returns:
+            The reduction, or 0 for 'sum' and 'count' and None otherwise if
+            no AABBs overlap.
+        """
+        if name not in self.aggregates:
+            raise ValueError('Unknown aggregate: ' + str(name))
+        func, combine = self.aggregates[name]
+        key = ('aggregate', name)
+        empty = 0 if combine in ('sum', 'count') else None
+        if not callable(combine):
+            combine = _REDUCTIONS[combine]
+
+        result = None
+        query = AABBTree(aabb)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not node.aabb.overlaps(aabb, closed):
+                continue
+            if _covers_subtree(query, node, closed):
+                reduced = _node_aggregate(node, key, func, combine)
+                result = _combine(result, reduced, combine)
+            elif node.is_leaf:
+                for box, value in _leaf_entries(node):
+                    if box.overlaps(aabb, closed):
+                        result = _combine(result, func(value), combine)
+            else:
+                stack.extend((node.right, node.left))
+        return empty if result is None else result
+
+    def does_overlap(self, aabb, method='DFS', closed=False, where=None):
         """Check for overlap
 
         This function checks if the limits overlap any leaf nodes in the tree.
@@ -465,14 +1003,20 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
             closed (bool): Option to specify closed or open box intersection.
                 If open, there must be a non-zero amount of overlap. If closed,
                 boxes can be touching.
+            where (dict, optional): Attribute conditions that the values
+                must meet. See :meth:`add_attribute`. Defaults to None.
 
         Returns:
             bool: True if overlaps with a leaf node of tree.
         """
-
+        if where is not None:
+            return len(_overlap_pairs(self, aabb, method, closed=closed,
+                                      unique=False, limit=1,
+                                      where=where)) > 0
         return len(_overlap_pairs(self, aabb, method, True, closed)) > 0
 
-    def overlap_aabbs(self, aabb, method='DFS', closed=False, unique=True):
+    def overlap_aabbs(self, aabb, method='DFS', closed=False, unique=True,
+                      limit=None, where=None):
         """Get overlapping AABBs
 
         This function gets each overlapping AABB.
@@ -482,6 +1026,11 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         This method also supports overlap checks with another instance of the
         AABBTree class.
 
+        *New in version 2.9.0*
+
+        Setting *limit* stops the traversal once that many AABBs are found.
+        Setting *where* skips the nodes whose attributes cannot meet it.
+
         Args:
             aabb (AABB or AABBTree): The AABB or AABBTree to check.
             method (str): {'DFS'|'BFS'} Method for traversing the tree.
@@ -491,18 +1040,23 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
                 If open, there must be a non-zero amount of overlap. If closed,
                 boxes can be touching.
         unique (bool): Return only unique pairs. Defaults to True.
+            limit (int, optional): Maximum number of AABBs to return.
+                Defaults to None, for no limit.
+            where (dict, optional): Attribute conditions that the values
+                must meet. See :meth:`add_attribute`. Defaults to None.
 
         Returns:
             list: AABB objects in AABBTree that overlap with the input.
         """
         pairs = _overlap_pairs(self, aabb, method, closed=closed,
-                               unique=unique)
+                               unique=unique, limit=limit, where=where)
         if len(pairs) == 0:
             return []
         boxes, _ = zip(*pairs)
         return list(boxes)
 
-    def overlap_values(self, aabb, method='DFS', closed=False, unique=True):
+    def overlap_values(self, aabb, method='DFS', closed=False, unique=True,
+                       limit=None, where=None):
         """Get values of overlapping AABBs
 
         This function gets the value field of each overlapping AABB.
@@ -512,6 +1066,12 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
         This method also supports overlap checks with another instance of the
         AABBTree class.
 
+        *New in version 2.9.0*
+
+        Setting *limit* stops the traversal once that many values are found.
+        To continue the traversal later, use :meth:`overlap_cursor`.
+        Setting *where* skips the nodes whose attributes cannot meet it.
+
         Args:
             aabb (AABB or AABBTree): The AABB or AABBTree to check.
             method (str): {'DFS'|'BFS'} Method for traversing the tree.
@@ -521,121 +1081,3471 @@ class AABBTree(object):  # pylint: disable=useless-object-inheritance
                 If open, there must be a non-zero amount of overlap. If closed,
                 boxes can be touching.
         unique (bool): Return only unique pairs. Defaults to True.
+            limit (int, optional): Maximum number of values to return.
+                Defaults to None, for no limit.
+            where (dict, optional): Attribute conditions that the values
+                must meet. See :meth:`add_attribute`. Defaults to None.
 
         Returns:
             list: Value fields of each node that overlaps.
         """
         pairs = _overlap_pairs(self, aabb, method, closed=closed,
-                               unique=unique)
+                               unique=unique, limit=limit, where=where)
         if len(pairs) == 0:
             return []
         _, values = zip(*pairs)
         return list(values)
 
+    def count_overlaps(self, aabb, method='DFS', closed=False, where=None):
+        """Count overlapping AABBs
 
-def _merge(lims1, lims2):
-    lower = min(lims1[0], lims2[0])
-    upper = max(lims1[1], lims2[1])
+        This function counts the AABBs that overlap the input without
+        building a list of them.
+        Each AABB in the tree is counted, including copies of the same AABB.
 
-    return (lower, upper)
+        *New in version 2.9.0*
 
+        Args:
+            aabb (AABB or AABBTree): The AABB or AABBTree to check.
+            method (str): {'DFS'|'BFS'} Method for traversing the tree.
+                Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            where (dict, optional): Attribute conditions that the values
+                must meet. See :meth:`add_attribute`. Defaults to None.
 
-def _overlap_pairs(in_tree, aabb, method='DFS', halt=False, closed=False, 
-                   unique=True):
-    """Get overlapping AABBs and values in (AABB, value) pairs
+        Returns:
+            int: Number of overlapping AABBs.
+        """
+        if method not in ('DFS', 'BFS'):
+            e_str = "method should be 'DFS' or 'BFS', not " + str(method)
+            raise ValueError(e_str)
+        return _count_pairs(self, aabb, closed, _prepare_where(self, where))
 
-    *New  in version 2.6.0*
+    def overlap_cursor(self, aabb, method='DFS', closed=False, unique=True,
+                       where=None):
+        """Get a resumable overlap query
 
-    This function gets each overlapping AABB and its value.
+        This function starts an overlap query that is traversed lazily, for
+        paging through the results. The tree should not be modified while the
+        cursor is in use.
 
-    Args:
-        in_tree: The AABBTree to compare with.
-        aabb (AABB or AABBTree): The AABB or AABBTree to check.
-        method (str): {'DFS'|'BFS'} Method for traversing the tree.
-            Setting 'DFS' performs a depth-first search and 'BFS' performs
-            a breadth-first search. Defaults to 'DFS'.
-        halt (bool): Return the list immediately once a pair has been
-            added.
-        closed (bool): Check for closed box intersection. Defaults to False.
-        unique (bool): Return only unique pairs. Defaults to True.
+        *New in version 2.9.0*
 
-    Returns:
-        list: (AABB, value) pairs in AABBTree that overlap with the input.
-    """
-    if isinstance(aabb, AABB):
-        tree = AABBTree(aabb=aabb)
-    else:
-        tree = aabb
+        Args:
+            aabb (AABB or AABBTree): The AABB or AABBTree to check.
+            method (str): {'DFS'|'BFS'} Method for traversing the tree.
+                Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            unique (bool): Return only unique pairs. Defaults to True.
+            where (dict, optional): Attribute conditions that the values
+                must meet. See :meth:`add_attribute`. Defaults to None.
 
-    if method == 'DFS':
-        pairs = _overlap_dfs(in_tree, tree, halt, closed)
+        Returns:
+            OverlapCursor: Cursor over the values of each overlapping AABB.
+        """
+        pairs = _iter_pairs(self, aabb, method, closed,
+                            _prepare_where(self, where))
+        if unique:
+            pairs = _iter_unique(pairs)
+        return OverlapCursor(pairs)
 
-    elif method == 'BFS':
-        pairs = _overlap_bfs(in_tree, tree, halt, closed)
-    else:
-        e_str = "method should be 'DFS' or 'BFS', not " + str(method)
-        raise ValueError(e_str)
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        """Get values of overlapping AABBs for many queries
 
-    if len(pairs) < 2 or not unique:
-        return pairs
-    return _unique_pairs(pairs)
+        This function answers many overlap queries in a single traversal of
+        the tree. Each node is visited once, tested against the queries that
+        reached it, and passes the ones that overlap it to its children.
 
+        *New in version 2.9.0*
 
-def _overlap_dfs(in_tree, tree, halt, closed):
-    pairs = []
+        Args:
+            aabbs (iterable): The AABBs to check.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
 
-    if in_tree.is_leaf:
-        in_branches = [in_tree]
-    else:
-        in_branches = [in_tree.left, in_tree.right]
+        Returns:
+            list: For each input AABB, the list of value fields of each node
+            that overlaps.
+        """
+        aabbs = list(aabbs)
+        results = [[] for _ in aabbs]
 
-    if tree.is_leaf:
-        tree_branches = [tree]
-    else:
-        tree_branches = [tree.left, tree.right]
+        def test(box, query):
+            return box.overlaps(query, closed)
 
-    if not in_tree.aabb.overlaps(tree.aabb, closed):
-        return pairs
+        for node, active in _batch_leaves(self, aabbs, test):
+            if node.bucket is None:
+                for q in active:
+                    results[q].append((node.aabb, node.value))
+            else:
+                for q in active:
+                    hits = overlaps_many(aabbs[q], node._lows, node._highs,
+                                         closed)
+                    results[q].extend(entry for entry, hit
+                                      in zip(node.bucket, hits) if hit)
 
-    if in_tree.is_leaf and tree.is_leaf:
-        pairs.append((in_tree.aabb, in_tree.value))
-        return pairs
+        if unique:
+            results = [_unique_pairs(p) if len(p) > 1 else p for p in results]
+        return [[value for _, value in pairs] for pairs in results]
 
-    for in_branch in in_branches:
-        for tree_branch in tree_branches:
-            o_pairs = _overlap_dfs(in_branch, tree_branch, halt, closed)
-            pairs.extend(o_pairs)
-            if halt and len(pairs) > 0:
-                return pairs
-    return pairs
+    def overlap_volumes(self, aabb, total=False):
+        """Get volumes of overlap with the AABBs
 
+        This function finds each AABB in the tree that overlaps the input
+        with a non-zero volume, along with the volume of the overlap, in a
+        single traversal of the tree.
 
-def _overlap_bfs(in_tree, tree, halt, closed):
-    pairs = []
-    queue = deque()
-    queue.append((in_tree, tree))
-    while len(queue) > 0:
-        s_node, t_node = queue.popleft()
-        if s_node.aabb.overlaps(t_node.aabb, closed):
-            if s_node.is_leaf and t_node.is_leaf:
-                pairs.append((s_node.aabb, s_node.value))
-                if halt:
-                    return pairs
-            elif s_node.is_leaf:
-                queue.append((s_node, t_node.left))
-                queue.append((s_node, t_node.right))
-            elif t_node.is_leaf:
-                queue.append((s_node.left, t_node))
-                queue.append((s_node.right, t_node))
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to check.
+            total (bool): Return only the total volume of overlap. Defaults
+                to False.
+
+        Returns:
+            list or float: (value, volume) pairs for each AABB that overlaps,
+            or their total volume if *total* is True.
+        """
+        return self.overlap_volumes_many([aabb], total)[0]
+
+    def overlap_volumes_many(self, aabbs, total=False):
+        """Get volumes of overlap with the AABBs for many queries
+
+        This function answers many overlap volume queries in a single
+        traversal of the tree, like :meth:`overlap_values_many`.
+        The volumes for the AABBs in a bucket leaf are found with
+        :func:`overlap_volume_many`.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+            total (bool): Return only the total volume of overlap for each
+                input AABB. Defaults to False.
+
+        Returns:
+            list: For each input AABB, the (value, volume) pairs of each AABB
+            that overlaps, or their total volume if *total* is True.
+        """
+        aabbs = list(aabbs)
+        results = [[] for _ in aabbs]
+        for node, active in _batch_leaves(self, aabbs, AABB.overlaps):
+            if node.bucket is None:
+                for q in active:
+                    volume = node.aabb.overlap_volume(aabbs[q])
+                    if volume > 0:
+                        results[q].append((node.value, volume))
             else:
-                queue.append((s_node.left, t_node.left))
-                queue.append((s_node.left, t_node.right))
-                queue.append((s_node.right, t_node.left))
-                queue.append((s_node.right, t_node.right))
-    return pairs
+                for q in active:
+                    volumes = overlap_volume_many(aabbs[q], node._lows,
+                                                  node._highs)
+                    results[q].extend((value, volume) for (_, value), volume
+                                      in zip(node.bucket, volumes)
+                                      if volume > 0)
+
+        if total:
+            return [sum(volume for _, volume in pairs) for pairs in results]
+        return results
+
+    def within(self, aabb):
+        """Get values of AABBs inside the input
+
+        This function finds each AABB in the tree that is entirely inside
+        the input, including AABBs that touch its boundary.
+        When a node of the tree is inside the input, every AABB below it is
+        added without further tests.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to check.
+
+        Returns:
+            list: Value fields of each AABB inside the input.
+        """
+        return self.within_many([aabb])[0]
+
+    def within_many(self, aabbs):
+        """Get values of AABBs inside the inputs for many queries
+
+        This function answers many :meth:`within` queries in a single
+        traversal of the tree.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+
+        Returns:
+            list: For each input AABB, the list of value fields of each AABB
+            inside it.
+        """
+        aabbs = list(aabbs)
+        results = [[] for _ in aabbs]
+        stack = [(self, range(len(aabbs)))]
+        while stack:
+            node, active = stack.pop()
+            inside = [q for q in active if aabbs[q].contains(node.aabb)]
+            if inside:
+                values = [value for _, value in _subtree_entries(node)]
+                for q in inside:
+                    results[q].extend(values)
+                inside = set(inside)
+
+            active = [q for q in active if q not in inside and
+                      node.aabb.overlaps(aabbs[q], True)]
+            if not active:
+                continue
+            if node.is_leaf:
+                for q in active:
+                    results[q].extend(value for box, value
+                                      in _leaf_entries(node)
+                                      if aabbs[q].contains(box))
+            else:
+                stack.append((node.right, active))
+                stack.append((node.left, active))
+        return results
+
+    def containing(self, aabb):
+        """Get values of AABBs containing the input
+
+        This function finds each AABB in the tree that entirely contains
+        the input, including AABBs that touch its boundary.
+        Only the nodes containing the input are searched.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The AABB to check.
+
+        Returns:
+            list: Value fields of each AABB containing the input.
+        """
+        return self.containing_many([aabb])[0]
+
+    def containing_many(self, aabbs):
+        """Get values of AABBs containing the inputs for many queries
+
+        This function answers many :meth:`containing` queries in a single
+        traversal of the tree.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+
+        Returns:
+            list: For each input AABB, the list of value fields of each AABB
+            containing it.
+        """
+        aabbs = list(aabbs)
+        results = [[] for _ in aabbs]
+        for node, active in _batch_leaves(self, aabbs, AABB.contains):
+            for q in active:
+                results[q].extend(value for box, value in _leaf_entries(node)
+                                  if box.contains(aabbs[q]))
+        return results
+
+    def within_distance(self, aabb, r, metric='euclidean'):
+        """Get values of AABBs within a distance of the input
+
+        This function finds each AABB in the tree whose distance to the input
+        AABB or point is at most *r*, using :meth:`AABB.distance`.
+        Nodes of the tree farther than *r* from the input are skipped, so
+        corner hits are excluded without enlarging the input.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB or iterable): The AABB or point to check.
+            r (float): Distance threshold.
+            metric (str): {'euclidean'|'chebyshev'} Distance metric.
+                Defaults to 'euclidean'.
+
+        Returns:
+            list: (value, distance) pairs for each AABB within the distance.
+        """
+        return self.within_distance_many([aabb], r, metric)[0]
+
+    def within_distance_many(self, aabbs, r, metric='euclidean'):
+        """Get values of AABBs within a distance of the inputs for many queries
+
+        This function answers many :meth:`within_distance` queries in a
+        single traversal of the tree.
+        The distances for the AABBs in a bucket leaf are found with
+        :func:`distance_many`.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The AABBs or points to check.
+            r (float): Distance threshold.
+            metric (str): {'euclidean'|'chebyshev'} Distance metric.
+                Defaults to 'euclidean'.
+
+        Returns:
+            list: For each input, the (value, distance) pairs of each AABB
+            within the distance.
+        """
+        _check_metric(metric)
+        aabbs = [_as_aabb(aabb) for aabb in aabbs]
+        results = [[] for _ in aabbs]
+        if self.aabb.limits is None:
+            return results
+
+        def test(box, query):
+            return box.distance(query, metric) <= r
+
+        for node, active in _batch_leaves(self, aabbs, test):
+            if node.bucket is None:
+                for q in active:
+                    dist = node.aabb.distance(aabbs[q], metric)
+                    results[q].append((node.value, dist))
+            else:
+                for q in active:
+                    dists = distance_many(aabbs[q], node._lows, node._highs,
+                                          metric)
+                    results[q].extend((value, dist) for (_, value), dist
+                                      in zip(node.bucket, dists) if dist <= r)
+        return results
+
+    def sweep(self, aabb, displacement, closed=False):
+        """Get values of AABBs hit by a moving AABB
+
+        This function finds each AABB in the tree that the input overlaps
+        while moving by *displacement*, using :meth:`AABB.entry_time`.
+        Nodes of the tree are skipped with the same test, so AABBs near the
+        path but never touched by the moving AABB are excluded.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabb (AABB): The moving AABB.
+            displacement (iterable): Displacement of the AABB over one step.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+
+        Returns:
+            list: (value, time) pairs for each AABB hit, sorted by the time of
+            first overlap between 0 and 1.
+        """
+        return self.sweep_many([aabb], [displacement], closed)[0]
+
+    def sweep_many(self, aabbs, displacements, closed=False):
+        """Get values of AABBs hit by many moving AABBs
+
+        This function answers many :meth:`sweep` queries, such as for all of
+        the moving bodies in a step, in a single traversal of the tree.
+
+        *New in version 2.9.0*
+
+        Args:
+            aabbs (iterable): The moving AABBs.
+            displacements (iterable): Displacement of each AABB.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+
+        Returns:
+            list: For each moving AABB, the (value, time) pairs of each AABB
+            hit, sorted by time.
+        """
+        queries = list(zip(aabbs, displacements))
+        results = [[] for _ in queries]
+        if self.aabb.limits is None:
+            return results
+
+        def test(box, query):
+            return query[0].entry_time(box, query[1], closed) is not None
+
+        for node, active in _batch_leaves(self, queries, test):
+            for q in active:
+                aabb, displacement = queries[q]
+                for box, value in _leaf_entries(node):
+                    t_hit = aabb.entry_time(box, displacement, closed)
+                    if t_hit is not None:
+                        results[q].append((value, t_hit))
+
+        for hits in results:
+            hits.sort(key=lambda hit: hit[1])
+        return results
+
+    def query_halfspaces(self, normals, offsets):
+        r"""Get values of AABBs inside a convex polytope
+
+        The polytope, such as a view frustum, is the intersection of the
+        half-spaces :math:`\mathbf{n}_k \cdot \mathbf{x} \le b_k`.
+        Each AABB is tested against each plane with its n-vertex and
+        p-vertex, the corners with the least and greatest value of
+        :math:`\mathbf{n}_k \cdot \mathbf{x}`.
+        An AABB is culled if its n-vertex is outside any plane, so AABBs near
+        the edges of the polytope may be kept without intersecting it.
+
+        Once a node of the tree is inside a plane, the plane is skipped for
+        the nodes below it.
+        When a node is inside every plane, every AABB below it is added
+        without further tests.
+
+        *New in version 2.9.0*
+
+        Args:
+            normals (iterable): Normal vector of each plane, pointing out of
+                the polytope.
+            offsets (iterable): Offset of each plane.
+
+        Returns:
+            list: Value fields of each AABB that is not culled.
+        """
+        normals = [list(normal) for normal in normals]
+        offsets = list(offsets)
+        if len(normals) != len(offsets):
+            e_str = 'Number of normals and offsets differ: '
+            e_str += str(len(normals)) + ' and ' + str(len(offsets))
+            raise ValueError(e_str)
+
+        values = []
+        if self.aabb.limits is None:
+            return values
+
+        stack = [(self, range(len(normals)))]
+        while stack:
+            node, active = stack.pop()
+            active = _halfspace_planes(node.aabb, normals, offsets, active)
+            if active is None:
+                continue
+            if not active:
+                values.extend(value for _, value in _subtree_entries(node))
+            elif node.is_leaf:
+                values.extend(value for box, value in _leaf_entries(node)
+                              if _halfspace_planes(box, normals, offsets,
+                                                   active) is not None)
+            else:
+                stack.append((node.right, active))
+                stack.append((node.left, active))
+        return values
+
+    def compile(self, layout='dfs', arity=2, quantize=None, dtype='float64'):
+        """Compile tree into flat arrays
+
+        This function copies the tree into a :class:`CompiledAABBTree`,
+        a read-only tree with its nodes and leaves stored in contiguous
+        arrays.
+        The children of each node are ordered along a Morton (Z-order)
+        curve, so the leaves of the compiled tree are sorted spatially and
+        the leaves below any node are stored next to each other.
+
+        Setting *arity* to 4 or 8 collapses levels of the binary tree into
+        wide nodes, which reduces the depth of the tree and tests all of the
+        children of a node in one pass.
+
+        Setting *quantize* to 8 or 16 stores the bounds of each node as 8-
+        or 16-bit offsets within the bounds of its parent, rounded outward.
+        The leaves keep their full bounds, so query results are unchanged.
+
+        The coordinates are stored as *dtype*. Integer types keep integer
+        coordinates exact, for both open and closed overlap, and
+        'float32' halves the size of the arrays.
+
+        *New in version 2.9.0*
+
+        Args:
+            layout (str): {'dfs'|'veb'} Order of the nodes in memory.
+                Setting 'dfs' stores the nodes in depth-first order and
+                'veb' stores them in van Emde Boas order. Defaults to 'dfs'.
+            arity (int): {2|4|8} Maximum number of children per node.
+                Defaults to 2.
+            quantize (int, optional): {8|16} Number of bits for each node
+                bound. Defaults to None, for full precision.
+            dtype (str): {'float32'|'float64'|'int32'|'int64'} Type of the
+                coordinates. Defaults to 'float64'.
+
+        Returns:
+            CompiledAABBTree: The compiled tree.
+        """
+        return CompiledAABBTree(self, layout, arity, quantize, dtype)
+
+
+class CompiledAABBTree(object):  # pylint: disable=useless-object-inheritance
+    """Compiled AABB Tree
+
+    A read-only AABB tree stored in flat arrays, typically created with
+    :meth:`AABBTree.compile`.
+
+    The bounds of the children of each node are stored together in the
+    parent, in the *child_lowers* and *child_uppers* arrays.
+    The children of node ``i`` occupy the slots
+    ``child_ptr[i]`` to ``child_ptr[i + 1]``, and nodes without children
+    are leaves.
+    The leaves below node ``i`` are the entries ``leaf_start[i]`` to
+    ``leaf_stop[i]`` of the leaf arrays, so a query that covers a node
+    emits that range of leaves without visiting the node's descendants.
+    The root is node 0.
+
+    With an *arity* of 4 or 8, each node holds up to that many children,
+    found by repeatedly expanding the largest internal child of the
+    binary tree.
+
+    With *quantize* set to 8 or 16, the child bounds are unsigned integers
+    ``q`` that map to ``low + q * (high - low) / (2**quantize - 1)`` within
+    the decoded bounds ``(low, high)`` of the parent. They are rounded
+    outward, so a decoded child contains the original child. The root
+    bounds and the leaf arrays keep full precision.
+
+    All coordinates, including the root bounds, are converted to *dtype*
+    when the tree is compiled. Integer types require integer coordinates
+    and keep them exact. Converting to 'float32' rounds to the nearest
+    value, which preserves the order of coordinates, so every node still
+    bounds its converted leaves.
+
+    *New in version 2.9.0*
+
+    Args:
+        tree (AABBTree): The tree to compile.
+        layout (str): {'dfs'|'veb'} Order of the nodes in memory.
+            Setting 'dfs' stores the nodes in depth-first order and
+            'veb' stores them in van Emde Boas order. Defaults to 'dfs'.
+        arity (int): {2|4|8} Maximum number of children per node.
+            Defaults to 2.
+        quantize (int, optional): {8|16} Number of bits for each child
+            bound. Defaults to None, for full precision.
+        dtype (str): {'float32'|'float64'|'int32'|'int64'} Type of the
+            coordinates. Defaults to 'float64'.
+
+    """
+    def __init__(self, tree, layout='dfs', arity=2, quantize=None,
+                 dtype='float64'):
+        if layout not in ('dfs', 'veb'):
+            e_str = "layout should be 'dfs' or 'veb', not " + str(layout)
+            raise ValueError(e_str)
+        if arity not in (2, 4, 8):
+            raise ValueError('arity should be 2, 4, or 8, not ' + str(arity))
+        if quantize not in (None, 8, 16):
+            e_str = 'quantize should be None, 8, or 16, not ' + str(quantize)
+            raise ValueError(e_str)
+        if str(dtype) not in _DTYPES:
+            e_str = 'dtype should be one of ' + ', '.join(_DTYPES)
+            e_str += ', not ' + str(dtype)
+            raise ValueError(e_str)
+
+        self.layout = layout
+        self.arity = arity
+        self.quantize = quantize
+        self.dtype = str(dtype)
+        self.n_dim = 0 if tree.aabb.limits is None else len(tree.aabb.limits)
+
+        code = _DTYPES[self.dtype]
+        cast = _caster(code)
+        bound_code = {None: code, 8: 'B', 16: 'H'}[quantize]
+        self.child_ptr = array('q', [0])
+        self.child_idx = array('q')
+        self.child_lowers = array(bound_code)
+        self.child_uppers = array(bound_code)
+        self.leaf_start = array('q')
+        self.leaf_stop = array('q')
+        self.leaf_lowers = array(code)
+        self.leaf_uppers = array(code)
+        self.values = []
+        if tree.aabb == AABB():
+            self.aabb = AABB()
+            return
+
+        # Depth-first walk with the children sorted along the Morton curve
+        lower = [cast(lb) for lb, _ in tree.aabb.limits]
+        upper = [cast(ub) for _, ub in tree.aabb.limits]
+        self.aabb = AABB(list(zip(lower, upper)))
+        kids = {}
+        preorder = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            preorder.append(node)
+            if node.is_leaf:
+                kids[id(node)] = []
+            else:
+                branches = sorted(_wide_branches(node, arity),
+                                  key=lambda n: _morton_code(n.aabb, lower,
+                                                             upper))
+                kids[id(node)] = branches
+                stack.extend(reversed(branches))
+
+        # Leaves are numbered in depth-first order for either layout
+        ranges = {}
+        n_leaves = 0
+        for node in preorder:
+            if node.is_leaf:
+                entries = _leaf_entries(node)
+                ranges[id(node)] = (n_leaves, n_leaves + len(entries))
+                n_leaves += len(entries)
+                for box, value in entries:
+                    for lb, ub in box.limits:
+                        self.leaf_lowers.append(cast(lb))
+                        self.leaf_uppers.append(cast(ub))
+                    self.values.append(value)
+        for node in reversed(preorder):
+            branches = kids[id(node)]
+            if branches:
+                ranges[id(node)] = (ranges[id(branches[0])][0],
+                                    ranges[id(branches[-1])][1])
+
+        if layout == 'dfs':
+            order = preorder
+        else:
+            order = _veb_order(tree, kids)
+        index = {id(node): i for i, node in enumerate(order)}
+
+        # Parents come before their children in either layout
+        decoded = {id(tree): (lower, upper)}
+        n_max = 0 if quantize is None else (1 << quantize) - 1
+        for node in order:
+            for branch in kids[id(node)]:
+                self.child_idx.append(index[id(branch)])
+                if quantize is None:
+                    for lb, ub in branch.aabb.limits:
+                        self.child_lowers.append(cast(lb))
+                        self.child_uppers.append(cast(ub))
+                    continue
+
+                lows = []
+                highs = []
+                for (lb, ub), low, high in zip(branch.aabb.limits,
+                                               *decoded[id(node)]):
+                    q_lo, q_hi = _quantize(cast(lb), cast(ub), low, high,
+                                           n_max)
+                    self.child_lowers.append(q_lo)
+                    self.child_uppers.append(q_hi)
+                    step = (high - low) / n_max
+                    lows.append(_dequantize(q_lo, low, high, step, n_max))
+                    highs.append(_dequantize(q_hi, low, high, step, n_max))
+                decoded[id(branch)] = (lows, highs)
+            self.child_ptr.append(len(self.child_idx))
+            start, stop = ranges[id(node)]
+            self.leaf_start.append(start)
+            self.leaf_stop.append(stop)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        """int: Size of the arrays of the tree, in bytes"""
+        arrays = [getattr(self, name) for name in _COMPILED_ARRAYS]
+        return sum(len(a) * a.itemsize for a in arrays)
+
+    def _header(self):
+        """Attributes of the tree other than its arrays and values"""
+        return {'layout': self.layout, 'arity': self.arity,
+                'quantize': self.quantize, 'dtype': self.dtype,
+                'n_dim': self.n_dim, 'limits': self.aabb.limits}
+
+    @classmethod
+    def _from_buffer(cls, header, buf, fields, values):
+        """Tree whose arrays are views of a buffer, such as shared memory
+
+        Args:
+            header (dict): Output of :meth:`_header`.
+            buf (memoryview): Bytes of the arrays, laid out as in *fields*.
+            fields (list): Output of :func:`_buffer_fields`.
+            values (sequence): The values of the leaves.
+
+        Returns:
+            CompiledAABBTree: The tree.
+        """
+        tree = cls.__new__(cls)
+        tree.layout = header['layout']
+        tree.arity = header['arity']
+        tree.quantize = header['quantize']
+        tree.dtype = header['dtype']
+        tree.n_dim = header['n_dim']
+        limits = header['limits']
+        tree.aabb = AABB() if limits is None else AABB(limits)
+        for name, code, offset, nbytes in fields:
+            setattr(tree, name, buf[offset:offset + nbytes].cast(code))
+        tree.values = values
+        return tree
+
+    def _release(self):
+        """Release the arrays of a tree made with :meth:`_from_buffer`"""
+        for name in _COMPILED_ARRAYS:
+            getattr(self, name).release()
+
+    def save(self, path):
+        """Save tree to a flat file
+
+        The file holds a short header followed by the arrays of the tree, so
+        that :meth:`load` can map it into memory without parsing.
+        Integer values are stored as an array. Other values are pickled.
+
+        *New in version 2.9.0*
+
+        Args:
+            path (str): Name of the file.
+        """
+        fields, size = _buffer_fields(self)
+        if all(isinstance(v, int) and not isinstance(v, bool)
+               for v in self.values):
+            values = array('q', self.values).tobytes()
+            value_format = 'int64'
+        else:
+            values = pickle.dumps(list(self.values))
+            value_format = 'pickle'
+
+        header = self._header()
+        header['fields'] = fields
+        header['values'] = [value_format, size, len(values)]
+        with open(path, 'wb') as f:
+            start = _write_flat_header(f, header)
+            for name, _, offset, _ in fields:
+                f.seek(start + offset)
+                f.write(getattr(self, name))
+            f.seek(start + size)
+            f.write(values)
+
+    @classmethod
+    def load(cls, path):
+        """Load tree from a flat file
+
+        The file is mapped into memory, so the arrays of the tree are read
+        from disk as they are used rather than all at once.
+
+        *New in version 2.9.0*
+
+        Args:
+            path (str): Name of a file written by :meth:`save` or
+                :meth:`stream_build`.
+
+        Returns:
+            CompiledAABBTree: The tree.
+        """
+        with open(path, 'rb') as f:
+            header, start = _read_flat_header(f)
+            data = memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))[start:]
+        value_format, offset, nbytes = header['values']
+        if value_format == 'int64':
+            values = data[offset:offset + nbytes].cast('q')
+        else:
+            values = pickle.loads(data[offset:offset + nbytes])
+        return cls._from_buffer(header, data, header['fields'], values)
+
+    @classmethod
+    def stream_build(cls, source, path, n_dim=None, chunk_size=65536,
+                     dtype='float64', record_dtype='float64', temp_dir=None):
+        """Build tree from more AABBs than fit in memory
+
+        This function builds a tree from a stream of AABBs and writes it to
+        a flat file, keeping about *chunk_size* AABBs in memory at a time.
+
+        The source is either an iterable of AABBs or the name of an array
+        file of records, where each record holds the limits of one AABB as
+        ``lower_1, upper_1, ..., lower_d, upper_d`` in *record_dtype*.
+        An iterable is first copied to a temporary array file.
+        The value of each AABB is its record number.
+
+        The build reads the records twice. The first pass samples their
+        centers and splits space into cells of about *chunk_size* records,
+        like :meth:`AABBTree.split`. The second pass sorts the records into
+        temporary files per cell. Each cell is then built into a subtree,
+        and the subtrees are joined by branches above the cells and written
+        into the file section by section.
+
+        *New in version 2.9.0*
+
+        Args:
+            source (str or iterable): Name of an array file, or the AABBs.
+            path (str): Name of the output file, for :meth:`load`.
+            n_dim (int, optional): Number of dimensions of the records.
+                Required for an array file.
+            chunk_size (int, optional): Number of AABBs per cell. Defaults
+                to 65536.
+            dtype (str): Type of the coordinates in the tree. See
+                :class:`CompiledAABBTree`. Defaults to 'float64'.
+            record_dtype (str): Type of the coordinates in the array file.
+                Defaults to 'float64'.
+            temp_dir (str, optional): Directory for temporary files.
+                Defaults to None, for the system default.
+
+        Returns:
+            CompiledAABBTree: The tree, loaded from *path*.
+        """
+        for name in (dtype, record_dtype):
+            if str(name) not in _DTYPES:
+                e_str = 'dtype should be one of ' + ', '.join(_DTYPES)
+                e_str += ', not ' + str(name)
+                raise ValueError(e_str)
+        if chunk_size < 1:
+            e_str = 'chunk_size should be at least 1, not ' + str(chunk_size)
+            raise ValueError(e_str)
+
+        with tempfile.TemporaryDirectory(dir=temp_dir) as temp:
+            if isinstance(source, (str, bytes, os.PathLike)):
+                if n_dim is None:
+                    raise ValueError('n_dim is required for an array file')
+                code = _DTYPES[str(record_dtype)]
+            else:
+                code = 'd'
+                source, n_dim = _spill_records(source, temp, chunk_size)
+            cells = _stream_cells(source, code, n_dim, chunk_size, temp)
+            subtrees = []
+            for k, (coords, indices) in enumerate(cells):
+                entries = [(AABB(list(zip(row[::2], row[1::2]))), index)
+                           for row, index in zip(coords, indices)]
+                compiled = _build(entries, 1).compile(dtype=str(dtype))
+                subtree = os.path.join(temp, 'subtree' + str(k))
+                compiled.save(subtree)
+                subtrees.append((subtree, compiled.aabb))
+                del entries, compiled
+            _stitch(subtrees, path, n_dim, str(dtype), chunk_size)
+        return cls.load(path)
+
+    @property
+    def depth(self):
+        """int: Depth of the tree"""
+        if len(self.values) == 0:
+            return 0
+        depth = 0
+        stack = [(0, 0)]
+        while stack:
+            node, level = stack.pop()
+            depth = max(depth, level)
+            for slot in range(self.child_ptr[node], self.child_ptr[node + 1]):
+                stack.append((self.child_idx[slot], level + 1))
+        return depth
+
+    def does_overlap(self, aabb, closed=False):
+        """Check for overlap
+
+        This function checks if the limits overlap any leaf nodes in the tree.
+        It returns true if there is an overlap.
+
+        Args:
+            aabb (AABB): The AABB to check.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+
+        Returns:
+            bool: True if overlaps with a leaf node of tree.
+        """
+        return len(self._overlap_leaves(aabb, closed, True)) > 0
+
+    def overlap_aabbs(self, aabb, closed=False, unique=True):
+        """Get overlapping AABBs
+
+        This function gets each overlapping AABB.
+
+        Args:
+            aabb (AABB): The AABB to check.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: AABB objects in the tree that overlap with the input.
+        """
+        pairs = self._overlap_pairs(aabb, closed, unique)
+        return [box for box, _ in pairs]
+
+    def overlap_values(self, aabb, closed=False, unique=True):
+        """Get values of overlapping AABBs
+
+        This function gets the value field of each overlapping AABB.
+
+        Args:
+            aabb (AABB): The AABB to check.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: Value fields of each leaf that overlaps.
+        """
+        pairs = self._overlap_pairs(aabb, closed, unique)
+        return [value for _, value in pairs]
+
+    def _leaf_aabb(self, leaf):
+        i = leaf * self.n_dim
+        j = i + self.n_dim
+        return AABB(list(zip(self.leaf_lowers[i:j], self.leaf_uppers[i:j])))
+
+    def _overlap_pairs(self, aabb, closed, unique):
+        leaves = self._overlap_leaves(aabb, closed)
+        pairs = [(self._leaf_aabb(k), self.values[k]) for k in leaves]
+        if len(pairs) < 2 or not unique:
+            return pairs
+        return _unique_pairs(pairs)
+
+    def _overlap_leaves(self, aabb, closed=False, halt=False):
+        leaves = []
+        if len(self.values) == 0 or not self.aabb.overlaps(aabb, closed):
+            return leaves
+
+        limits = aabb.limits
+        n_dim = self.n_dim
+        root_bounds = ([lb for lb, _ in self.aabb.limits],
+                       [ub for _, ub in self.aabb.limits])
+        stack = [(0, root_bounds, False)]
+        while stack:
+            node, bounds, covered = stack.pop()
+            if covered:
+                leaves.extend(range(self.leaf_start[node],
+                                    self.leaf_stop[node]))
+                if halt:
+                    return leaves[:1]
+                continue
+
+            first = self.child_ptr[node]
+            last = self.child_ptr[node + 1]
+            if first == last:
+                for leaf in range(self.leaf_start[node], self.leaf_stop[node]):
+                    if _flat_overlaps(self.leaf_lowers, self.leaf_uppers,
+                                      leaf * n_dim, limits, closed):
+                        leaves.append(leaf)
+                        if halt:
+                            return leaves
+                continue
+
+            if self.quantize is None:
+                lowers = self.child_lowers
+                uppers = self.child_uppers
+                base = 0
+            else:
+                lowers, uppers = self._decode(first, last, bounds)
+                base = first
+            slots = _block_overlaps(lowers, uppers, first - base, last - base,
+                                    n_dim, limits, closed)
+            for s in reversed(slots):
+                i = s * n_dim
+                j = i + n_dim
+                child_bounds = (lowers[i:j], uppers[i:j])
+                covered = _covers_bounds(limits, child_bounds, closed)
+                stack.append((self.child_idx[base + s], child_bounds, covered))
+        return leaves
+
+    def _decode(self, first, last, bounds):
+        """Full-precision bounds of quantized child slots"""
+        n_max = (1 << self.quantize) - 1
+        steps = [(high - low) / n_max for low, high in zip(*bounds)]
+        params = list(zip(bounds[0], bounds[1], steps))
+        lowers = []
+        uppers = []
+        for s in range(first, last):
+            offset = s * self.n_dim
+            for i, (low, high, step) in enumerate(params):
+                lowers.append(_dequantize(self.child_lowers[offset + i],
+                                          low, high, step, n_max))
+                uppers.append(_dequantize(self.child_uppers[offset + i],
+                                          low, high, step, n_max))
+        return lowers, uppers
+
+
+class AsyncAABBIndex(object):  # pylint: disable=useless-object-inheritance
+    """Asyncio Query Service
+
+    A wrapper that answers overlap queries from coroutines.
+    Queries arriving within *window* seconds of each other are gathered
+    into one batch and answered with a single call to
+    ``tree.overlap_values_many``, run in an executor so the event loop is
+    not blocked. Each caller receives the values for its own query.
+
+    The tree should not be modified while queries are pending.
+
+    *New in version 2.9.0*
+
+    Args:
+        tree (AABBTree): The tree to query. Any index with an
+            ``overlap_values_many`` method may be used.
+        window (float, optional): Time to wait for more queries after the
+            first query of a batch, in seconds. Defaults to 0.001.
+        max_batch (int, optional): Maximum number of queries in a batch. A
+            full batch is sent without waiting. Defaults to 256.
+        closed (bool, optional): Option to specify closed or open box
+            intersection. Defaults to False.
+        unique (bool, optional): Return only unique values. Defaults to True.
+        executor (concurrent.futures.Executor, optional): The executor that
+            runs the batches. Defaults to None, for the loop's default
+            executor.
+
+    """
+    def __init__(self, tree, window=0.001, max_batch=256, closed=False,
+                 unique=True, executor=None):
+        self.tree = tree
+        self.window = window
+        self.max_batch = max_batch
+        self.closed = closed
+        self.unique = unique
+        self.executor = executor
+        self._pending = []
+        self._timer = None
+
+    async def query(self, aabb):
+        """Get values of overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+
+        Returns:
+            list: Value fields of each node that overlaps.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((aabb, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._pending
+        self._pending = []
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        aabbs = [aabb for aabb, _ in batch]
+        done = loop.run_in_executor(self.executor,
+                                    self.tree.overlap_values_many, aabbs,
+                                    self.closed, self.unique)
+        done.add_done_callback(lambda f: _resolve_batch(batch, f))
+
+
+class OverlapCursor(object):  # pylint: disable=useless-object-inheritance
+    """Resumable Overlap Query
+
+    An iterator over the values of the AABBs overlapping a query, created
+    with :meth:`AABBTree.overlap_cursor`.
+    The traversal of the tree stops between pages and resumes where the
+    previous page ended.
+
+    *New in version 2.9.0*
+
+    Args:
+        pairs (iterator): Lazy (AABB, value) pairs.
+
+    """
+    def __init__(self, pairs):
+        self._pairs = pairs
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._pairs)[1]
+        except StopIteration:
+            self.done = True
+            raise
+
+    def next(self):  # pragma: no cover
+        """___next__ for Python 2"""
+        return self.__next__()
+
+    def fetch(self, n):
+        """Get the next page of values
+
+        Args:
+            n (int): Maximum number of values in the page.
+
+        Returns:
+            list: Up to *n* values. Fewer are returned at the end of the
+            query, after which :attr:`done` is True.
+        """
+        page = list(itertools.islice(self, n))
+        if len(page) < n:
+            self.done = True
+        return page
+
+
+class SnapshotAABBTree(object):  # pylint: disable=useless-object-inheritance
+    """Copy-on-Write AABB Tree
+
+    An AABB tree that can be queried by reader threads while it is being
+    updated.
+    Each call to :meth:`add` copies the nodes along the insertion path and
+    shares every other subtree with the previous version of the tree, then
+    publishes the new root as the current snapshot.
+    Snapshots are never modified, so readers do not need a lock and never
+    see a partial update. Writers are serialized with a lock.
+
+    *New in version 2.9.0*
+
+    Args:
+        tree (AABBTree, optional): The initial snapshot. It should not be
+            modified after being passed in. Defaults to an empty tree.
+        leaf_size (int, optional): The maximum number of AABBs in a leaf,
+            used if *tree* is not given. Defaults to 1.
+
+    """
+    def __init__(self, tree=None, leaf_size=1):
+        if tree is None:
+            tree = AABBTree(leaf_size=leaf_size)
+        self.tree = tree
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tree)
+
+    def snapshot(self):
+        """Get the current snapshot
+
+        Returns:
+            AABBTree: The current version of the tree. It should not be
+            modified.
+        """
+        return self.tree
+
+    def add(self, aabb, value=None, method='volume'):
+        """Add node to tree
+
+        This function inserts a node into a copy of the current snapshot,
+        following the same rules as :meth:`AABBTree.add`, then makes the
+        copy the current snapshot.
+
+        Args:
+            aabb (AABB): The AABB to add.
+            value: The value associated with the AABB. Defaults to None.
+            method (str): The method for deciding how to build the tree.
+                Defaults to 'volume'.
+        """
+        with self._lock:
+            self.tree = _path_copy_add(self.tree, aabb, value, method)
+
+    def does_overlap(self, aabb, method='DFS', closed=False):
+        """Check for overlap in the current snapshot
+
+        See :meth:`AABBTree.does_overlap`.
+        """
+        return self.tree.does_overlap(aabb, method, closed)
+
+    def overlap_aabbs(self, aabb, method='DFS', closed=False, unique=True,
+                      limit=None):
+        """Get overlapping AABBs in the current snapshot
+
+        See :meth:`AABBTree.overlap_aabbs`.
+        """
+        return self.tree.overlap_aabbs(aabb, method, closed, unique, limit)
+
+    def overlap_values(self, aabb, method='DFS', closed=False, unique=True,
+                       limit=None):
+        """Get values of overlapping AABBs in the current snapshot
+
+        See :meth:`AABBTree.overlap_values`.
+        """
+        return self.tree.overlap_values(aabb, method, closed, unique, limit)
+
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        """Get values of overlapping AABBs for many queries
+
+        All of the queries are answered from the same snapshot.
+        See :meth:`AABBTree.overlap_values_many`.
+        """
+        return self.tree.overlap_values_many(aabbs, closed, unique)
+
+
+class SweepAndPrune(object):  # pylint: disable=useless-object-inheritance
+    """Sweep and Prune
+
+    A broad phase that keeps the AABBs sorted by their lower bound along one
+    axis, as an alternative to the AABB tree for scenes where every AABB
+    moves at each step.
+    Moving an AABB restores the order with an insertion sort, which takes
+    only a few swaps when AABBs move a little between steps.
+    Overlap queries only test the AABBs whose interval along the axis can
+    reach the query.
+
+    AABBs are inserted with :meth:`insert`, which returns a handle used to
+    update or remove the AABB.
+
+    *New in version 2.9.0*
+
+    Args:
+        axis (int, optional): The axis to sort along. Defaults to 0.
+
+    """
+    def __init__(self, axis=0):
+        self.axis = axis
+        self._boxes = {}
+        self._order = []
+        self._lows = []
+        self._max_len = 0
+        self._next_handle = 0
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def insert(self, aabb, value=None):
+        """Insert an AABB
+
+        Args:
+            aabb (AABB): The AABB to add.
+            value: The value associated with the AABB. Defaults to None.
+
+        Returns:
+            int: Handle of the AABB.
+        """
+        handle = self._next_handle
+        self._next_handle += 1
+        self._boxes[handle] = (aabb, value)
+
+        lower, upper = aabb.limits[self.axis]
+        i = bisect.bisect_right(self._lows, lower)
+        self._lows.insert(i, lower)
+        self._order.insert(i, handle)
+        if self._max_len is not None:
+            self._max_len = max(self._max_len, upper - lower)
+        return handle
+
+    def remove(self, handle):
+        """Remove an AABB
+
+        Args:
+            handle (int): Handle of the AABB, from :meth:`insert`.
+        """
+        i = self._index(handle)
+        del self._lows[i]
+        del self._order[i]
+        aabb, _ = self._boxes.pop(handle)
+        lower, upper = aabb.limits[self.axis]
+        if self._max_len is not None and upper - lower >= self._max_len:
+            # Longest AABB removed, recompute at the next query
+            self._max_len = None
+
+    def update(self, handle, aabb):
+        """Move an AABB
+
+        Args:
+            handle (int): Handle of the AABB, from :meth:`insert`.
+            aabb (AABB): The new AABB.
+        """
+        i = self._index(handle)
+        old_lower, old_upper = self._boxes[handle][0].limits[self.axis]
+        self._boxes[handle] = (aabb, self._boxes[handle][1])
+        lower, upper = aabb.limits[self.axis]
+        if self._max_len is not None:
+            if upper - lower >= self._max_len:
+                self._max_len = upper - lower
+            elif old_upper - old_lower >= self._max_len:
+                # Longest AABB shrank, recompute at the next query
+                self._max_len = None
+
+        lows = self._lows
+        order = self._order
+        lows[i] = lower
+        while i > 0 and lows[i - 1] > lower:
+            lows[i], lows[i - 1] = lows[i - 1], lower
+            order[i], order[i - 1] = order[i - 1], handle
+            i -= 1
+        while i < len(lows) - 1 and lows[i + 1] < lower:
+            lows[i], lows[i + 1] = lows[i + 1], lower
+            order[i], order[i + 1] = order[i + 1], handle
+            i += 1
+
+    def does_overlap(self, aabb, method='DFS', closed=False):
+        """Check for overlap
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the sweep has no tree to traverse. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+
+        Returns:
+            bool: True if overlaps with an AABB.
+        """
+        return len(self._overlap_pairs(aabb, method, closed, True)) > 0
+
+    def overlap_aabbs(self, aabb, method='DFS', closed=False, unique=True):
+        """Get overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the sweep has no tree to traverse. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: AABB objects that overlap with the input.
+        """
+        pairs = self._overlap_pairs(aabb, method, closed)
+        if unique and len(pairs) > 1:
+            pairs = _unique_pairs(pairs)
+        return [box for box, _ in pairs]
+
+    def overlap_values(self, aabb, method='DFS', closed=False, unique=True):
+        """Get values of overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the sweep has no tree to traverse. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: Value fields of each AABB that overlaps.
+        """
+        pairs = self._overlap_pairs(aabb, method, closed)
+        if unique and len(pairs) > 1:
+            pairs = _unique_pairs(pairs)
+        return [value for _, value in pairs]
+
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        """Get values of overlapping AABBs for many queries
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: For each input AABB, the list of value fields of each AABB
+            that overlaps.
+        """
+        return [self.overlap_values(aabb, closed=closed, unique=unique)
+                for aabb in aabbs]
+
+    def overlap_pairs(self, closed=False):
+        """Get all pairs of overlapping AABBs
+
+        This function sweeps along the axis, keeping the AABBs whose interval
+        contains the sweep position, and tests each AABB against them.
+
+        Args:
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+
+        Returns:
+            list: (value, value) pairs for each pair of AABBs that overlap.
+            In each pair, the first AABB is the one with the lower bound
+            that comes first along the axis.
+        """
+        pairs = []
+        active = []
+        for handle, lower in zip(self._order, self._lows):
+            aabb, value = self._boxes[handle]
+            if closed:
+                active = [h for h in active
+                          if self._boxes[h][0].limits[self.axis][1] >= lower]
+            else:
+                active = [h for h in active
+                          if self._boxes[h][0].limits[self.axis][1] > lower]
+            for other in active:
+                other_aabb, other_value = self._boxes[other]
+                if other_aabb.overlaps(aabb, closed):
+                    pairs.append((other_value, value))
+            active.append(handle)
+        return pairs
+
+    def _index(self, handle):
+        lower = self._boxes[handle][0].limits[self.axis][0]
+        i = bisect.bisect_left(self._lows, lower)
+        while self._order[i] != handle:
+            i += 1
+        return i
+
+    def _overlap_pairs(self, aabb, method, closed, halt=False):
+        if method not in ('DFS', 'BFS'):
+            e_str = "method should be 'DFS' or 'BFS', not " + str(method)
+            raise ValueError(e_str)
+
+        pairs = []
+        if aabb.limits is None or not self._boxes:
+            return pairs
+
+        lower, upper = aabb.limits[self.axis]
+        if closed:
+            stop = bisect.bisect_right(self._lows, upper)
+        else:
+            stop = bisect.bisect_left(self._lows, upper)
+        if self._max_len is None:
+            self._max_len = max(box.limits[self.axis][1] -
+                                box.limits[self.axis][0]
+                                for box, _ in self._boxes.values())
+        start = bisect.bisect_left(self._lows, lower - self._max_len)
+        for handle in self._order[start:stop]:
+            entry = self._boxes[handle]
+            if entry[0].overlaps(aabb, closed):
+                pairs.append(entry)
+                if halt:
+                    break
+        return pairs
+
+
+class GridIndex(object):  # pylint: disable=useless-object-inheritance
+    """Uniform Hash Grid
+
+    An index that stores each AABB in every cell of a uniform grid that it
+    touches, as an alternative to the AABB tree for densely packed AABBs of
+    similar size.
+    Only the occupied cells are stored, in a dictionary.
+    The index has the same query methods as :class:`AABBTree`.
+
+    If *cell_size* is not given, it is chosen from the AABBs in
+    :meth:`from_aabbs` as the median side length along each axis, or from
+    the first AABB added with :meth:`add`.
+
+    *New in version 2.9.0*
+
+    Args:
+        cell_size (float or iterable, optional): The side length of the
+            cells, either one value or one per axis. Defaults to None.
+
+    """
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_aabbs(cls, aabbs, values=None, cell_size=None):
+        """Build index from many AABBs
+
+        The cells of all of the AABBs are found one axis at a time.
+
+        Args:
+            aabbs (iterable): The AABBs to add.
+            values (iterable, optional): The value associated with each AABB.
+                Defaults to None for every AABB.
+            cell_size (float or iterable, optional): The side length of the
+                cells. Defaults to None, for the median side length of the
+                AABBs along each axis.
+
+        Returns:
+            GridIndex: An index containing the AABBs.
+        """
+        aabbs = list(aabbs)
+        values = len(aabbs) * [None] if values is None else list(values)
+        if len(aabbs) != len(values):
+            e_str = 'Number of AABBs and values differ: ' + str(len(aabbs))
+            e_str += ' and ' + str(len(values))
+            raise ValueError(e_str)
+
+        index = cls(cell_size)
+        if not aabbs:
+            return index
+        if cell_size is None:
+            index.cell_size = _median_sides(aabbs)
+        sizes = index._sizes(len(aabbs[0]))
+
+        # Cell ranges of every AABB, one axis at a time
+        ranges = []
+        for axis, size in enumerate(sizes):
+            ranges.append([(int(math.floor(box.limits[axis][0] / size)),
+                            int(math.floor(box.limits[axis][1] / size)) + 1)
+                           for box in aabbs])
+
+        index.entries = list(zip(aabbs, values))
+        cells = index.cells
+        for k, box_ranges in enumerate(zip(*ranges)):
+            for cell in itertools.product(*[range(*r) for r in box_ranges]):
+                cells.setdefault(cell, []).append(k)
+        return index
+
+    def add(self, aabb, value=None):
+        """Add an AABB
+
+        Args:
+            aabb (AABB): The AABB to add.
+            value: The value associated with the AABB. Defaults to None.
+        """
+        if self.cell_size is None:
+            self.cell_size = _median_sides([aabb])
+        k = len(self.entries)
+        self.entries.append((aabb, value))
+        for cell in self._cells(aabb):
+            self.cells.setdefault(cell, []).append(k)
+
+    def does_overlap(self, aabb, method='DFS', closed=False):
+        """Check for overlap
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the grid looks up cells instead. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+
+        Returns:
+            bool: True if overlaps with an AABB in the index.
+        """
+        return len(self._overlap_pairs(aabb, method, closed, True)) > 0
+
+    def overlap_aabbs(self, aabb, method='DFS', closed=False, unique=True):
+        """Get overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the grid looks up cells instead. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: AABB objects in the index that overlap with the input.
+        """
+        pairs = self._overlap_pairs(aabb, method, closed)
+        if unique and len(pairs) > 1:
+            pairs = _unique_pairs(pairs)
+        return [box for box, _ in pairs]
+
+    def overlap_values(self, aabb, method='DFS', closed=False, unique=True):
+        """Get values of overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+            method (str): {'DFS'|'BFS'} Accepted to match :class:`AABBTree`,
+                as the grid looks up cells instead. Defaults to 'DFS'.
+            closed (bool): Option to specify closed or open box intersection.
+                If open, there must be a non-zero amount of overlap. If closed,
+                boxes can be touching.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: Value fields of each AABB that overlaps.
+        """
+        pairs = self._overlap_pairs(aabb, method, closed)
+        if unique and len(pairs) > 1:
+            pairs = _unique_pairs(pairs)
+        return [value for _, value in pairs]
+
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        """Get values of overlapping AABBs for many queries
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: For each input AABB, the list of value fields of each AABB
+            that overlaps.
+        """
+        return [self.overlap_values(aabb, closed=closed, unique=unique)
+                for aabb in aabbs]
+
+    def _sizes(self, n_dim):
+        try:
+            sizes = list(self.cell_size)
+        except TypeError:
+            sizes = n_dim * [self.cell_size]
+        return sizes
+
+    def _cells(self, aabb):
+        sizes = self._sizes(len(aabb))
+        ranges = [range(int(math.floor(lb / size)),
+                        int(math.floor(ub / size)) + 1)
+                  for (lb, ub), size in zip(aabb.limits, sizes)]
+        return itertools.product(*ranges)
+
+    def _overlap_pairs(self, aabb, method, closed, halt=False):
+        if method not in ('DFS', 'BFS'):
+            e_str = "method should be 'DFS' or 'BFS', not " + str(method)
+            raise ValueError(e_str)
+
+        pairs = []
+        if aabb.limits is None or not self.entries:
+            return pairs
+
+        sizes = self._sizes(len(aabb))
+        bounds = [(int(math.floor(lb / size)), int(math.floor(ub / size)))
+                  for (lb, ub), size in zip(aabb.limits, sizes)]
+        n_cells = 1
+        for lower, upper in bounds:
+            n_cells *= upper - lower + 1
+        if n_cells > len(self.cells):
+            cells = [c for c in self.cells
+                     if all(lb <= i <= ub for i, (lb, ub) in zip(c, bounds))]
+        else:
+            cells = [c for c in self._cells(aabb) if c in self.cells]
+
+        candidates = set()
+        for cell in cells:
+            candidates.update(self.cells[cell])
+        for k in sorted(candidates):
+            entry = self.entries[k]
+            if entry[0].overlaps(aabb, closed):
+                pairs.append(entry)
+                if halt:
+                    break
+        return pairs
+
+
+class ShardedAABBIndex(object):  # pylint: disable=useless-object-inheritance
+    """Multi-Process Sharded Index
+
+    An index that splits the AABBs of a tree into spatial shards with
+    :meth:`AABBTree.split` and answers queries in one worker process per
+    shard, so that queries can use more than one core.
+    Each shard is compiled into a :class:`CompiledAABBTree` whose arrays are
+    stored in shared memory, where the worker reads them without a copy.
+
+    The index keeps the bounds of each shard and sends a query only to the
+    workers whose shard overlaps it, over a pipe. The workers return leaf
+    numbers, which are matched to values in this process, so the values
+    do not need to be picklable.
+
+    Call :meth:`close` to stop the workers and free the shared memory, or
+    use the index as a context manager.
+    This class requires Python 3.8 or later.
+
+    *New in version 2.9.0*
+
+    Args:
+        tree (AABBTree): The tree to shard. It is not modified.
+        n_shards (int, optional): Number of shards and worker processes.
+            Defaults to None, for the number of CPUs.
+        dtype (str): Type of the coordinates in shared memory. See
+            :class:`CompiledAABBTree`. Defaults to 'float64'.
+
+    """
+    def __init__(self, tree, n_shards=None, dtype='float64'):
+        if shared_memory is None:  # pragma: no cover
+            raise RuntimeError('ShardedAABBIndex requires Python 3.8+')
+        if n_shards is None:
+            n_shards = os.cpu_count() or 1
+
+        self.bounds = []
+        self._trees = []
+        self._memory = []
+        self._conns = []
+        self._workers = []
+        try:
+            for shard, bounds in tree.split(n_shards):
+                self._start(shard.compile(dtype=dtype))
+                self.bounds.append(bounds)
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self):
+        return sum(len(compiled) for compiled in self._trees)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start(self, compiled):
+        fields, size = _buffer_fields(compiled)
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._memory.append(memory)
+        for name, _, offset, nbytes in fields:
+            memory.buf[offset:offset + nbytes] = getattr(compiled,
+                                                         name).tobytes()
+        header = compiled._header()
+        self._trees.append(CompiledAABBTree._from_buffer(header, memory.buf,
+                                                         fields,
+                                                         compiled.values))
+
+        conn, worker_conn = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=_shard_worker,
+                                         args=(worker_conn, memory.name,
+                                               header, fields))
+        worker.daemon = True
+        worker.start()
+        worker_conn.close()
+        self._conns.append(conn)
+        self._workers.append(worker)
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        for worker in self._workers:
+            worker.join()
+        for compiled in self._trees:
+            compiled._release()
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._conns = []
+        self._workers = []
+        self._trees = []
+        self._memory = []
+
+    def does_overlap(self, aabb, closed=False):
+        """Check for overlap
+
+        Args:
+            aabb (AABB): The AABB to check.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+
+        Returns:
+            bool: True if overlaps with an AABB in the index.
+        """
+        return len(self.overlap_values(aabb, closed, unique=False)) > 0
+
+    def overlap_values(self, aabb, closed=False, unique=True):
+        """Get values of overlapping AABBs
+
+        Args:
+            aabb (AABB): The AABB to check.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: Value fields of each AABB that overlaps.
+        """
+        return self.overlap_values_many([aabb], closed, unique)[0]
+
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        """Get values of overlapping AABBs for many queries
+
+        Each worker receives the queries that overlap its shard in one
+        message, and the workers search their shards at the same time.
+
+        Args:
+            aabbs (iterable): The AABBs to check.
+            closed (bool): Option to specify closed or open box intersection.
+                Defaults to False.
+            unique (bool): Return only unique pairs. Defaults to True.
+
+        Returns:
+            list: For each input AABB, the list of value fields of each AABB
+            that overlaps, in shard order.
+        """
+        aabbs = list(aabbs)
+        routes = []
+        for conn, bounds in zip(self._conns, self.bounds):
+            active = [q for q, aabb in enumerate(aabbs)
+                      if bounds.overlaps(aabb, closed)]
+            if active:
+                conn.send(([aabbs[q].limits for q in active], closed))
+            routes.append(active)
+
+        results = [[] for _ in aabbs]
+        for conn, compiled, active in zip(self._conns, self._trees, routes):
+            if not active:
+                continue
+            for q, leaves in zip(active, conn.recv()):
+                results[q].extend((compiled, leaf) for leaf in leaves)
+
+        if not unique:
+            return [[compiled.values[leaf] for compiled, leaf in hits]
+                    for hits in results]
+        values = []
+        for hits in results:
+            pairs = [(compiled._leaf_aabb(leaf), compiled.values[leaf])
+                     for compiled, leaf in hits]
+            if len(pairs) > 1:
+                pairs = _unique_pairs(pairs)
+            values.append([value for _, value in pairs])
+        return values
+
+
+def _buffer_fields(compiled):
+    """Layout of the arrays of a compiled tree in one buffer
+
+    Each array starts on an 8-byte boundary.
+
+    Returns:
+        tuple: List of (name, typecode, offset, nbytes) for each array, and
+        the total size in bytes.
+    """
+    sections = []
+    for name in _COMPILED_ARRAYS:
+        arr = getattr(compiled, name)
+        code = arr.format if isinstance(arr, memoryview) else arr.typecode
+        sections.append((name, code, len(arr) * arr.itemsize))
+    return _section_layout(sections)
+
+
+def _section_layout(sections):
+    """Offsets of (name, typecode, nbytes) sections, 8-byte aligned"""
+    fields = []
+    offset = 0
+    for name, code, nbytes in sections:
+        fields.append((name, code, offset, nbytes))
+        offset += -(-nbytes // 8) * 8
+    return fields, offset
+
+
+def _write_flat_header(f, header):
+    """Write the header of a flat file and return the start of its data"""
+    text = json.dumps(header).encode('utf-8')
+    f.write(_FLAT_MAGIC + struct.pack('<Q', len(text)) + text)
+    start = -(-f.tell() // 8) * 8
+    f.write(bytes(start - f.tell()))
+    return start
+
+
+def _read_flat_header(f):
+    """Read the header of a flat file and the start of its data"""
+    magic = f.read(len(_FLAT_MAGIC))
+    if magic != _FLAT_MAGIC:
+        raise ValueError('Not an AABBTree flat file: ' + str(f.name))
+    n_bytes, = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(n_bytes).decode('utf-8'))
+    header['fields'] = [tuple(field) for field in header['fields']]
+    return header, -(-f.tell() // 8) * 8
+
+
+def _spill_records(aabbs, temp, chunk_size):
+    """Copy AABBs to a float64 array file of records"""
+    path = os.path.join(temp, 'records')
+    n_dim = None
+    with open(path, 'wb') as f:
+        chunk = array('d')
+        for aabb in aabbs:
+            if n_dim is None:
+                n_dim = len(aabb)
+            for lims in aabb.limits:
+                chunk.extend(lims)
+            if len(chunk) >= 2 * n_dim * chunk_size:
+                chunk.tofile(f)
+                chunk = array('d')
+        chunk.tofile(f)
+    return path, n_dim or 0
+
+
+def _record_chunks(path, code, n_dim, chunk_size, numbers=None):
+    """Read an array file of records in chunks
+
+    Args:
+        numbers (str, optional): Array file of the record numbers. Defaults
+            to None, for the position of each record in the file.
+
+    Yields:
+        tuple: Record numbers and a list of records.
+    """
+    width = 2 * n_dim
+    size = array(code).itemsize * width
+    with open(path, 'rb') as f:
+        g = None if numbers is None else open(numbers, 'rb')
+        try:
+            first = 0
+            while True:
+                data = f.read(size * chunk_size)
+                if not data:
+                    break
+                if len(data) % size:
+                    e_str = 'Incomplete record at end of ' + str(path)
+                    raise ValueError(e_str)
+                flat = array(code)
+                flat.frombytes(data)
+                records = [flat[i:i + width]
+                           for i in range(0, len(flat), width)]
+                if g is None:
+                    chunk_numbers = range(first, first + len(records))
+                else:
+                    chunk_numbers = array('q')
+                    chunk_numbers.frombytes(g.read(8 * len(records)))
+                yield chunk_numbers, records
+                first += len(records)
+        finally:
+            if g is not None:
+                g.close()
+
+
+def _stream_cells(path, code, n_dim, chunk_size, temp, numbers=None,
+                  prefix=None):
+    """Sort the records of an array file into spatial cells
+
+    Cells with more than *chunk_size* records are sorted again from their
+    own files, so no cell in memory has more than *chunk_size* records.
+
+    Yields:
+        tuple: The records of each cell and their record numbers.
+    """
+    n_records = 0
+    if n_dim > 0:
+        n_records = os.path.getsize(path) // (array(code).itemsize * 2 * n_dim)
+    if n_records == 0:
+        return
+    if n_records <= chunk_size:
+        for chunk_numbers, records in _record_chunks(path, code, n_dim,
+                                                     chunk_size, numbers):
+            yield records, array('q', chunk_numbers)
+        return
+
+    # First pass: sample the centers
+    n_sample = max(chunk_size, 2)
+    n_cells = min(-(-n_records // chunk_size), n_sample // 2)
+    stride = max(1, n_records // n_sample)
+    sample = []
+    sample_numbers = []
+    position = 0
+    for chunk_numbers, records in _record_chunks(path, code, n_dim,
+                                                 chunk_size, numbers):
+        for i in range(-position % stride, len(records), stride):
+            row = records[i]
+            sample.append([0.5 * (lb + ub)
+                           for lb, ub in zip(row[::2], row[1::2])])
+            sample_numbers.append(chunk_numbers[i])
+        position += len(records)
+    cuts = _partition_cells(sample, sample_numbers, n_cells)
+
+    # Second pass: append the records to their cell files
+    if prefix is None:
+        prefix = os.path.join(temp, 'cell')
+    names = [prefix + '_' + str(k) for k in range(n_cells)]
+    counts = n_cells * [0]
+    for chunk_numbers, records in _record_chunks(path, code, n_dim,
+                                                 chunk_size, numbers):
+        coords = [array(code) for _ in names]
+        indices = [array('q') for _ in names]
+        for number, row in zip(chunk_numbers, records):
+            k = _find_cell(cuts, row, number)
+            coords[k].extend(row)
+            indices[k].append(number)
+        for k, name in enumerate(names):
+            if indices[k]:
+                counts[k] += len(indices[k])
+                with open(name, 'ab') as f:
+                    indices[k].tofile(f)
+                with open(name + '.coords', 'ab') as f:
+                    coords[k].tofile(f)
+
+    for name, count in zip(names, counts):
+        if count == 0:
+            continue
+        if count < n_records:
+            cells = _stream_cells(name + '.coords', code, n_dim, chunk_size,
+                                  temp, name, name)
+        else:
+            # No split was made, so read the cell in pieces
+            cells = ((records, array('q', chunk_numbers))
+                     for chunk_numbers, records
+                     in _record_chunks(name + '.coords', code, n_dim,
+                                       chunk_size, name))
+        for cell in cells:
+            yield cell
+        os.remove(name)
+        os.remove(name + '.coords')
+
+
+def _partition_cells(centers, numbers, n_cells):
+    """Split sampled centers into cells, as in :meth:`AABBTree.split`
+
+    Ties between centers are broken by record number, so that records with
+    the same center are spread across cells.
+
+    Returns:
+        tuple: Nested (axis, cut, left, right) splits, where a record goes
+        left if its (center along *axis*, record number) is below *cut*,
+        and cell numbers at the ends.
+    """
+    next_cell = [0]
+
+    def split(group, group_numbers, n_parts):
+        if n_parts <= 1 or len(group) < 2:
+            cell = next_cell[0]
+            next_cell[0] += n_parts
+            return cell
+        n_left = n_parts // 2
+        spreads = [max(c) - min(c) for c in zip(*group)]
+        axis = spreads.index(max(spreads))
+        order = sorted(range(len(group)),
+                       key=lambda k: (group[k][axis], group_numbers[k]))
+        half = len(group) * n_left // n_parts
+        left, right = order[:half], order[half:]
+        cut = (group[right[0]][axis], group_numbers[right[0]])
+        return (axis, cut,
+                split([group[i] for i in left],
+                      [group_numbers[i] for i in left], n_left),
+                split([group[i] for i in right],
+                      [group_numbers[i] for i in right], n_parts - n_left))
+
+    return split(centers, numbers, n_cells)
+
+
+def _find_cell(cuts, row, number):
+    """Cell number of a record, from :func:`_partition_cells`"""
+    while not isinstance(cuts, int):
+        axis, cut, left, right = cuts
+        center = 0.5 * (row[2 * axis] + row[2 * axis + 1])
+        cuts = left if (center, number) < cut else right
+    return cuts
+
+
+def _stitch(subtrees, path, n_dim, dtype, chunk_size):
+    """Join saved subtrees under new branches and write one flat file
+
+    The branches above the subtrees come first, in depth-first order,
+    followed by each subtree in the order of its leaves.
+    """
+    code = _DTYPES[dtype]
+    cast = _caster(code)
+    if subtrees:
+        cells = [AABBTree(bounds, value=k)
+                 for k, (_, bounds) in enumerate(subtrees)]
+        top = _graft(cells, _centers((cell.aabb, None) for cell in cells))
+    else:
+        top = AABBTree()
+
+    # Depth-first branches and the order of the subtrees below them
+    branches = []
+    order = []
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf:
+            if node.value is not None:
+                order.append(node.value)
+        else:
+            branches.append(node)
+            stack.extend((node.right, node.left))
+    index = {id(node): i for i, node in enumerate(branches)}
+
+    # Sizes and offsets of each subtree within the joined arrays
+    headers = []
+    ranges = {}
+    node_base = len(branches)
+    slot_base = 2 * len(branches)
+    leaf_base = 0
+    for k in order:
+        with open(subtrees[k][0], 'rb') as f:
+            header, _ = _read_flat_header(f)
+        sizes = {name: nbytes // array(fcode).itemsize
+                 for name, fcode, _, nbytes in header['fields']}
+        n_leaves = header['values'][2] // 8
+        header['bases'] = (node_base, slot_base, leaf_base)
+        node_base += sizes['leaf_start']
+        slot_base += sizes['child_idx']
+        leaf_base += n_leaves
+        headers.append(header)
+        ranges[k] = (header['bases'][2], leaf_base)
+    cell_roots = {k: h['bases'][0] for k, h in zip(order, headers)}
+
+    # Leaf ranges of the branches, from the bottom up
+    for node in reversed(branches):
+        kids = [ranges[kid.value] if kid.is_leaf else ranges[id(kid)]
+                for kid in (node.left, node.right)]
+        ranges[id(node)] = (kids[0][0], kids[1][1])
+
+    top_arrays = {'child_ptr': array('q', range(0, 2 * len(branches), 2)),
+                  'child_idx': array('q'), 'child_lowers': array(code),
+                  'child_uppers': array(code), 'leaf_start': array('q'),
+                  'leaf_stop': array('q')}
+    for node in branches:
+        for kid in (node.left, node.right):
+            if kid.is_leaf:
+                top_arrays['child_idx'].append(cell_roots[kid.value])
+            else:
+                top_arrays['child_idx'].append(index[id(kid)])
+            for lb, ub in kid.aabb.limits:
+                top_arrays['child_lowers'].append(cast(lb))
+                top_arrays['child_uppers'].append(cast(ub))
+        top_arrays['leaf_start'].append(ranges[id(node)][0])
+        top_arrays['leaf_stop'].append(ranges[id(node)][1])
+
+    counts = {'child_ptr': node_base + 1, 'child_idx': slot_base,
+              'child_lowers': slot_base * n_dim,
+              'child_uppers': slot_base * n_dim,
+              'leaf_start': node_base, 'leaf_stop': node_base,
+              'leaf_lowers': leaf_base * n_dim,
+              'leaf_uppers': leaf_base * n_dim}
+    sections = []
+    for name in _COMPILED_ARRAYS:
+        fcode = 'q' if name in _INDEX_ARRAYS else code
+        sections.append((name, fcode, counts[name] * array(fcode).itemsize))
+    fields, size = _section_layout(sections)
+
+    header = {'layout': 'dfs', 'arity': 2, 'quantize': None, 'dtype': dtype,
+              'n_dim': n_dim, 'limits': None if not subtrees else
+              [[cast(lb), cast(ub)] for lb, ub in top.aabb.limits],
+              'fields': fields, 'values': ['int64', size, 8 * leaf_base]}
+    with open(path, 'wb') as f:
+        start = _write_flat_header(f, header)
+        for name, _, offset, _ in fields:
+            f.seek(start + offset)
+            f.write(top_arrays.get(name, b''))
+            for k, sub_header in zip(order, headers):
+                _copy_section(f, subtrees[k][0], sub_header, name,
+                              chunk_size)
+            if name == 'child_ptr':
+                f.write(array('q', [slot_base]))
+        f.seek(start + size)
+        for k, sub_header in zip(order, headers):
+            _copy_section(f, subtrees[k][0], sub_header, 'values',
+                          chunk_size)
+
+
+def _copy_section(f, subtree, header, name, chunk_size):
+    """Append an array of a saved subtree to a file, shifting indices"""
+    node_base, slot_base, leaf_base = header['bases']
+    shift = {'child_ptr': slot_base, 'child_idx': node_base,
+             'leaf_start': leaf_base, 'leaf_stop': leaf_base}.get(name, 0)
+    if name == 'values':
+        fcode = 'q'
+        _, offset, nbytes = header['values']
+    else:
+        _, fcode, offset, nbytes = [field for field in header['fields']
+                                    if field[0] == name][0]
+    if name == 'child_ptr':
+        # The last entry is replaced by the next subtree
+        nbytes -= array(fcode).itemsize
+
+    with open(subtree, 'rb') as sub:
+        _, start = _read_flat_header(sub)
+        sub.seek(start + offset)
+        step = chunk_size * array(fcode).itemsize
+        while nbytes > 0:
+            chunk = array(fcode)
+            chunk.frombytes(sub.read(min(step, nbytes)))
+            nbytes -= step
+            if shift:
+                chunk = array(fcode, [x + shift for x in chunk])
+            chunk.tofile(f)
+
+
+def _shard_worker(conn, name, header, fields):
+    """Answer leaf queries on a shared-memory shard until sent None"""
+    memory = shared_memory.SharedMemory(name=name)
+    compiled = CompiledAABBTree._from_buffer(header, memory.buf, fields,
+                                             None)
+    compiled.values = range(len(compiled.leaf_lowers) // compiled.n_dim)
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            limits, closed = message
+            conn.send([compiled._overlap_leaves(AABB(lims), closed)
+                       for lims in limits])
+    finally:
+        compiled._release()
+        memory.close()
+        conn.close()
+
+
+def _median_sides(aabbs):
+    """Median side length of AABBs along each axis, for cell sizes"""
+    sizes = []
+    for sides in zip(*[[ub - lb for lb, ub in box.limits] for box in aabbs]):
+        positive = sorted(side for side in sides if side > 0)
+        sizes.append(positive[len(positive) // 2] if positive else 1)
+    return sizes
+
+
+def _resolve_batch(batch, done):
+    """Hand each caller in a batch its own slice of the results"""
+    futures = [future for _, future in batch]
+    if done.cancelled() or done.exception() is not None:
+        for future in futures:
+            if not future.done():
+                if done.cancelled():
+                    future.cancel()
+                else:
+                    future.set_exception(done.exception())
+        return
+
+    for future, values in zip(futures, done.result()):
+        if not future.done():
+            future.set_result(values)
+
+
+def overlaps_many(box, lows, highs, closed=False):
+    """Determine if an AABB overlaps many boxes
+
+    The boxes are given as two (n, d) arrays, such as lists of lists or
+    NumPy arrays, with row ``k`` of *lows* and *highs* holding the lower and
+    upper bounds of box ``k``.
+    The result matches :meth:`AABB.overlaps` for each box.
+
+    *New in version 2.9.0*
+
+    Args:
+        box (AABB): The AABB to check for overlap
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+        closed (bool): Flag for closed overlap between AABBs.
+            Defaults to False.
+
+    Returns:
+        list: Flags set to true for each box that overlaps the AABB
+    """
+    n_boxes = len(lows)
+    if n_boxes == 0:
+        return []
+    if box.limits is None:
+        return n_boxes * [False]
+
+    mask = n_boxes * [True]
+    for (lower, upper), lbs, ubs in zip(box.limits, zip(*lows), zip(*highs)):
+        if closed:
+            mask = [m and lb <= upper and lower <= ub
+                    for m, lb, ub in zip(mask, lbs, ubs)]
+        else:
+            mask = [m and lb < upper and lower < ub
+                    for m, lb, ub in zip(mask, lbs, ubs)]
+    return mask
+
+
+def overlap_volume_many(box, lows, highs):
+    """Determine volume of overlap between an AABB and many boxes
+
+    The result matches :meth:`AABB.overlap_volume` for each box.
+
+    *New in version 2.9.0*
+
+    Args:
+        box (AABB): The AABB to calculate for overlap volume
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+
+    Returns:
+        list: Volume of overlap with each box
+    """
+    volumes = len(lows) * [1]
+    if len(lows) == 0:
+        return volumes
+
+    for (lower, upper), lbs, ubs in zip(box.limits, zip(*lows), zip(*highs)):
+        volumes = [v * max(min(upper, ub) - max(lower, lb), 0)
+                   for v, lb, ub in zip(volumes, lbs, ubs)]
+    return volumes
+
+
+def distance_many(box, lows, highs, metric='euclidean'):
+    """Determine distance between an AABB and many boxes
+
+    The result matches :meth:`AABB.distance` for each box.
+
+    *New in version 2.9.0*
+
+    Args:
+        box (AABB): The AABB to calculate distance to
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+        metric (str): {'euclidean'|'chebyshev'} Distance metric.
+            Defaults to 'euclidean'.
+
+    Returns:
+        list: Distance to each box
+    """
+    _check_metric(metric)
+    dists = len(lows) * [0]
+    if len(lows) == 0:
+        return dists
+
+    chebyshev = metric == 'chebyshev'
+    for (lower, upper), lbs, ubs in zip(box.limits, zip(*lows), zip(*highs)):
+        gaps = [max(lb - upper, lower - ub, 0) for lb, ub in zip(lbs, ubs)]
+        if chebyshev:
+            dists = [max(d, gap) for d, gap in zip(dists, gaps)]
+        else:
+            dists = [d + gap * gap for d, gap in zip(dists, gaps)]
+    if chebyshev:
+        return dists
+    return [math.sqrt(d) for d in dists]
+
+
+def merge_many(lows, highs):
+    """Merge many boxes
+
+    Find the AABB of the union of the boxes.
+
+    *New in version 2.9.0*
+
+    Args:
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+
+    Returns:
+        AABB: An AABB that contains all of the boxes
+    """
+    if len(lows) == 0:
+        return AABB()
+    return AABB([(min(lbs), max(ubs))
+                 for lbs, ubs in zip(zip(*lows), zip(*highs))])
+
+
+def volume_many(lows, highs):
+    """Volumes of many boxes
+
+    *New in version 2.9.0*
+
+    Args:
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+
+    Returns:
+        list: Volume of each box
+    """
+    volumes = len(lows) * [1]
+    for lbs, ubs in zip(zip(*lows), zip(*highs)):
+        volumes = [v * (ub - lb) for v, lb, ub in zip(volumes, lbs, ubs)]
+    return volumes
+
+
+def perimeter_many(lows, highs):
+    """Perimeters of many boxes
+
+    The result matches :attr:`AABB.perimeter` for each box.
+
+    *New in version 2.9.0*
+
+    Args:
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+
+    Returns:
+        list: Perimeter of each box
+    """
+    n_boxes = len(lows)
+    sides = [[ub - lb for lb, ub in zip(lbs, ubs)]
+             for lbs, ubs in zip(zip(*lows), zip(*highs))]
+    if len(sides) < 2:
+        return n_boxes * [0]
+
+    suffixes = [n_boxes * [1]]
+    for col in reversed(sides[1:]):
+        suffixes.append([s * c for s, c in zip(suffixes[-1], col)])
+    suffixes.reverse()
+
+    perims = n_boxes * [0]
+    prefix = n_boxes * [1]
+    for col, suffix in zip(sides, suffixes):
+        perims = [p + a * b for p, a, b in zip(perims, prefix, suffix)]
+        prefix = [a * c for a, c in zip(prefix, col)]
+    return [2 * p for p in perims]
+
+
+def corners_many(lows, highs):
+    """Corner points of many boxes
+
+    The result matches :attr:`AABB.corners` for each box.
+
+    *New in version 2.9.0*
+
+    Args:
+        lows (iterable): (n, d) lower bounds of the boxes
+        highs (iterable): (n, d) upper bounds of the boxes
+
+    Returns:
+        list: For each box, the list of its 2^d corner points
+    """
+    return [[list(corner) for corner in itertools.product(*zip(lbs, ubs))]
+            for lbs, ubs in zip(lows, highs)]
+
+
+# Arrays of a CompiledAABBTree
+_COMPILED_ARRAYS = ('child_ptr', 'child_idx', 'child_lowers', 'child_uppers',
+                    'leaf_start', 'leaf_stop', 'leaf_lowers', 'leaf_uppers')
+
+# Arrays of a CompiledAABBTree holding node, slot, or leaf numbers
+_INDEX_ARRAYS = ('child_ptr', 'child_idx', 'leaf_start', 'leaf_stop')
+
+# Built-in reductions of AABBTree.add_aggregate
+_REDUCTIONS = {'sum': operator.add, 'min': min, 'max': max,
+               'count': operator.add}
+
+# First bytes of a CompiledAABBTree flat file
+_FLAT_MAGIC = b'AABBTREE'
+
+# Subtrees with fewer than this many AABBs per added AABB are rebuilt
+_REBUILD_RATIO = 1
+
+# Levels of each tree replaced when merging trees
+_GRAFT_DEPTH = 3
+
+
+def _check_metric(metric):
+    if metric not in ('euclidean', 'chebyshev'):
+        e_str = "metric should be 'euclidean' or 'chebyshev', not "
+        e_str += str(metric)
+        raise ValueError(e_str)
+
+
+def _as_aabb(aabb):
+    """AABB of an AABB or a point"""
+    if isinstance(aabb, AABB):
+        return aabb
+    return AABB([(x, x) for x in aabb])
+
+
+def _merge(lims1, lims2):
+    lower = min(lims1[0], lims2[0])
+    upper = max(lims1[1], lims2[1])
+
+    return (lower, upper)
+
+
+def _leaf_entries(node):
+    """(AABB, value) pairs stored in a leaf"""
+    if node.bucket is not None:
+        return node.bucket
+    if node.aabb == AABB():
+        return []
+    return [(node.aabb, node.value)]
+
+
+def _fill_bucket(node, entries):
+    """Set the contents of a bucket leaf"""
+    node.bucket = list(entries)
+    node._lows = [[lb for lb, _ in box.limits] for box, _ in entries]
+    node._highs = [[ub for _, ub in box.limits] for box, _ in entries]
+    node.aabb = merge_many(node._lows, node._highs)
+    node.value = None
+
+
+def _centers(entries):
+    """Centers of the AABBs in (AABB, value) pairs"""
+    return [[0.5 * (lb + ub) for lb, ub in box.limits] for box, _ in entries]
+
+
+def _median_split(centers, half=None):
+    """Indices of the centers below and above the median
+
+    The median is along the axis where the centers spread most. Setting
+    *half* puts that many centers below the split instead.
+    """
+    spreads = [max(c) - min(c) for c in zip(*centers)]
+    axis = spreads.index(max(spreads))
+    keys = [center[axis] for center in centers]
+    order = sorted(range(len(centers)), key=keys.__getitem__)
+    if half is None:
+        half = len(centers) // 2
+    return order[:half], order[half:]
+
+
+def _split_entries(entries):
+    """Split (AABB, value) pairs at the median of their centers"""
+    left, right = _median_split(_centers(entries))
+    return [entries[k] for k in left], [entries[k] for k in right]
+
+
+def _build(entries, leaf_size, centers=None):
+    """Build a tree top-down from (AABB, value) pairs"""
+    if len(entries) <= leaf_size:
+        if leaf_size > 1:
+            tree = AABBTree(leaf_size=leaf_size)
+            _fill_bucket(tree, entries)
+            return tree
+        if len(entries) == 0:
+            return AABBTree()
+        return AABBTree(*entries[0])
+
+    if centers is None:
+        centers = _centers(entries)
+    left_idx, right_idx = _median_split(centers)
+    left = _build([entries[k] for k in left_idx], leaf_size,
+                  [centers[k] for k in left_idx])
+    right = _build([entries[k] for k in right_idx], leaf_size,
+                   [centers[k] for k in right_idx])
+    return AABBTree(AABB.merge(left.aabb, right.aabb), left=left, right=right,
+                    leaf_size=leaf_size)
+
+
+def _graft(subtrees, centers):
+    """Join subtrees with new branches, split at the median of centers"""
+    if len(subtrees) == 1:
+        return subtrees[0]
+    left_idx, right_idx = _median_split(centers)
+    left = _graft([subtrees[k] for k in left_idx],
+                  [centers[k] for k in left_idx])
+    right = _graft([subtrees[k] for k in right_idx],
+                   [centers[k] for k in right_idx])
+    return AABBTree(AABB.merge(left.aabb, right.aabb), left=left, right=right,
+                    leaf_size=left.leaf_size)
+
+
+def _insertion_costs(node, aabb, method):
+    """Costs to add an AABB to a branch: new parent, left, and right"""
+    if method != 'volume':
+        raise ValueError('Unrecognized method: ' + str(method))
+
+    # Define merged AABBs
+    branch_merge = AABB.merge(node.aabb, aabb)
+    left_merge = AABB.merge(node.left.aabb, aabb)
+    right_merge = AABB.merge(node.right.aabb, aabb)
+
+    # Calculate the change in the sum of the bounding volumes
+    branch_cost = branch_merge.volume
+
+    left_cost = branch_merge.volume - node.aabb.volume
+    left_cost += left_merge.volume - node.left.aabb.volume
+
+    right_cost = branch_merge.volume - node.aabb.volume
+    right_cost += right_merge.volume - node.right.aabb.volume
+
+    # Calculate amount of overlap
+    branch_olap_cost = node.aabb.overlap_volume(aabb)
+    left_olap_cost = left_merge.overlap_volume(node.right.aabb)
+    right_olap_cost = right_merge.overlap_volume(node.left.aabb)
+
+    # Calculate total cost
+    branch_cost += branch_olap_cost
+    left_cost += left_olap_cost
+    right_cost += right_olap_cost
+    return branch_cost, left_cost, right_cost
+
+
+def _insertion_costs_many(node, entries):
+    """Volume costs of :func:`_insertion_costs` for many AABBs
+
+    Returns:
+        list: (branch, left, right) costs of each (AABB, value) pair.
+    """
+    p_lims = node.aabb.limits
+    l_lims = node.left.aabb.limits
+    r_lims = node.right.aabb.limits
+    p_vol = node.aabb.volume
+    l_vol = node.left.aabb.volume
+    r_vol = node.right.aabb.volume
+
+    costs = []
+    for box, _ in entries:
+        bm_vol = 1
+        lm_vol = 1
+        rm_vol = 1
+        b_olap = 1
+        l_olap = 1
+        r_olap = 1
+        for (lower, upper), (p_lo, p_hi), (l_lo, l_hi), (r_lo, r_hi) in \
+                zip(box.limits, p_lims, l_lims, r_lims):
+            # Conditional expressions are faster than min and max here
+            lm_lo = l_lo if l_lo < lower else lower
+            lm_hi = l_hi if l_hi > upper else upper
+            rm_lo = r_lo if r_lo < lower else lower
+            rm_hi = r_hi if r_hi > upper else upper
+            bm_vol *= ((p_hi if p_hi > upper else upper) -
+                       (p_lo if p_lo < lower else lower))
+            lm_vol *= lm_hi - lm_lo
+            rm_vol *= rm_hi - rm_lo
+            if b_olap:
+                width = ((p_hi if p_hi < upper else upper) -
+                         (p_lo if p_lo > lower else lower))
+                b_olap = b_olap * width if width > 0 else 0
+            if l_olap:
+                width = ((lm_hi if lm_hi < r_hi else r_hi) -
+                         (lm_lo if lm_lo > r_lo else r_lo))
+                l_olap = l_olap * width if width > 0 else 0
+            if r_olap:
+                width = ((rm_hi if rm_hi < l_hi else l_hi) -
+                         (rm_lo if rm_lo > l_lo else l_lo))
+                r_olap = r_olap * width if width > 0 else 0
+
+        branch_cost = bm_vol + b_olap
+        left_cost = bm_vol - p_vol + lm_vol - l_vol + l_olap
+        right_cost = bm_vol - p_vol + rm_vol - r_vol + r_olap
+        costs.append((branch_cost, left_cost, right_cost))
+    return costs
+
+
+def _add_entries(node, entries):
+    """Add (AABB, value) pairs to a tree in place, descending together"""
+    if not entries:
+        return
+    node._aggregates = None
+    if node.is_leaf or _size_below(node, _REBUILD_RATIO * len(entries)):
+        new = _build(_subtree_entries(node) + entries, node.leaf_size)
+        _replace_node(node, new)
+        return
+
+    new_entries = []
+    left_entries = []
+    right_entries = []
+    for entry, (branch_cost, left_cost, right_cost) in \
+            zip(entries, _insertion_costs_many(node, entries)):
+        if branch_cost < left_cost and branch_cost < right_cost:
+            new_entries.append(entry)
+        elif left_cost < right_cost:
+            left_entries.append(entry)
+        else:
+            right_entries.append(entry)
+
+    _add_entries(node.left, left_entries)
+    _add_entries(node.right, right_entries)
+    node.aabb = AABB.merge(node.left.aabb, node.right.aabb)
+    if new_entries:
+        old = AABBTree(node.aabb, left=node.left, right=node.right,
+                       leaf_size=node.leaf_size)
+        node.left = old
+        node.right = _build(new_entries, node.leaf_size)
+        node.aabb = AABB.merge(old.aabb, node.right.aabb)
+
+
+def _size_below(tree, n):
+    """Check if a tree has fewer than *n* AABBs, visiting at most *n* nodes"""
+    if tree.is_leaf:
+        return len(_leaf_entries(tree)) < n
+
+    # Below the root, each leaf holds one AABB or a non-empty bucket
+    size = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.left is None and node.right is None:
+            size += 1 if node.bucket is None else len(node.bucket)
+            if size >= n:
+                return False
+        else:
+            stack.append(node.left)
+            stack.append(node.right)
+    return True
+
+
+def _nodes_below(tree, n):
+    """Check if a tree has fewer than *n* nodes, visiting at most *n* nodes"""
+    size = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        size += 1
+        if size >= n:
+            return False
+        if not node.is_leaf:
+            stack.extend((node.left, node.right))
+    return True
+
+
+def _path_copy_add(node, aabb, value, method):
+    """Add an AABB without modifying the tree
+
+    The nodes along the insertion path are copied and all other subtrees
+    are shared with the input tree.
+
+    Returns:
+        AABBTree: The root of the new tree.
+    """
+    leaf_size = node.leaf_size
+    if node.bucket is not None:
+        entries = node.bucket + [(aabb, value)]
+        if len(entries) <= leaf_size:
+            return _build(entries, leaf_size)
+        left_entries, right_entries = _split_entries(entries)
+        left = _build(left_entries, leaf_size)
+        right = _build(right_entries, leaf_size)
+
+    elif node.aabb == AABB():
+        return AABBTree(aabb, value)
+
+    elif node.is_leaf:
+        left = node
+        right = AABBTree(aabb, value)
+
+    else:
+        branch_cost, left_cost, right_cost = _insertion_costs(node, aabb,
+                                                              method)
+        if branch_cost < left_cost and branch_cost < right_cost:
+            left = node
+            right = AABBTree(aabb, value, leaf_size=leaf_size)
+        elif left_cost < right_cost:
+            left = _path_copy_add(node.left, aabb, value, method)
+            right = node.right
+        else:
+            left = node.left
+            right = _path_copy_add(node.right, aabb, value, method)
+
+    return AABBTree(AABB.merge(left.aabb, right.aabb), left=left, right=right,
+                    leaf_size=leaf_size)
+
+
+def _subtree_entries(tree):
+    """(AABB, value) pairs in all of the leaves of a tree"""
+    entries = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf:
+            entries.extend(_leaf_entries(node))
+        else:
+            stack.extend((node.right, node.left))
+    return entries
+
+
+def _replace_node(node, new):
+    """Overwrite a node in place with the contents of another"""
+    node.aabb = new.aabb
+    node.value = new.value
+    node.left = new.left
+    node.right = new.right
+    node.bucket = new.bucket
+    node._lows = new._lows
+    node._highs = new._highs
+    node._aggregates = new._aggregates
+
+
+def _overlap_fraction(node):
+    """Fraction of the volume of a branch where its children overlap"""
+    volume = node.aabb.volume
+    if volume <= 0:
+        return 0
+    return node.left.aabb.overlap_volume(node.right.aabb) / volume
+
+
+def _scan_branches(tree, max_nodes, path=None, deadline=None):
+    """Find the branches of a tree to consider rebuilding
+
+    The tree is scanned in preorder, one subtree of at most *max_nodes*
+    nodes at a time, starting from the subtree at *path*. The scan stops
+    after the subtree before *path*, or once ``time.perf_counter()`` passes
+    *deadline*, though at least one subtree is scanned.
+
+    Args:
+        tree (AABBTree): The tree to scan.
+        max_nodes (int): The maximum number of nodes in a scanned subtree.
+        path (list, optional): Directions from the root to the subtree to
+            start from, 0 for left and 1 for right. Defaults to None, for
+            the root.
+        deadline (float, optional): Time to stop the scan by.
+
+    Returns:
+        tuple: (-score, index, size, node) for each scanned branch whose
+        children overlap, where the index counts the scanned nodes in
+        preorder, and the path to resume the scan from.
+    """
+    trail = []
+    node = tree
+    for direction in path or []:
+        if node.is_leaf:
+            break
+        trail.append((node, direction))
+        node = node.right if direction else node.left
+    # Back up to the largest subtree on the path that fits in one scan
+    while trail and _nodes_below(trail[-1][0], max_nodes + 1):
+        node = trail.pop()[0]
+    start = [direction for _, direction in trail]
+
+    candidates = []
+    n_scanned = 0
+    wrapped = False
+    while True:
+        here = [direction for _, direction in trail]
+        if n_scanned and deadline is not None and \
+                time.perf_counter() >= deadline:
+            return candidates, here
+        if wrapped and here >= start:
+            return candidates, start
+
+        if not node.is_leaf and not _nodes_below(node, max_nodes + 1):
+            trail.append((node, 0))
+            node = node.left
+            continue
+        found = _branch_candidates(node, n_scanned)
+        n_scanned += found[1]
+        candidates.extend(found[0])
+
+        # Move to the next subtree in preorder
+        while trail and trail[-1][1] == 1:
+            trail.pop()
+        if trail:
+            parent, _ = trail.pop()
+            trail.append((parent, 1))
+            node = parent.right
+        elif start and not wrapped:
+            wrapped = True
+            node = tree
+        else:
+            return candidates, None
+
+
+def _branch_candidates(tree, first):
+    """Branches of a subtree whose children overlap
+
+    Returns:
+        tuple: List of (-score, index, size, node) for the branches, where
+        indices count the nodes in preorder from *first*, and the number of
+        nodes in the subtree.
+    """
+    # Preorder walk, then subtree sizes from the bottom up
+    preorder = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        preorder.append(node)
+        if not node.is_leaf:
+            stack.extend((node.right, node.left))
+    sizes = {}
+    for node in reversed(preorder):
+        if node.is_leaf:
+            sizes[id(node)] = 1
+        else:
+            sizes[id(node)] = (1 + sizes[id(node.left)] +
+                               sizes[id(node.right)])
+
+    candidates = []
+    for i, node in enumerate(preorder):
+        if node.is_leaf:
+            continue
+        score = _overlap_fraction(node)
+        if score > 0:
+            candidates.append((-score, first + i, sizes[id(node)], node))
+    return candidates, len(preorder)
+
+
+def _subtree_cost(tree):
+    """Sum of branch volumes and child overlap volumes in a tree"""
+    cost = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if not node.is_leaf:
+            cost += node.aabb.volume
+            cost += node.left.aabb.overlap_volume(node.right.aabb)
+            stack.extend((node.left, node.right))
+    return cost
+
+
+def _batch_leaves(tree, aabbs, test):
+    """Leaves reached by a batch of queries in one traversal
+
+    A query reaches the children of a node if ``test(node.aabb, query)`` is
+    true.
+
+    Yields:
+        tuple: A leaf and the indices of the queries that reach it.
+    """
+    stack = [(tree, range(len(aabbs)))]
+    while stack:
+        node, active = stack.pop()
+        active = [q for q in active if test(node.aabb, aabbs[q])]
+        if not active:
+            continue
+        if node.is_leaf:
+            yield node, active
+        else:
+            stack.append((node.right, active))
+            stack.append((node.left, active))
+
+
+def _halfspace_planes(aabb, normals, offsets, active):
+    """Planes that an AABB straddles
+
+    Returns:
+        list: Indices in *active* of the planes that the AABB crosses, or
+        None if the AABB is outside any of them.
+    """
+    straddled = []
+    for k in active:
+        low = 0
+        high = 0
+        for n, (lb, ub) in zip(normals[k], aabb.limits):
+            if n >= 0:
+                low += n * lb
+                high += n * ub
+            else:
+                low += n * ub
+                high += n * lb
+        if low > offsets[k]:
+            return None
+        if high > offsets[k]:
+            straddled.append(k)
+    return straddled
+
+
+def _leaf_pairs(s_node, t_node, closed):
+    """(AABB, value) pairs of leaf *s_node* that overlap leaf *t_node*
+
+    The bounds of the two leaves are known to overlap.
+    """
+    if s_node.bucket is None and t_node.bucket is None:
+        return [(s_node.aabb, s_node.value)]
+
+    entries = _leaf_entries(s_node)
+    if s_node.bucket is None:
+        lows = [[lb for lb, _ in s_node.aabb.limits]]
+        highs = [[ub for _, ub in s_node.aabb.limits]]
+    else:
+        lows = s_node._lows
+        highs = s_node._highs
+
+    pairs = []
+    for box, _ in _leaf_entries(t_node):
+        hits = overlaps_many(box, lows, highs, closed)
+        pairs.extend(entry for entry, hit in zip(entries, hits) if hit)
+    return pairs
+
+
+def _morton_code(aabb, lower, upper, bits=10):
+    """Morton (Z-order) code of the center of an AABB
+
+    The center is quantized to *bits* bits per dimension within the box
+    given by *lower* and *upper*, then the bits are interleaved.
+    """
+    cells = []
+    n_cells = 1 << bits
+    for (lb, ub), low, high in zip(aabb.limits, lower, upper):
+        span = high - low
+        frac = (0.5 * (lb + ub) - low) / span if span > 0 else 0
+        cells.append(min(max(int(frac * n_cells), 0), n_cells - 1))
+
+    code = 0
+    for bit in range(bits - 1, -1, -1):
+        for cell in cells:
+            code = (code << 1) | ((cell >> bit) & 1)
+    return code
+
+
+def _veb_order(root, kids):
+    """Nodes of a tree in van Emde Boas order
+
+    The tree is cut at half its height. The top half is laid out first,
+    followed by each of the subtrees hanging below it, recursively.
+    """
+    heights = {}
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        branches = kids[id(node)]
+        if visited or not branches:
+            heights[id(node)] = 1 + max([heights[id(b)] for b in branches],
+                                        default=0)
+        else:
+            stack.append((node, True))
+            stack.extend((b, False) for b in branches)
+
+    order = []
+
+    def layout(node, n_levels):
+        if n_levels == 1:
+            order.append(node)
+            return
+        n_top = n_levels // 2
+        layout(node, n_top)
+        level = [node]
+        for _ in range(n_top):
+            level = [b for n in level for b in kids[id(n)]]
+        for sub in level:
+            layout(sub, n_levels - n_top)
+
+    layout(root, heights[id(root)])
+    return order
+
+
+_DTYPES = {'float32': 'f', 'float64': 'd', 'int32': 'i', 'int64': 'q'}
+
+
+def _caster(code):
+    """Function converting a coordinate to an array type"""
+    if code == 'd':
+        return float
+    if code == 'f':
+        return lambda x: array('f', [x])[0]
+
+    def cast(x):
+        if x != int(x):
+            raise ValueError('Coordinate is not an integer: ' + str(x))
+        return int(x)
+    return cast
+
+
+def _quantize(lower, upper, low, high, n_max):
+    """Integer offsets of (lower, upper) within (low, high), rounded outward"""
+    step = (high - low) / n_max
+    if step <= 0:
+        return 0, 0
+
+    q_lo = min(max(int(math.floor((lower - low) / step)), 0), n_max)
+    while q_lo > 0 and _dequantize(q_lo, low, high, step, n_max) > lower:
+        q_lo -= 1
+    q_hi = min(max(int(math.ceil((upper - low) / step)), 0), n_max)
+    while q_hi < n_max and _dequantize(q_hi, low, high, step, n_max) < upper:
+        q_hi += 1
+    return q_lo, q_hi
+
+
+def _dequantize(q, low, high, step, n_max):
+    """Value of an integer offset within (low, high)"""
+    if q == n_max:
+        return high
+    return low + q * step
+
+
+def _wide_branches(node, arity):
+    """Children of a wide node, collapsed from a binary tree"""
+    branches = [node.left, node.right]
+    while len(branches) < arity:
+        inner = [i for i, b in enumerate(branches) if not b.is_leaf]
+        if not inner:
+            break
+        i = max(inner, key=lambda j: branches[j].aabb.volume)
+        branches[i:i + 1] = [branches[i].left, branches[i].right]
+    return branches
+
+
+def _block_overlaps(lowers, uppers, first, last, n_dim, limits, closed):
+    """Slots in a block of flat-array boxes that overlap AABB limits
+
+    Each dimension is tested for the whole block at once, using strided
+    slices of the arrays.
+    """
+    mask = [True] * (last - first)
+    for i, (lower, upper) in enumerate(limits):
+        lows = lowers[first * n_dim + i:last * n_dim:n_dim]
+        highs = uppers[first * n_dim + i:last * n_dim:n_dim]
+        if closed:
+            mask = [m and lo <= upper and lower <= hi
+                    for m, lo, hi in zip(mask, lows, highs)]
+        else:
+            mask = [m and lo < upper and lower < hi
+                    for m, lo, hi in zip(mask, lows, highs)]
+        if not any(mask):
+            return []
+    return [first + k for k, m in enumerate(mask) if m]
+
+
+def _covers_bounds(limits, bounds, closed):
+    """Check if AABB limits cover (lowers, uppers) bounds
+
+    For open overlap, the bounds must be strictly inside the limits, so
+    that every box within the bounds overlaps the limits.
+    """
+    for (lower, upper), low, high in zip(limits, *bounds):
+        if closed:
+            if low < lower or high > upper:
+                return False
+        elif low <= lower or high >= upper:
+            return False
+    return True
+
+
+def _flat_overlaps(lowers, uppers, offset, limits, closed):
+    """Overlap test between a box in flat arrays and AABB limits"""
+    for i, (lower, upper) in enumerate(limits):
+        if closed:
+            if lowers[offset + i] > upper or lower > uppers[offset + i]:
+                return False
+        elif lowers[offset + i] >= upper or lower >= uppers[offset + i]:
+            return False
+    return True
+
+
+def _overlap_pairs(in_tree, aabb, method='DFS', halt=False, closed=False, 
+                   unique=True, limit=None, where=None):
+    """Get overlapping AABBs and values in (AABB, value) pairs
+
+    *New  in version 2.6.0*
+
+    This function gets each overlapping AABB and its value.
+    When an AABB covers a node of the tree, every AABB below that node is
+    added without further tests.
+
+    Args:
+        in_tree: The AABBTree to compare with.
+        aabb (AABB or AABBTree): The AABB or AABBTree to check.
+        method (str): {'DFS'|'BFS'} Method for traversing the tree.
+            Setting 'DFS' performs a depth-first search and 'BFS' performs
+            a breadth-first search. Defaults to 'DFS'.
+        halt (bool): Return the list immediately once a pair has been
+            added.
+        closed (bool): Check for closed box intersection. Defaults to False.
+        unique (bool): Return only unique pairs. Defaults to True.
+        limit (int): Maximum number of pairs. Defaults to None.
+        where (dict): Attribute conditions. Defaults to None.
+
+    Returns:
+        list: (AABB, value) pairs in AABBTree that overlap with the input.
+    """
+    if limit is not None or where is not None:
+        pairs = _iter_pairs(in_tree, aabb, method, closed,
+                            _prepare_where(in_tree, where))
+        if unique:
+            pairs = _iter_unique(pairs)
+        return list(itertools.islice(pairs, limit))
+
+    if isinstance(aabb, AABB):
+        tree = AABBTree(aabb=aabb)
+    else:
+        tree = aabb
+
+    if method == 'DFS':
+        pairs = _overlap_dfs(in_tree, tree, halt, closed)
+
+    elif method == 'BFS':
+        pairs = _overlap_bfs(in_tree, tree, halt, closed)
+    else:
+        e_str = "method should be 'DFS' or 'BFS', not " + str(method)
+        raise ValueError(e_str)
+
+    if len(pairs) < 2 or not unique:
+        return pairs
+    return _unique_pairs(pairs)
+
+
+def _iter_pairs(in_tree, aabb, method, closed, conditions=None):
+    """Lazily generate overlapping (AABB, value) pairs
+
+    The pairs come in the same order as :func:`_overlap_dfs` or
+    :func:`_overlap_bfs`, depending on *method*.
+    Nodes of *in_tree* that cannot meet the *conditions* from
+    :func:`_prepare_where` are skipped.
+    """
+    if method not in ('DFS', 'BFS'):
+        e_str = "method should be 'DFS' or 'BFS', not " + str(method)
+        raise ValueError(e_str)
+    if isinstance(aabb, AABB):
+        tree = AABBTree(aabb=aabb)
+    else:
+        tree = aabb
+
+    depth_first = method == 'DFS'
+    queue = deque([(in_tree, tree)])
+    while queue:
+        s_node, t_node = queue.pop() if depth_first else queue.popleft()
+        if not s_node.aabb.overlaps(t_node.aabb, closed):
+            continue
+        if conditions and not _node_meets(s_node, conditions):
+            continue
+        if s_node.is_leaf and t_node.is_leaf:
+            for pair in _leaf_pairs(s_node, t_node, closed):
+                if s_node.bucket is None or not conditions or \
+                        _value_meets(pair[1], conditions):
+                    yield pair
+            continue
+        if _covers_subtree(t_node, s_node, closed):
+            if conditions:
+                entries = _matching_entries(s_node, conditions)
+            else:
+                entries = _subtree_entries(s_node)
+            for pair in entries:
+                yield pair
+            continue
+
+        s_branches = [s_node] if s_node.is_leaf else [s_node.left,
+                                                      s_node.right]
+        t_branches = [t_node] if t_node.is_leaf else [t_node.left,
+                                                      t_node.right]
+        pairs = [(s, t) for s in s_branches for t in t_branches]
+        queue.extend(reversed(pairs) if depth_first else pairs)
+
+
+def _count_pairs(in_tree, aabb, closed, conditions=None):
+    """Number of pairs from :func:`_iter_pairs`, without building them
+
+    The AABBs below a node covered by the input are counted with a walk
+    of the node instead of being listed.
+    """
+    if isinstance(aabb, AABB):
+        tree = AABBTree(aabb=aabb)
+    else:
+        tree = aabb
+
+    count = 0
+    stack = [(in_tree, tree)]
+    while stack:
+        s_node, t_node = stack.pop()
+        if not s_node.aabb.overlaps(t_node.aabb, closed):
+            continue
+        if conditions and not _node_meets(s_node, conditions):
+            continue
+        if s_node.is_leaf and t_node.is_leaf:
+            count += _count_leaf_pairs(s_node, t_node, closed, conditions)
+            continue
+        if _covers_subtree(t_node, s_node, closed):
+            count += _count_entries(s_node, conditions)
+            continue
+
+        s_branches = [s_node] if s_node.is_leaf else [s_node.left,
+                                                      s_node.right]
+        t_branches = [t_node] if t_node.is_leaf else [t_node.left,
+                                                      t_node.right]
+        stack.extend((s, t) for s in s_branches for t in t_branches)
+    return count
+
+
+def _count_leaf_pairs(s_node, t_node, closed, conditions=None):
+    """Number of pairs from :func:`_leaf_pairs` that meet the conditions"""
+    if s_node.bucket is None and t_node.bucket is None:
+        return 1
+
+    if s_node.bucket is None:
+        entries = [(s_node.aabb, s_node.value)]
+        lows = [[lb for lb, _ in s_node.aabb.limits]]
+        highs = [[ub for _, ub in s_node.aabb.limits]]
+    else:
+        entries = s_node.bucket
+        lows = s_node._lows
+        highs = s_node._highs
+    check = s_node.bucket is not None and conditions
+
+    count = 0
+    for box, _ in _leaf_entries(t_node):
+        hits = overlaps_many(box, lows, highs, closed)
+        if check:
+            count += sum(1 for (_, value), hit in zip(entries, hits)
+                         if hit and _value_meets(value, conditions))
+        else:
+            count += sum(hits)
+    return count
+
+
+def _count_entries(tree, conditions=None):
+    """Number of AABBs below a node that meet every condition"""
+    count = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if conditions and not _node_meets(node, conditions):
+            continue
+        if not node.is_leaf:
+            stack.extend((node.left, node.right))
+        elif node.bucket is None:
+            if node.aabb.limits is not None:
+                count += 1
+        elif conditions:
+            count += sum(1 for _, value in node.bucket
+                         if _value_meets(value, conditions))
+        else:
+            count += len(node.bucket)
+    return count
+
+
+def _prepare_where(tree, where):
+    """List of (name, func, kind, condition) for a *where* filter"""
+    if where is None:
+        return None
+    conditions = []
+    for name, condition in where.items():
+        if name not in tree.attributes:
+            raise ValueError('Unknown attribute: ' + str(name))
+        func, kind = tree.attributes[name]
+        if kind == 'range':
+            lower, upper = condition
+            condition = (lower, upper)
+            combine = _span
+            func = _pair_of(func)
+        else:
+            combine = operator.or_
+        conditions.append((('attribute', name), func, combine, kind,
+                           condition))
+    return conditions
+
+
+def _meets(aggregate, kind, condition):
+    """Check if an attribute aggregate may meet a condition"""
+    if aggregate is None:
+        return False
+    if kind == 'mask':
+        return (aggregate & condition) != 0
+    return aggregate[0] <= condition[1] and condition[0] <= aggregate[1]
+
+
+def _node_meets(node, conditions):
+    """Check if any value below a node may meet every condition"""
+    for key, func, combine, kind, condition in conditions:
+        aggregate = _node_aggregate(node, key, func, combine)
+        if not _meets(aggregate, kind, condition):
+            return False
+    return True
+
+
+def _value_meets(value, conditions):
+    """Check if a value meets every condition"""
+    for _, func, _, kind, condition in conditions:
+        if not _meets(func(value), kind, condition):
+            return False
+    return True
+
+
+def _matching_entries(tree, conditions):
+    """(AABB, value) pairs below a node that meet every condition"""
+    entries = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if not _node_meets(node, conditions):
+            continue
+        if node.is_leaf:
+            entries.extend(entry for entry in _leaf_entries(node)
+                           if node.bucket is None or
+                           _value_meets(entry[1], conditions))
+        else:
+            stack.extend((node.right, node.left))
+    return entries
+
+
+def _node_aggregate(tree, key, func, combine):
+    """Reduction of ``func(value)`` over the values below a node
+
+    Reductions are kept in the *_aggregates* dictionary of each node under
+    *key* and found from the bottom up where missing. The dictionary is
+    made when a node keeps its first reduction.
+    """
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node._aggregates is None:
+            node._aggregates = {}
+        elif key in node._aggregates:
+            continue
+        if node.is_leaf:
+            aggregate = None
+            for _, value in _leaf_entries(node):
+                aggregate = _combine(aggregate, func(value), combine)
+            node._aggregates[key] = aggregate
+        elif expanded:
+            node._aggregates[key] = _combine(node.left._aggregates[key],
+                                             node.right._aggregates[key],
+                                             combine)
+        else:
+            stack.extend(((node, True), (node.left, False),
+                          (node.right, False)))
+    return tree._aggregates[key]
+
+
+def _combine(aggregate1, aggregate2, combine):
+    """Combine two reductions, where None is empty"""
+    if aggregate1 is None:
+        return aggregate2
+    if aggregate2 is None:
+        return aggregate1
+    return combine(aggregate1, aggregate2)
+
+
+def _span(range1, range2):
+    """Smallest (min, max) range containing two ranges"""
+    return (min(range1[0], range2[0]), max(range1[1], range2[1]))
+
+
+def _pair_of(func):
+    """Function from a value to the range (func(value), func(value))"""
+    def pair(value):
+        attribute = func(value)
+        return (attribute, attribute)
+    return pair
+
+
+def _count_one(_):
+    return 1
+
+
+def _clear_aggregates(tree, key):
+    """Remove the reductions kept under *key* from every node"""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node._aggregates is not None:
+            node._aggregates.pop(key, None)
+        if not node.is_leaf:
+            stack.extend((node.left, node.right))
+
+
+def _iter_unique(pairs):
+    """Lazily drop pairs whose AABB has already been seen"""
+    seen = set()
+    seen_boxes = []
+    for pair in pairs:
+        try:
+            key = tuple(tuple(lims) for lims in pair[0].limits)
+            if key in seen:
+                continue
+            seen.add(key)
+        except TypeError:
+            # Unhashable limits
+            if pair[0] in seen_boxes:
+                continue
+            seen_boxes.append(pair[0])
+        yield pair
+
+
+def _overlap_dfs(in_tree, tree, halt, closed):
+    pairs = []
+
+    if in_tree.is_leaf:
+        in_branches = [in_tree]
+    else:
+        in_branches = [in_tree.left, in_tree.right]
+
+    if tree.is_leaf:
+        tree_branches = [tree]
+    else:
+        tree_branches = [tree.left, tree.right]
+
+    if not in_tree.aabb.overlaps(tree.aabb, closed):
+        return pairs
+
+    if in_tree.is_leaf and tree.is_leaf:
+        return _leaf_pairs(in_tree, tree, closed)
+
+    if _covers_subtree(tree, in_tree, closed):
+        pairs = _subtree_entries(in_tree)
+        return pairs[:1] if halt else pairs
+
+    for in_branch in in_branches:
+        for tree_branch in tree_branches:
+            o_pairs = _overlap_dfs(in_branch, tree_branch, halt, closed)
+            pairs.extend(o_pairs)
+            if halt and len(pairs) > 0:
+                return pairs
+    return pairs
+
+
+def _overlap_bfs(in_tree, tree, halt, closed):
+    pairs = []
+    queue = deque()
+    queue.append((in_tree, tree))
+    while len(queue) > 0:
+        s_node, t_node = queue.popleft()
+        if s_node.aabb.overlaps(t_node.aabb, closed):
+            if s_node.is_leaf and t_node.is_leaf:
+                pairs.extend(_leaf_pairs(s_node, t_node, closed))
+                if halt and len(pairs) > 0:
+                    return pairs
+            elif _covers_subtree(t_node, s_node, closed):
+                pairs.extend(_subtree_entries(s_node))
+                if halt:
+                    return pairs[:1]
+            elif s_node.is_leaf:
+                queue.append((s_node, t_node.left))
+                queue.append((s_node, t_node.right))
+            elif t_node.is_leaf:
+                queue.append((s_node.left, t_node))
+                queue.append((s_node.right, t_node))
+            else:
+                queue.append((s_node.left, t_node.left))
+                queue.append((s_node.left, t_node.right))
+                queue.append((s_node.right, t_node.left))
+                queue.append((s_node.right, t_node.right))
+    return pairs
+
+
+def _covers_subtree(t_node, s_node, closed):
+    """Check if every AABB below *s_node* overlaps the leaf *t_node*
+
+    This is true when the AABB of *s_node* is inside the AABB of the leaf.
+    For open overlap, it must be strictly inside, so that AABBs with zero
+    width still overlap.
+    """
+    if s_node.is_leaf or not t_node.is_leaf or t_node.bucket is not None:
+        return False
+    if closed:
+        return t_node.aabb.contains(s_node.aabb)
+    if t_node.aabb.limits is None or s_node.aabb.limits is None:
+        return False
+    for (min1, max1), (min2, max2) in zip(t_node.aabb.limits,
+                                          s_node.aabb.limits):
+        if min2 <= min1 or max2 >= max1:
+            return False
+    return True
 
 
 def _unique_pairs(pairs):
-    boxes, _ = zip(*pairs)
-    u_pairs = [p for i, p in enumerate(pairs) if p[0] not in boxes[:i]]
-    return u_pairs
+    return list(_iter_unique(pairs))
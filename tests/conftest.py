@@ -0,0 +1,16 @@
+import itertools
+
+from aabbtree import AABB
+from aabbtree import AABBTree
+
+
+def grid_aabbs(n):
+    return [AABB([(i, i + 0.5), (j, j + 0.5)])
+            for i, j in itertools.product(range(n), range(n))]
+
+
+def grid_tree(n):
+    tree = AABBTree()
+    for i, j in itertools.product(range(n), range(n)):
+        tree.add(AABB([(i, i + 0.5), (j, j + 0.5)]), (i, j))
+    return tree
@@ -1,6 +1,13 @@
 import pytest
 
 from aabbtree import AABB
+from aabbtree import corners_many
+from aabbtree import distance_many
+from aabbtree import merge_many
+from aabbtree import overlap_volume_many
+from aabbtree import overlaps_many
+from aabbtree import perimeter_many
+from aabbtree import volume_many
 
 
 def test_init():
@@ -123,6 +130,51 @@ def test_overlaps_closed():
     assert not aabb1.overlaps(AABB(), True)
 
 
+def test_contains():
+    aabb1 = AABB([(0, 10), (0, 10)])
+    aabb2 = AABB([(0, 5), (3, 10)])
+    aabb3 = AABB([(-1, 5), (3, 4)])
+
+    assert aabb1.contains(aabb1)
+    assert aabb1.contains(aabb2)
+    assert not aabb2.contains(aabb1)
+    assert not aabb1.contains(aabb3)
+    assert not aabb1.contains(AABB())
+    assert not AABB().contains(aabb1)
+
+
+def test_distance():
+    aabb1 = AABB([(0, 1), (0, 1)])
+    aabb2 = AABB([(4, 5), (5, 6)])
+    aabb3 = AABB([(0.5, 3), (1, 2)])
+
+    assert aabb1.distance(aabb2) == 5
+    assert aabb2.distance(aabb1) == 5
+    assert aabb1.distance(aabb2, 'chebyshev') == 4
+    assert aabb1.distance(aabb3) == 0
+    assert aabb2.distance(aabb3) == pytest.approx(10 ** 0.5)
+    with pytest.raises(ValueError):
+        aabb1.distance(aabb2, 'manhattan')
+
+
+def test_entry_time():
+    aabb1 = AABB([(0, 1), (0, 1)])
+    aabb2 = AABB([(3, 4), (0, 1)])
+    aabb3 = AABB([(3, 4), (3, 4)])
+
+    assert aabb1.entry_time(aabb2, (4, 0)) == 0.5
+    assert aabb1.entry_time(aabb2, (2, 0)) is None
+    assert aabb1.entry_time(aabb2, (2, 0), closed=True) == 1
+    assert aabb1.entry_time(aabb2, (-4, 0)) is None
+    assert aabb1.entry_time(aabb2, (4, 1)) == 0.5
+    assert aabb1.entry_time(aabb2, (4, 2)) is None
+    assert aabb1.entry_time(aabb3, (4, 4)) == 0.5
+    assert aabb1.entry_time(aabb3, (4, 0)) is None
+    assert aabb1.entry_time(aabb1, (0, 0)) == 0
+    assert aabb2.entry_time(aabb1, (-2.5, 0)) == 0.8
+    assert aabb1.entry_time(AABB(), (1, 1)) is None
+
+
 def test_corners():
     lims = [(0, 10), (5, 10)]
     aabb_corners = [
@@ -140,9 +192,105 @@ def test_corners():
         assert c in aabb_corners
 
 
+def test_corners_order():
+    lims = [(0, 1), (2, 3), (4, 5)]
+    corners = AABB(lims).corners
+    assert len(corners) == 8
+    for i, corner in enumerate(corners):
+        bits = [(i >> (2 - d)) & 1 for d in range(3)]
+        assert corner == [lims[d][b] for d, b in enumerate(bits)]
+
+    assert list(AABB(lims).iter_corners()) == [tuple(c) for c in corners]
+    assert len(list(AABB(10 * [(0, 1)]).iter_corners())) == 1024
+
+
+def test_perimeter_many():
+    boxes = [[(0, 1)], [(0, 4), (-2, 3.2)], [(-3, -2), (4, 5), (0, 1)],
+             [(4, 4), (0, 1), (0, 1)],
+             [(0, 2), (0, 3), (0, 4), (1, 6), (0, 1), (2, 5)]]
+    for lims in boxes:
+        aabb = AABB(lims)
+        lows = [[lb for lb, _ in lims], [ub for _, ub in lims]]
+        highs = [[ub for _, ub in lims], [ub for _, ub in lims]]
+        assert perimeter_many(lows, highs) == [aabb.perimeter, 0]
+        assert corners_many(lows, highs)[0] == aabb.corners
+
+    sides = [2, 3, 4, 5, 1, 3]
+    expected = 0
+    for i in range(6):
+        prod = 1
+        for j in range(6):
+            if j != i:
+                prod *= sides[j]
+        expected += prod
+    assert AABB(boxes[-1]).perimeter == 2 * expected
+    assert perimeter_many([], []) == []
+    assert corners_many([], []) == []
+
+
 def test_next():
     box = [(0, 1), (0, 1)]
     aabb = AABB(box)
     aabb._i = 2 + 1
     with pytest.raises(StopIteration):
         aabb.__next__()
+
+
+def test_overlaps_many():
+    boxes = [AABB([(0, 10), (0, 10)]),
+             AABB([(-5, 5), (-6, 3)]),
+             AABB([(10, 12), (5, 6)]),
+             AABB([(0, 0), (4, 4)])]
+    lows = [[lb for lb, _ in box] for box in boxes]
+    highs = [[ub for _, ub in box] for box in boxes]
+
+    for box in boxes + [AABB([(10, 10), (3, 3)])]:
+        for closed in (False, True):
+            expected = [box.overlaps(b, closed) for b in boxes]
+            assert overlaps_many(box, lows, highs, closed) == expected
+
+    assert overlaps_many(AABB(), lows, highs) == 4 * [False]
+    assert overlaps_many(boxes[0], [], []) == []
+
+
+def test_overlap_volume_many():
+    boxes = [AABB([(0, 10), (0, 10)]),
+             AABB([(-5, 5), (-6, 3)]),
+             AABB([(10, 12), (5, 6)])]
+    lows = [[lb for lb, _ in box] for box in boxes]
+    highs = [[ub for _, ub in box] for box in boxes]
+
+    for box in boxes:
+        expected = [box.overlap_volume(b) for b in boxes]
+        assert overlap_volume_many(box, lows, highs) == expected
+    assert overlap_volume_many(boxes[0], [], []) == []
+
+
+def test_distance_many():
+    boxes = [AABB([(0, 10), (0, 10)]),
+             AABB([(-5, 5), (-6, 3)]),
+             AABB([(12, 14), (15, 16)])]
+    lows = [[lb for lb, _ in box] for box in boxes]
+    highs = [[ub for _, ub in box] for box in boxes]
+
+    for box in boxes:
+        for metric in ('euclidean', 'chebyshev'):
+            expected = [box.distance(b, metric) for b in boxes]
+            assert distance_many(box, lows, highs, metric) == expected
+    assert distance_many(boxes[0], [], []) == []
+    with pytest.raises(ValueError):
+        distance_many(boxes[0], lows, highs, 'manhattan')
+
+
+def test_merge_many():
+    lows = [[0, 1], [-2, 3], [4, 0]]
+    highs = [[1, 2], [0, 4], [5, 1]]
+    assert merge_many(lows, highs) == AABB([(-2, 5), (0, 4)])
+    assert merge_many([], []) == AABB()
+
+
+def test_volume_many():
+    lows = [[0, 1], [-2, 3], [4, 0]]
+    highs = [[1, 2], [0, 4], [5, 2.5]]
+    assert volume_many(lows, highs) == [1, 2, 2.5]
+    assert volume_many([], []) == []
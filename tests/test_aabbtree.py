@@ -2,9 +2,12 @@ import itertools
 
 import pytest
 
+import aabbtree
 from aabbtree import AABB
 from aabbtree import AABBTree
 
+from conftest import grid_aabbs
+
 
 def test_init():
     aabb = AABB([(-2.3, 4.5), (3.6, 8.2)])
@@ -257,6 +260,105 @@ def test_overlap_values_error():
         tree.overlap_values(aabbs[0], method=method)
 
 
+def test_overlap_values_many():
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]), AABB([(0, 1), (0, 1)])]
+    for leaf_size in (1, 4):
+        tree = AABBTree(leaf_size=leaf_size)
+        for i, aabb in enumerate(grid_aabbs(6) + grid_aabbs(2)):
+            tree.add(aabb, i)
+        for closed, unique in itertools.product((False, True), (False, True)):
+            results = tree.overlap_values_many(queries, closed, unique)
+            assert len(results) == len(queries)
+            for aabb, vals in zip(queries, results):
+                assert vals == tree.overlap_values(aabb, closed=closed,
+                                                   unique=unique)
+
+    assert AABBTree().overlap_values_many(queries) == 4 * [[]]
+    assert AABBTree().overlap_values_many([]) == []
+
+
+def test_overlap_volumes():
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(0.25, 3.25), (0.25, 0.5)]), AABB([(20, 21), (0, 1)])]
+    aabbs = grid_aabbs(6) + [AABB([(0, 1), (0, 0)])]
+    for leaf_size in (1, 4):
+        tree = AABBTree.from_aabbs(aabbs, range(len(aabbs)), leaf_size)
+        results = tree.overlap_volumes_many(queries)
+        totals = tree.overlap_volumes_many(queries, total=True)
+        for aabb, pairs, volume in zip(queries, results, totals):
+            expected = [(i, box.overlap_volume(aabb))
+                        for i, box in enumerate(aabbs)
+                        if box.overlap_volume(aabb) > 0]
+            assert sorted(pairs) == expected
+            assert tree.overlap_volumes(aabb) == pairs
+            assert volume == pytest.approx(sum(v for _, v in expected))
+            assert tree.overlap_volumes(aabb, total=True) == volume
+
+    assert sorted(tree.overlap_volumes(queries[2])) == \
+        [(0, 0.0625), (6, 0.125), (12, 0.125), (18, 0.0625)]
+    assert AABBTree().overlap_volumes(queries[0]) == []
+    assert AABBTree().overlap_volumes(queries[0], total=True) == 0
+
+    aabbs = [AABB([(0, 2), (0, 2)]), AABB([(1, 1), (0, 2)])]
+    query = AABB([(0.5, 1.5), (0.5, 1.5)])
+    for leaf_size in (1, 4):
+        tree = AABBTree.from_aabbs(aabbs, ['a', 'b'], leaf_size)
+        assert tree.overlap_volumes(query) == [('a', 1.0)]
+
+
+def test_within_containing():
+    aabbs = grid_aabbs(6) + [AABB([(0, 6), (0, 6)]), AABB([(1, 2), (1, 1)])]
+    queries = [AABB([(-1, 2.5), (1, 3)]), AABB([(2, 2.5), (0, 9)]),
+               AABB([(1.2, 1.3), (1.1, 1.2)]), AABB([(-9, 9), (-9, 9)]),
+               AABB([(20, 21), (0, 1)]), AABB([(1, 1.5), (1, 1)])]
+    for leaf_size in (1, 4):
+        tree = AABBTree.from_aabbs(aabbs, range(len(aabbs)), leaf_size)
+        within = tree.within_many(queries)
+        containing = tree.containing_many(queries)
+        for aabb, w_vals, c_vals in zip(queries, within, containing):
+            assert sorted(w_vals) == [i for i, b in enumerate(aabbs)
+                                      if aabb.contains(b)]
+            assert sorted(c_vals) == [i for i, b in enumerate(aabbs)
+                                      if b.contains(aabb)]
+            assert tree.within(aabb) == w_vals
+            assert tree.containing(aabb) == c_vals
+
+    assert sorted(tree.within(queries[3])) == list(range(38))
+    assert sorted(tree.containing(queries[5])) == [7, 36, 37]
+    assert AABBTree().within(queries[3]) == []
+    assert AABBTree().containing(queries[3]) == []
+
+
+def test_covered_subtree(monkeypatch):
+    tree = AABBTree.from_aabbs(grid_aabbs(8), range(64))
+    calls = []
+    overlaps = AABB.overlaps
+
+    def counting_overlaps(self, aabb, closed=False):
+        calls.append(aabb)
+        return overlaps(self, aabb, closed)
+
+    monkeypatch.setattr(AABB, 'overlaps', counting_overlaps)
+    big = AABB([(-1, 9), (-1, 9)])
+    for m, closed in itertools.product(('DFS', 'BFS'), (False, True)):
+        del calls[:]
+        assert sorted(tree.overlap_values(big, method=m, closed=closed)) == \
+            list(range(64))
+        assert len(calls) == 1
+        assert tree.does_overlap(big, method=m, closed=closed)
+
+    # Open overlap needs the node strictly inside the query
+    edge = AABB([(0, 7.5), (0, 7.5)])
+    assert sorted(tree.overlap_values(edge)) == list(range(64))
+    flat = AABBTree.from_aabbs([AABB([(0, 0), (0, 1)]),
+                                AABB([(1, 1), (0, 1)])], 'ab')
+    assert flat.overlap_values(AABB([(0, 1), (0, 1)])) == []
+    assert flat.overlap_values(AABB([(0, 1), (0, 1)]), closed=True) == \
+        ['a', 'b']
+    assert flat.overlap_values(AABB([(-1, 2), (-1, 2)])) == ['a', 'b']
+
+
 def test_return_the_origin_pass_in_value():
     class Foo:
         pass
@@ -292,6 +394,588 @@ def test_unique():
     assert 'box 2' in vals
 
 
+def test_leaf_size():
+    aabbs = grid_aabbs(8)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)])]
+
+    flat = AABBTree()
+    for i, aabb in enumerate(aabbs):
+        flat.add(aabb, i)
+
+    for leaf_size in (2, 8):
+        tree = AABBTree(leaf_size=leaf_size)
+        for i, aabb in enumerate(aabbs):
+            tree.add(aabb, i)
+            assert len(tree) == i + 1
+        aabb_merge(tree)
+        assert count_nodes(tree) < count_nodes(flat)
+        assert all_buckets(tree, leaf_size)
+
+        for aabb in queries:
+            for closed in (False, True):
+                vals = tree.overlap_values(aabb, closed=closed)
+                assert sorted(vals) == sorted(flat.overlap_values(
+                    aabb, closed=closed))
+        assert tree.does_overlap(flat)
+        assert sorted(tree.overlap_values(flat, unique=False)) == \
+            list(range(64))
+        assert sorted(tree.compile().overlap_values(queries[0])) == \
+            sorted(flat.overlap_values(queries[0]))
+
+
+def test_leaf_size_raises():
+    with pytest.raises(ValueError):
+        AABBTree(leaf_size=0)
+    with pytest.raises(ValueError):
+        AABBTree.from_aabbs(standard_aabbs(), leaf_size=0)
+    with pytest.raises(ValueError):
+        AABBTree.from_aabbs(standard_aabbs(), values=[1, 2])
+
+
+def test_leaf_size_repr():
+    tree = AABBTree(AABB([(0, 1)]), 'a', leaf_size=4)
+    assert tree.bucket == [(AABB([(0, 1)]), 'a')]
+    assert tree.value is None
+    assert repr(tree) == \
+        "AABBTree(bucket=[(AABB([(0, 1)]), 'a')], leaf_size=4)"
+    assert 'Bucket: ' in str(tree)
+    assert repr(AABBTree(leaf_size=4)) == 'AABBTree(leaf_size=4)'
+
+    for n in (1, 3, 4, 9, 40):
+        aabbs = grid_aabbs(n)[:n]
+        tree = AABBTree.from_aabbs(aabbs, [str(i) for i in range(n)], 4)
+        copy = eval(repr(tree))
+        assert copy == tree
+        assert len(copy) == n
+        assert copy.overlap_values(AABB([(-1, 99), (-1, 99)])) == \
+            tree.overlap_values(AABB([(-1, 99), (-1, 99)]))
+
+    entries = [(AABB([(0, 1)]), 'a'), (AABB([(2, 3)]), 'b')]
+    assert AABBTree(bucket=entries, leaf_size=2).bucket == entries
+    with pytest.raises(ValueError):
+        AABBTree(bucket=entries)
+    with pytest.raises(ValueError):
+        AABBTree(bucket=3 * entries, leaf_size=4)
+
+
+def test_from_aabbs():
+    aabbs = grid_aabbs(8)
+    values = list(range(len(aabbs)))
+    query = AABB([(-1, 2.5), (1.5, 3)])
+    for leaf_size in (1, 4, 32):
+        tree = AABBTree.from_aabbs(aabbs, values, leaf_size)
+        assert len(tree) == len(aabbs)
+        aabb_merge(tree)
+        if leaf_size > 1:
+            assert all_buckets(tree, leaf_size)
+        assert sorted(tree.overlap_values(query)) == [2, 10, 18]
+
+    assert AABBTree.from_aabbs([]) == AABBTree()
+    assert len(AABBTree.from_aabbs([], leaf_size=4)) == 0
+    assert AABBTree.from_aabbs(aabbs[:1]) == AABBTree(aabbs[0])
+
+
+def test_optimize():
+    # Boxes added in sorted order degrade the tree
+    aabbs = [AABB([(x, x + i % 5 + 1), ((61 * i) % 100, (61 * i) % 100 + 3)])
+             for i, x in enumerate(range(0, 200, 2))]
+    query = AABB([(20, 45), (20, 40)])
+    tree = AABBTree()
+    for i, aabb in enumerate(aabbs):
+        tree.add(aabb, i)
+    expected = sorted(tree.overlap_values(query, unique=False))
+    n_nodes = count_nodes(tree)
+
+    assert tree.optimize(max_nodes=0) == 0
+    assert tree.optimize(max_time=0) == 0
+
+    total = 0
+    for _ in range(5):
+        cost = aabbtree._subtree_cost(tree)
+        n_rebuilt = tree.optimize(max_nodes=64)
+        assert aabbtree._subtree_cost(tree) <= cost
+        total += n_rebuilt
+        aabb_merge(tree)
+        assert len(tree) == len(aabbs)
+        assert count_nodes(tree) == n_nodes
+        assert sorted(tree.overlap_values(query, unique=False)) == expected
+    assert total > 0
+
+    assert AABBTree().optimize() == 0
+
+
+def test_optimize_max_time(monkeypatch):
+    # Each reading of the clock takes a millisecond
+    class Clock(object):  # pylint: disable=useless-object-inheritance
+        now = 0
+
+        @classmethod
+        def perf_counter(cls):
+            cls.now += 1e-3
+            return cls.now
+
+    scored = []
+    overlap_fraction = aabbtree._overlap_fraction
+
+    def counter(node):
+        scored.append(id(node))
+        return overlap_fraction(node)
+
+    monkeypatch.setattr(aabbtree, 'time', Clock)
+    monkeypatch.setattr(aabbtree, '_overlap_fraction', counter)
+    tree = AABBTree.from_aabbs(grid_aabbs(32), list(range(1024)))
+    branches = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if not node.is_leaf:
+            if count_nodes(node) <= 16:
+                branches.add(id(node))
+            stack.extend((node.left, node.right))
+
+    # The search stops when the time runs out, then resumes
+    assert tree.optimize(max_nodes=16, max_time=0.01) == 0
+    assert 0 < len(scored) < len(branches) / 10
+    for _ in range(len(branches)):
+        if set(scored) == branches:
+            break
+        n_scored = len(scored)
+        tree.optimize(max_nodes=16, max_time=0.01)
+        assert len(scored) > n_scored
+    assert set(scored) == branches
+    assert len(scored) < 2 * len(branches)
+
+
+def test_count_overlaps(monkeypatch):
+    tree = AABBTree.from_aabbs(grid_aabbs(6), list(range(36)))
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]), AABB([(-9, 9), (-9, 9)])]
+    for query, method, closed in itertools.product(queries, ('DFS', 'BFS'),
+                                                   (False, True)):
+        expected = tree.overlap_values(query, method, closed, unique=False)
+        assert tree.count_overlaps(query, method, closed) == len(expected)
+
+    def fail(*args):
+        raise AssertionError('pairs were built')
+
+    # Counting does not list the overlapping AABBs
+    where = {'time': (5, 30)}
+    for leaf_size in (1, 3):
+        tree = AABBTree.from_aabbs(grid_aabbs(6), list(range(36)), leaf_size)
+        tree.add_attribute('time', lambda v: v, kind='range')
+        other = AABBTree.from_aabbs(grid_aabbs(3), leaf_size=leaf_size)
+        n_pairs = len(list(aabbtree._iter_pairs(tree, other, 'DFS', True)))
+
+        for name in ('_iter_pairs', '_subtree_entries', '_matching_entries',
+                     '_leaf_pairs'):
+            monkeypatch.setattr(aabbtree, name, fail)
+        for query, closed in itertools.product(queries, (False, True)):
+            expected = [i for i, box in enumerate(grid_aabbs(6))
+                        if box.overlaps(query, closed)]
+            assert tree.count_overlaps(query, closed=closed) == len(expected)
+            assert tree.count_overlaps(query, closed=closed, where=where) == \
+                len([i for i in expected if 5 <= i <= 30])
+        assert tree.count_overlaps(other, closed=True) == n_pairs
+        monkeypatch.undo()
+
+    tree = AABBTree()
+    tree.add(AABB([(0, 1)]), 'box 1')
+    tree.add(AABB([(0, 1)]), 'box 2')
+    assert tree.count_overlaps(AABB([(0.5, 2)])) == 2
+    assert AABBTree().count_overlaps(AABB([(0, 1)])) == 0
+    with pytest.raises(ValueError):
+        tree.count_overlaps(AABB([(0, 1)]), method='other')
+
+
+def test_overlap_values_limit():
+    tree = AABBTree.from_aabbs(grid_aabbs(6), list(range(36)))
+    query = AABB([(-1, 2.5), (1.5, 3)])
+    for method in ('DFS', 'BFS'):
+        expected = tree.overlap_values(query, method)
+        for limit in (0, 1, 3, len(expected), 100):
+            out = tree.overlap_values(query, method, limit=limit)
+            assert out == expected[:limit]
+        boxes = tree.overlap_aabbs(query, method, limit=2)
+        assert boxes == tree.overlap_aabbs(query, method)[:2]
+
+    tree = AABBTree()
+    tree.add(AABB([(0, 1)]), 'box 1')
+    tree.add(AABB([(0, 1)]), 'box 2')
+    tree.add(AABB([(1, 2)]), 'box 3')
+    assert tree.overlap_values(AABB([(0, 2)]), limit=2) == ['box 1', 'box 3']
+    assert tree.overlap_values(AABB([(0, 2)]), unique=False, limit=2) == \
+        ['box 1', 'box 2']
+
+
+def test_overlap_cursor():
+    tree = AABBTree.from_aabbs(grid_aabbs(6), list(range(36)))
+    query = AABB([(0.2, 3.2), (-1, 4.2)])
+    for method, unique in itertools.product(('DFS', 'BFS'), (True, False)):
+        expected = tree.overlap_values(query, method, unique=unique)
+        cursor = tree.overlap_cursor(query, method, unique=unique)
+        pages = []
+        while not cursor.done:
+            pages.append(cursor.fetch(3))
+        assert all(len(page) == 3 for page in pages[:-1])
+        assert sum(pages, []) == expected
+        assert cursor.fetch(3) == []
+
+    cursor = tree.overlap_cursor(query)
+    first = next(cursor)
+    assert [first] + list(cursor) == tree.overlap_values(query)
+    assert cursor.done
+
+
+def test_within_distance():
+    aabbs = grid_aabbs(6)
+    points = [(2.25, 2.25), (-1, -1), (6, 2.75), (20, 20)]
+    queries = points + [AABB([(1.6, 1.9), (-3, -2)])]
+    for leaf_size, metric in itertools.product((1, 3),
+                                               ('euclidean', 'chebyshev')):
+        tree = AABBTree.from_aabbs(aabbs, list(range(36)), leaf_size)
+        for query, r in itertools.product(queries, (0, 0.5, 1.2, 2.5)):
+            box = query if isinstance(query, AABB) else \
+                AABB([(x, x) for x in query])
+            expected = sorted((v, box.distance(b, metric))
+                              for v, b in enumerate(aabbs)
+                              if box.distance(b, metric) <= r)
+            out = tree.within_distance(query, r, metric)
+            assert sorted(out) == expected
+
+        many = tree.within_distance_many(queries, 1.2, metric)
+        assert [sorted(out) for out in many] == \
+            [sorted(tree.within_distance(q, 1.2, metric)) for q in queries]
+
+    tree = AABBTree.from_aabbs(aabbs, list(range(36)))
+    corner = [v for v, _ in tree.within_distance((-0.5, -0.5), 0.6)]
+    assert corner == []
+    corner = [v for v, _ in tree.within_distance((-0.5, -0.5), 0.6,
+                                                 'chebyshev')]
+    assert corner == [0]
+    assert AABBTree().within_distance((0, 0), 1) == []
+    with pytest.raises(ValueError):
+        tree.within_distance((0, 0), 1, 'manhattan')
+
+
+def test_query_halfspaces():
+    aabbs = grid_aabbs(6)
+    # Box [1, 3.2] x [0.7, 2.1]
+    box_normals = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+    box_offsets = [3.2, -1, 2.1, -0.7]
+    # Triangle x >= 0, y >= 0, x + y <= 3
+    tri_normals = [(-1, 0), (0, -1), (1, 1)]
+    tri_offsets = [0, 0, 3]
+    for leaf_size in (1, 3):
+        tree = AABBTree.from_aabbs(aabbs, list(range(36)), leaf_size)
+        out = tree.query_halfspaces(box_normals, box_offsets)
+        query = AABB([(1, 3.2), (0.7, 2.1)])
+        assert sorted(out) == sorted(tree.overlap_values(query, closed=True))
+
+        out = tree.query_halfspaces(tri_normals, tri_offsets)
+        expected = [6 * i + j for i, j in itertools.product(range(6), range(6))
+                    if i + j <= 3]
+        assert sorted(out) == expected
+
+        assert sorted(tree.query_halfspaces([], [])) == list(range(36))
+        assert tree.query_halfspaces([(1, 1)], [-1]) == []
+
+    assert AABBTree().query_halfspaces(tri_normals, tri_offsets) == []
+    with pytest.raises(ValueError):
+        tree.query_halfspaces(tri_normals, box_offsets)
+
+
+def test_query_halfspaces_skips_planes(monkeypatch):
+    tree = AABBTree.from_aabbs(grid_aabbs(6), list(range(36)))
+    tested = []
+    planes = aabbtree._halfspace_planes
+
+    def counter(aabb, normals, offsets, active):
+        tested.append(len(active))
+        return planes(aabb, normals, offsets, active)
+
+    monkeypatch.setattr(aabbtree, '_halfspace_planes', counter)
+    out = tree.query_halfspaces([(-1, 0), (1, 0)], [-1, 100])
+    assert sorted(out) == list(range(6, 36))
+    assert tested[0] == 2
+    assert tested[1:] == (len(tested) - 1) * [1]
+    assert len(tested) < 71
+
+
+def test_sweep():
+    aabbs = grid_aabbs(6)
+    queries = [AABB([(0.6, 0.9), (0.6, 0.9)]), AABB([(-2, -1), (2.1, 2.4)]),
+               AABB([(4, 4.5), (0, 5)]), AABB([(7, 8), (7, 8)])]
+    displacements = [(4, 4), (9, 0), (-3, 0.5), (1, 1)]
+    for leaf_size, closed in itertools.product((1, 3), (False, True)):
+        tree = AABBTree.from_aabbs(aabbs, list(range(36)), leaf_size)
+        for aabb, disp in zip(queries, displacements):
+            expected = [(v, aabb.entry_time(box, disp, closed))
+                        for v, box in enumerate(aabbs)]
+            expected = [hit for hit in expected if hit[1] is not None]
+            out = tree.sweep(aabb, disp, closed)
+            assert sorted(out) == sorted(expected)
+            times = [t_hit for _, t_hit in out]
+            assert times == sorted(times)
+
+        many = tree.sweep_many(queries, displacements, closed)
+        assert many == [tree.sweep(aabb, disp, closed)
+                        for aabb, disp in zip(queries, displacements)]
+
+    tree = AABBTree.from_aabbs(aabbs, list(range(36)))
+    hits = tree.sweep(queries[0], displacements[0])
+    assert [v for v, _ in hits] == [7, 14, 21, 28]
+    swept = AABB([(0.6, 4.9), (0.6, 4.9)])
+    assert len(tree.overlap_values(swept)) > len(hits)
+    assert AABBTree().sweep(queries[0], displacements[0]) == []
+
+
+def test_add_many():
+    aabbs = grid_aabbs(8)
+    for leaf_size, n_init, n_add in itertools.product((1, 3), (0, 1, 40),
+                                                      (1, 5, 24, 64)):
+        tree = AABBTree.from_aabbs(aabbs[:n_init], list(range(n_init)),
+                                   leaf_size)
+        added = aabbs[-n_add:]
+        tree.add_many(added, ['new'] * n_add)
+        assert len(tree) == n_init + n_add
+        assert tree.aabb == AABBTree.from_aabbs(aabbs[:n_init] + added).aabb
+        aabb_merge(tree)
+        if leaf_size > 1:
+            assert all_buckets(tree, leaf_size)
+        for box in added:
+            assert 'new' in tree.overlap_values(box, unique=False)
+
+    tree = AABBTree()
+    tree.add_many([])
+    assert tree == AABBTree()
+    tree.add_many(aabbs[:2])
+    assert tree.overlap_values(AABB([(-1, 9), (-1, 9)]), unique=False) == \
+        [None, None]
+    with pytest.raises(ValueError):
+        tree.add_many(aabbs[:2], [1])
+    with pytest.raises(ValueError):
+        tree.add_many(aabbs[:2], method='other')
+
+
+def test_add_many_new_branch():
+    tree = AABBTree.from_aabbs(grid_aabbs(8), list(range(64)))
+    far = [AABB([(100 + i, 100.5 + i), (100, 100.5)]) for i in range(3)]
+    tree.add_many(far, ['far'] * 3)
+    assert tree.right.aabb == AABB([(100, 102.5), (100, 100.5)])
+    assert sorted(tree.left.overlap_values(tree.left.aabb)) == list(range(64))
+
+
+def test_merge_trees():
+    aabbs = grid_aabbs(8)
+    for leaf_size in (1, 3):
+        tree1 = AABBTree.from_aabbs(aabbs[::2], range(0, 64, 2), leaf_size)
+        tree2 = AABBTree.from_aabbs(aabbs[1::2], range(1, 64, 2), leaf_size)
+        merged = AABBTree.merge_trees(tree1, tree2)
+        assert len(merged) == 64
+        assert merged.aabb == AABB([(0, 7.5), (0, 7.5)])
+        aabb_merge(merged)
+        assert merged.depth <= max(tree1.depth, tree2.depth) + 2
+        query = AABB([(1.2, 3.7), (2, 5)])
+        assert sorted(merged.overlap_values(query)) == \
+            sorted(tree1.overlap_values(query) + tree2.overlap_values(query))
+        assert len(tree1) == 32 and len(tree2) == 32
+
+    tree = AABBTree.from_aabbs(aabbs[:5])
+    assert AABBTree.merge_trees(tree, AABBTree()) == tree
+    assert AABBTree.merge_trees(AABBTree(), AABBTree()) == AABBTree()
+
+    # A lone surviving leaf is copied, not shared with the input
+    for leaf_size, n in ((1, 1), (4, 3)):
+        tree = AABBTree.from_aabbs(aabbs[:n], leaf_size=leaf_size)
+        merged = AABBTree.merge_trees(AABBTree(leaf_size=leaf_size), tree)
+        assert merged is not tree
+        assert merged == tree
+        merged.add(aabbs[n])
+        assert len(tree) == n and len(merged) == n + 1
+        assert tree == AABBTree.from_aabbs(aabbs[:n], leaf_size=leaf_size)
+    with pytest.raises(ValueError):
+        AABBTree.merge_trees(tree, AABBTree(leaf_size=2))
+
+
+def test_split():
+    aabbs = grid_aabbs(8)
+    for leaf_size, k in itertools.product((1, 3), (1, 2, 3, 5, 8)):
+        tree = AABBTree.from_aabbs(aabbs, list(range(64)), leaf_size)
+        shards = tree.split(k)
+        assert len(shards) == k
+        sizes = [len(shard) for shard, _ in shards]
+        assert sum(sizes) == 64
+        assert max(sizes) - min(sizes) <= 1
+        values = []
+        for shard, bounds in shards:
+            assert shard.aabb == bounds
+            assert shard.leaf_size == leaf_size
+            values.extend(shard.overlap_values(bounds, unique=False))
+        assert sorted(values) == list(range(64))
+        assert len(tree) == 64
+
+    shards = AABBTree.from_aabbs(aabbs, list(range(64))).split(4)
+    for (_, bounds1), (_, bounds2) in itertools.combinations(shards, 2):
+        assert not bounds1.overlaps(bounds2)
+
+    assert len(AABBTree.from_aabbs(aabbs[:3]).split(5)) == 3
+    assert AABBTree().split(2) == []
+    with pytest.raises(ValueError):
+        AABBTree().split(0)
+
+
+def test_where():
+    aabbs = grid_aabbs(8)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(-9, 9), (-9, 9)]),
+               AABB([(3.2, 6), (0, 9)])]
+    conditions = [{'layer': 0b001}, {'layer': 0b110}, {'time': (10, 20)},
+                  {'layer': 0b100, 'time': (0, 40)}, {'time': (70, 80)}]
+
+    def meets(value, where):
+        layer_ok = 'layer' not in where or (1 << value % 3) & where['layer']
+        lower, upper = where.get('time', (0, 63))
+        return layer_ok and lower <= value <= upper
+
+    for leaf_size, method in itertools.product((1, 3), ('DFS', 'BFS')):
+        tree = AABBTree.from_aabbs(aabbs, list(range(64)), leaf_size)
+        tree.add_attribute('layer', lambda v: 1 << v % 3)
+        tree.add_attribute('time', lambda v: v, kind='range')
+        for query, where in itertools.product(queries, conditions):
+            expected = [v for v in tree.overlap_values(query, method)
+                        if meets(v, where)]
+            out = tree.overlap_values(query, method, where=where)
+            assert out == expected
+            boxes = tree.overlap_aabbs(query, method, where=where)
+            assert boxes == [aabbs[v] for v in expected]
+            assert tree.count_overlaps(query, method, where=where) == \
+                len(expected)
+            assert tree.does_overlap(query, method, where=where) == \
+                (len(expected) > 0)
+            assert tree.overlap_cursor(query, method, where=where).fetch(2) \
+                == expected[:2]
+            assert tree.overlap_values(query, method, limit=1,
+                                       where=where) == expected[:1]
+
+    with pytest.raises(ValueError):
+        tree.overlap_values(queries[0], where={'size': 1})
+    with pytest.raises(ValueError):
+        tree.add_attribute('size', len, kind='sum')
+    assert AABBTree().overlap_values(queries[0], where={}) == []
+
+
+def test_where_prunes(monkeypatch):
+    tree = AABBTree.from_aabbs(grid_aabbs(8), list(range(64)))
+    tree.add_attribute('time', lambda v: v, kind='range')
+    visited = []
+    meets = aabbtree._node_meets
+
+    def counter(node, conditions):
+        visited.append(node)
+        return meets(node, conditions)
+
+    monkeypatch.setattr(aabbtree, '_node_meets', counter)
+    query = AABB([(-1, 9), (-1, 0.2)])
+    assert tree.overlap_values(query, where={'time': (24, 24)}) == [24]
+    assert len(visited) < 2 * tree.depth + 2
+
+
+def test_where_updates():
+    tree = AABBTree()
+    tree.add_attribute('layer', lambda v: v[1])
+    for i, aabb in enumerate(grid_aabbs(4)):
+        tree.add(aabb, (i, 1))
+    query = AABB([(-1, 9), (-1, 9)])
+    assert tree.overlap_values(query, where={'layer': 2}) == []
+
+    tree.add(AABB([(1, 2), (1, 2)]), ('new', 2))
+    assert tree.overlap_values(query, where={'layer': 2}) == [('new', 2)]
+    tree.add_many([AABB([(0, 1), (2, 3)])], [('many', 6)])
+    assert sorted(tree.overlap_values(query, where={'layer': 2})) == \
+        [('many', 6), ('new', 2)]
+    tree.optimize()
+    assert sorted(tree.overlap_values(query, where={'layer': 4})) == \
+        [('many', 6)]
+
+    tree.add_attribute('layer', lambda v: 1 if v[0] == 0 else 0)
+    assert tree.overlap_values(query, where={'layer': 1}) == [(0, 1)]
+
+    tree.add(AABB([(5, 6), (5, 6)]), (0, 0))
+    tree.add_attribute('layer', lambda v: v[1])
+    assert tree.overlap_values(query, where={'layer': 4}) == [('many', 6)]
+    assert tree.left.attributes == {}
+
+
+def test_aggregate():
+    aabbs = grid_aabbs(8)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(-9, 9), (-9, 9)]),
+               AABB([(3.2, 6), (0, 9)]), AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)])]
+    for leaf_size, closed in itertools.product((1, 3), (False, True)):
+        tree = AABBTree.from_aabbs(aabbs, list(range(64)), leaf_size)
+        tree.add_aggregate('total', lambda v: v)
+        tree.add_aggregate('low', lambda v: v, 'min')
+        tree.add_aggregate('high', lambda v: 2 * v, 'max')
+        tree.add_aggregate('n', combine='count')
+        tree.add_aggregate('odd', lambda v: v % 2, lambda a, b: a ^ b)
+        for query in queries:
+            hits = tree.overlap_values(query, closed=closed, unique=False)
+            assert tree.aggregate(query, 'total', closed) == sum(hits)
+            assert tree.aggregate(query, 'low', closed) == \
+                (min(hits) if hits else None)
+            assert tree.aggregate(query, 'high', closed) == \
+                (2 * max(hits) if hits else None)
+            assert tree.aggregate(query, 'n', closed) == len(hits)
+            parity = sum(v % 2 for v in hits) % 2 if hits else None
+            assert tree.aggregate(query, 'odd', closed) == parity
+
+    with pytest.raises(ValueError):
+        tree.aggregate(queries[0], 'weight')
+    with pytest.raises(ValueError):
+        tree.add_aggregate('weight', len, combine='mean')
+    with pytest.raises(ValueError):
+        tree.add_aggregate('weight', combine='sum')
+    assert tree.left.aggregates == {}
+    with pytest.raises(ValueError):
+        tree.left.aggregate(queries[0], 'n')
+
+    tree = AABBTree()
+    tree.add_aggregate('n', combine='count')
+    tree.add_aggregate('low', lambda v: v, 'min')
+    assert tree.aggregate(queries[0], 'n') == 0
+    assert tree.aggregate(queries[0], 'low') is None
+
+
+def test_aggregate_uses_nodes():
+    tree = AABBTree.from_aabbs(grid_aabbs(8), list(range(64)))
+    calls = []
+    tree.add_aggregate('total', lambda v: calls.append(v) or v)
+    query = AABB([(-1, 9), (-1, 9)])
+    assert tree.aggregate(query, 'total') == sum(range(64))
+    assert len(calls) == 64
+    assert tree.aggregate(query, 'total') == sum(range(64))
+    assert len(calls) == 64
+
+    tree.add(AABB([(1, 2), (1, 2)]), 100)
+    assert tree.aggregate(query, 'total') == sum(range(64)) + 100
+    assert len(calls) < 64 + tree.depth + 2
+    tree.add_many([AABB([(0, 1), (0, 1)])], [1000])
+    tree.optimize()
+    assert tree.aggregate(query, 'total') == sum(range(64)) + 1100
+
+
+def count_nodes(tree):
+    if tree.is_leaf:
+        return 1
+    return 1 + count_nodes(tree.left) + count_nodes(tree.right)
+
+
+def all_buckets(tree, leaf_size):
+    if tree.is_leaf:
+        return tree.bucket is not None and 0 < len(tree.bucket) <= leaf_size
+    return all_buckets(tree.left, leaf_size) and \
+        all_buckets(tree.right, leaf_size)
+
+
 def standard_aabbs():
     aabb1 = AABB([(0, 1), (0, 1)])
     aabb2 = AABB([(3, 4), (0, 1)])
@@ -0,0 +1,63 @@
+import asyncio
+import itertools
+
+import pytest
+
+from aabbtree import AABB
+from aabbtree import AsyncAABBIndex
+
+from conftest import grid_tree
+
+
+class CountingTree(object):
+    def __init__(self, tree):
+        self.tree = tree
+        self.batches = []
+
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        self.batches.append(len(aabbs))
+        return self.tree.overlap_values_many(aabbs, closed, unique)
+
+
+class BrokenTree(object):
+    def overlap_values_many(self, aabbs, closed=False, unique=True):
+        raise RuntimeError('broken')
+
+
+def test_query():
+    tree = grid_tree(6)
+    queries = [AABB([(i - 0.2, i + 0.2), (j - 0.2, j + 0.2)])
+               for i, j in itertools.product(range(-1, 7), range(-1, 7))]
+    counter = CountingTree(tree)
+
+    async def main():
+        index = AsyncAABBIndex(counter, window=0.01)
+        return await asyncio.gather(*[index.query(q) for q in queries])
+
+    results = asyncio.run(main())
+    assert results == [tree.overlap_values(q) for q in queries]
+    assert counter.batches == [len(queries)]
+
+
+def test_max_batch():
+    tree = grid_tree(4)
+    queries = 10 * [AABB([(0, 1), (0, 1)])]
+    counter = CountingTree(tree)
+
+    async def main():
+        index = AsyncAABBIndex(counter, window=10, max_batch=4, closed=True)
+        return await asyncio.wait_for(
+            asyncio.gather(*[index.query(q) for q in queries[:8]]), 5)
+
+    results = asyncio.run(main())
+    assert results == 8 * [tree.overlap_values(queries[0], closed=True)]
+    assert counter.batches == [4, 4]
+
+
+def test_query_raises():
+    async def main():
+        index = AsyncAABBIndex(BrokenTree())
+        return await index.query(AABB([(0, 1)]))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
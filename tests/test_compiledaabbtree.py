@@ -0,0 +1,290 @@
+import itertools
+from array import array
+
+import pytest
+
+import aabbtree
+from aabbtree import AABB
+from aabbtree import AABBTree
+from aabbtree import CompiledAABBTree
+
+from conftest import grid_aabbs
+from conftest import grid_tree
+
+
+def test_init():
+    tree = standard_tree()
+    for layout in ('dfs', 'veb'):
+        compiled = tree.compile(layout)
+        assert isinstance(compiled, CompiledAABBTree)
+        assert compiled.aabb == tree.aabb
+        assert len(compiled) == len(tree)
+        assert len(compiled.leaf_start) == 7
+        assert compiled.leaf_start[0] == 0
+        assert compiled.leaf_stop[0] == 4
+
+    assert len(AABBTree().compile()) == 0
+    assert AABBTree().compile().overlap_values(AABB([(0, 1), (0, 1)])) == []
+
+
+def test_init_raises():
+    with pytest.raises(ValueError):
+        standard_tree().compile(layout='bfs')
+    with pytest.raises(ValueError):
+        standard_tree().compile(arity=3)
+    with pytest.raises(ValueError):
+        standard_tree().compile(quantize=32)
+    with pytest.raises(ValueError):
+        standard_tree().compile(dtype='float16')
+    with pytest.raises(ValueError):
+        grid_tree(2).compile(dtype='int32')
+
+
+def test_wide():
+    tree = grid_tree(8)
+    binary = tree.compile()
+    assert binary.depth == tree.depth
+    for arity in (4, 8):
+        compiled = tree.compile(arity=arity)
+        assert compiled.depth < binary.depth
+        assert len(compiled) == len(tree)
+        for node in range(len(compiled.leaf_start)):
+            n_kids = compiled.child_ptr[node + 1] - compiled.child_ptr[node]
+            assert n_kids <= arity
+
+
+def test_subtree_leaves_contiguous():
+    tree = grid_tree(6)
+    for layout in ('dfs', 'veb'):
+        compiled = tree.compile(layout)
+        for node in range(len(compiled.leaf_start)):
+            first = compiled.child_ptr[node]
+            last = compiled.child_ptr[node + 1]
+            if first == last:
+                continue
+            kids = [compiled.child_idx[s] for s in range(first, last)]
+            assert compiled.leaf_start[node] == compiled.leaf_start[kids[0]]
+            assert compiled.leaf_stop[node] == compiled.leaf_stop[kids[-1]]
+            for kid1, kid2 in zip(kids[:-1], kids[1:]):
+                assert compiled.leaf_stop[kid1] == compiled.leaf_start[kid2]
+
+
+def test_overlap_values():
+    tree = grid_tree(6)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]),
+               AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]),
+               AABB([(-9, 9), (-9, 9)])]
+    options = itertools.product(('dfs', 'veb'), (2, 4, 8), (False, True))
+    for layout, arity, closed in options:
+        compiled = tree.compile(layout, arity)
+        for aabb in queries:
+            expected = tree.overlap_values(aabb, closed=closed)
+            out = compiled.overlap_values(aabb, closed=closed)
+            assert sorted(out) == sorted(expected)
+            assert compiled.does_overlap(aabb, closed) == (len(expected) > 0)
+            boxes = compiled.overlap_aabbs(aabb, closed=closed)
+            assert len(boxes) == len(expected)
+            assert all([box.overlaps(aabb, closed) for box in boxes])
+
+
+def test_quantize():
+    tree = AABBTree()
+    for i, j in itertools.product(range(12), range(12)):
+        x = 0.37 * i * i
+        y = 1000 + 0.11 * j
+        tree.add(AABB([(x, x + 0.3), (y, y + 0.1 * (i % 3))]), (i, j))
+    queries = [AABB([(0.3, 0.3), (1000, 1001)]),
+               AABB([(10, 20), (1000.2, 1000.5)]),
+               AABB([(48.3, 60), (1000.99, 1002)]),
+               AABB([(-5, 0), (999, 1000)])]
+
+    full = tree.compile()
+    for quantize, arity in itertools.product((8, 16), (2, 4)):
+        compiled = tree.compile(arity=arity, quantize=quantize)
+        assert compiled.nbytes < full.nbytes
+        for aabb, closed in itertools.product(queries, (False, True)):
+            expected = tree.overlap_values(aabb, closed=closed)
+            assert sorted(compiled.overlap_values(aabb, closed)) == \
+                sorted(expected)
+
+    assert tree.compile(quantize=8).child_lowers.itemsize == 1
+    assert tree.compile(quantize=16).child_uppers.itemsize == 2
+
+
+def test_dtype():
+    tree = AABBTree()
+    for i, j in itertools.product(range(8), range(8)):
+        tree.add(AABB([(2 * i, 2 * i + 2), (3 * j, 3 * j + 1 + i % 2)]),
+                 (i, j))
+    queries = [AABB([(4, 4), (0, 30)]), AABB([(2, 6), (3, 4)]),
+               AABB([(-2, 0), (-1, 0)]), AABB([(16, 20), (22, 25)])]
+
+    sizes = {}
+    for dtype in ('float32', 'float64', 'int32', 'int64'):
+        compiled = tree.compile(dtype=dtype)
+        assert compiled.dtype == dtype
+        sizes[dtype] = compiled.nbytes
+        for aabb, closed in itertools.product(queries, (False, True)):
+            expected = tree.overlap_values(aabb, closed=closed)
+            assert sorted(compiled.overlap_values(aabb, closed)) == \
+                sorted(expected)
+            assert compiled.overlap_aabbs(aabb, closed) == \
+                tree.compile().overlap_aabbs(aabb, closed)
+        quantized = tree.compile(dtype=dtype, quantize=8)
+        assert quantized.overlap_values(queries[1]) == \
+            compiled.overlap_values(queries[1])
+
+    assert sizes['float32'] < sizes['float64']
+    assert sizes['int32'] < sizes['int64']
+    leaf = tree.compile(dtype='int64').overlap_aabbs(queries[1])[0]
+    assert all(isinstance(x, int) for lims in leaf for x in lims)
+
+
+def test_float32():
+    tree = AABBTree()
+    tree.add(AABB([(0.1, 0.2)]), 'a')
+    tree.add(AABB([(0.2, 0.3)]), 'b')
+    compiled = tree.compile(dtype='float32')
+    low, high = compiled.aabb.limits[0]
+    assert low <= compiled.leaf_lowers[0]
+    assert compiled.overlap_values(AABB([(high, high)]), closed=True) == ['b']
+
+
+def test_covered_subtree():
+    tree = AABBTree()
+    for i in range(5):
+        tree.add(AABB([(i, i), (0, 1)]), i)
+    queries = [AABB([(0, 4), (0, 1)]), AABB([(-1, 5), (-1, 2)]),
+               AABB([(0.5, 4), (-1, 2)]), AABB([(-1, 2.5), (-1, 2)])]
+    for quantize, arity in itertools.product((None, 8), (2, 4)):
+        compiled = tree.compile(arity=arity, quantize=quantize)
+        for aabb, closed in itertools.product(queries, (False, True)):
+            expected = tree.overlap_values(aabb, closed=closed)
+            assert sorted(compiled.overlap_values(aabb, closed)) == \
+                sorted(expected)
+            assert compiled.does_overlap(aabb, closed) == (len(expected) > 0)
+    assert tree.compile().overlap_values(queries[1]) == [0, 1, 2, 3, 4]
+
+
+def test_unique():
+    tree = AABBTree()
+    tree.add(AABB([(0, 1)]), 'box 1')
+    tree.add(AABB([(0, 1)]), 'box 2')
+    compiled = tree.compile()
+    assert len(compiled.overlap_values(AABB([(0, 1)]))) == 1
+    assert len(compiled.overlap_values(AABB([(0, 1)]), unique=False)) == 2
+
+
+def test_save_load(tmp_path):
+    tree = grid_tree(6)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(-9, 9), (-9, 9)])]
+    path = str(tmp_path / 'tree.flat')
+    options = [{}, {'arity': 4, 'quantize': 8}, {'dtype': 'float32'}]
+    for kwargs in options:
+        compiled = tree.compile(**kwargs)
+        compiled.save(path)
+        loaded = CompiledAABBTree.load(path)
+        assert loaded.aabb == compiled.aabb
+        assert loaded.nbytes == compiled.nbytes
+        assert loaded.quantize == compiled.quantize
+        for aabb in queries:
+            assert loaded.overlap_values(aabb) == compiled.overlap_values(aabb)
+
+    compiled = AABBTree.from_aabbs(grid_aabbs(3), range(9)).compile()
+    compiled.save(path)
+    assert list(CompiledAABBTree.load(path).values) == list(compiled.values)
+
+    AABBTree().compile().save(path)
+    assert len(CompiledAABBTree.load(path)) == 0
+
+    with open(path, 'wb') as f:
+        f.write(b'not a tree')
+    with pytest.raises(ValueError):
+        CompiledAABBTree.load(path)
+
+
+def test_stream_build(tmp_path):
+    aabbs = [AABB([(0.37 * i * i % 11, 0.37 * i * i % 11 + 0.5),
+                   (0.11 * i, 0.11 * i + 0.1 * (i % 3))]) for i in range(200)]
+    tree = AABBTree.from_aabbs(aabbs, range(len(aabbs)))
+    queries = [AABB([(0.3, 0.3), (0, 10)]), AABB([(2, 5), (3, 6)]),
+               AABB([(-1, 20), (-1, 30)]), AABB([(-5, 0), (-9, 0)])]
+    path = str(tmp_path / 'tree.flat')
+    for chunk_size in (1, 16, 50, 1000):
+        compiled = CompiledAABBTree.stream_build(iter(aabbs), path,
+                                                 chunk_size=chunk_size)
+        assert len(compiled) == len(aabbs)
+        assert compiled.aabb == tree.aabb
+        for aabb, closed in itertools.product(queries, (False, True)):
+            expected = tree.overlap_values(aabb, closed=closed, unique=False)
+            out = compiled.overlap_values(aabb, closed, unique=False)
+            assert sorted(out) == sorted(expected)
+        check_contiguous(compiled)
+
+    records = str(tmp_path / 'records')
+    with open(records, 'wb') as f:
+        array('i', [x for box in aabbs for lims in box.limits
+                    for x in (int(lims[0]), int(lims[1]) + 1)]).tofile(f)
+    compiled = CompiledAABBTree.stream_build(records, path, n_dim=2,
+                                             chunk_size=32, dtype='int32',
+                                             record_dtype='int32')
+    assert compiled.dtype == 'int32'
+    assert sorted(compiled.overlap_values(AABB([(0, 1), (0, 1)]),
+                                          unique=False)) == \
+        [i for i, box in enumerate(aabbs) if box.limits[1][0] < 1 and
+         box.limits[0][0] < 1]
+
+    assert len(CompiledAABBTree.stream_build([], path)) == 0
+    with pytest.raises(ValueError):
+        CompiledAABBTree.stream_build(records, path)
+    with pytest.raises(ValueError):
+        CompiledAABBTree.stream_build(aabbs, path, chunk_size=0)
+    with pytest.raises(ValueError):
+        CompiledAABBTree.stream_build(aabbs, path, dtype='float16')
+
+
+def test_stream_build_tied_centers(tmp_path):
+    tied = 2000 * [AABB([(5, 6), (5, 6)])]
+    tiles = [AABB([(i, i + 1), (j, j + 1)])
+             for i, j in itertools.product(range(3), repeat=2)]
+    tiled = [box for box in tiles for _ in range(300)]
+    path = str(tmp_path / 'tree.flat')
+    for aabbs in (tied, tiled):
+        temp = tmp_path / str(len(aabbs))
+        temp.mkdir()
+        records, n_dim = aabbtree._spill_records(aabbs, str(temp), 100)
+        cells = list(aabbtree._stream_cells(records, 'd', n_dim, 100,
+                                            str(temp)))
+        assert max(len(numbers) for _, numbers in cells) <= 100
+        numbers = [k for _, cell_numbers in cells for k in cell_numbers]
+        assert sorted(numbers) == list(range(len(aabbs)))
+
+        compiled = CompiledAABBTree.stream_build(aabbs, path, chunk_size=100)
+        assert len(compiled) == len(aabbs)
+        query = AABB([(5.2, 5.4), (5.2, 5.4)])
+        expected = [k for k, box in enumerate(aabbs) if box.overlaps(query)]
+        out = compiled.overlap_values(query, unique=False)
+        assert sorted(out) == expected
+        check_contiguous(compiled)
+
+
+def check_contiguous(compiled):
+    for node in range(len(compiled.leaf_start)):
+        first = compiled.child_ptr[node]
+        last = compiled.child_ptr[node + 1]
+        if first == last:
+            continue
+        kids = [compiled.child_idx[s] for s in range(first, last)]
+        assert compiled.leaf_start[node] == compiled.leaf_start[kids[0]]
+        assert compiled.leaf_stop[node] == compiled.leaf_stop[kids[-1]]
+
+
+def standard_tree():
+    tree = AABBTree()
+    tree.add(AABB([(0, 1), (0, 1)]), 'value 1')
+    tree.add(AABB([(3, 4), (0, 1)]), 3.14)
+    tree.add(AABB([(5, 6), (5, 6)]))
+    tree.add(AABB([(7, 8), (5, 6)]))
+    return tree
@@ -0,0 +1,75 @@
+import itertools
+
+import pytest
+
+from aabbtree import AABB
+from aabbtree import AABBTree
+from aabbtree import GridIndex
+
+
+def test_from_aabbs():
+    aabbs = dense_aabbs()
+    index = GridIndex.from_aabbs(aabbs, range(len(aabbs)))
+    assert len(index) == len(aabbs)
+    assert index.cell_size == [1, 1]
+    check_queries(index, aabbs)
+
+    index = GridIndex.from_aabbs(aabbs, range(len(aabbs)), cell_size=2.5)
+    check_queries(index, aabbs)
+
+    index = GridIndex.from_aabbs(aabbs, range(len(aabbs)), cell_size=(0.5, 4))
+    check_queries(index, aabbs)
+
+    assert len(GridIndex.from_aabbs([])) == 0
+    empty = GridIndex.from_aabbs([])
+    assert empty.overlap_values(AABB([(0, 1), (0, 1)])) == []
+
+
+def test_from_aabbs_raises():
+    with pytest.raises(ValueError):
+        GridIndex.from_aabbs(dense_aabbs(), values=[1, 2])
+
+
+def test_add():
+    aabbs = dense_aabbs()
+    index = GridIndex()
+    for i, aabb in enumerate(aabbs):
+        index.add(aabb, i)
+    assert index.cell_size == [1, 1]
+    check_queries(index, aabbs)
+
+    index = GridIndex(cell_size=0.3)
+    for i, aabb in enumerate(aabbs):
+        index.add(aabb, i)
+    check_queries(index, aabbs)
+
+
+def check_queries(index, aabbs):
+    tree = AABBTree()
+    for i, aabb in enumerate(aabbs):
+        tree.add(aabb, i)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]), AABB([(-50, 50), (-50, 50)]),
+               AABB([(3, 3), (3, 3)]), AABB()]
+    for aabb, method, closed in itertools.product(queries, ('DFS', 'BFS'),
+                                                  (False, True)):
+        expected = tree.overlap_values(aabb, method, closed, unique=False)
+        assert sorted(index.overlap_values(aabb, method, closed,
+                                           unique=False)) == sorted(expected)
+        assert len(index.overlap_aabbs(aabb, method, closed)) == \
+            len(tree.overlap_aabbs(aabb, method, closed))
+        assert index.does_overlap(aabb, method, closed) == (len(expected) > 0)
+    assert index.overlap_values_many(queries) == \
+        [index.overlap_values(q) for q in queries]
+    with pytest.raises(ValueError):
+        index.does_overlap(queries[0], 'RANDOM')
+
+
+def dense_aabbs():
+    aabbs = []
+    for i, j in itertools.product(range(-3, 6), range(-3, 6)):
+        x = i + 0.25 * (j % 3)
+        y = j - 0.25 * (i % 2)
+        aabbs.append(AABB([(x, x + 1), (y, y + 1)]))
+    aabbs.append(AABB([(3, 3), (3, 3)]))
+    return aabbs
@@ -0,0 +1,58 @@
+import itertools
+
+from aabbtree import AABB
+from aabbtree import AABBTree
+from aabbtree import ShardedAABBIndex
+
+from conftest import grid_tree
+
+
+def test_overlap_values():
+    tree = grid_tree(8)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]),
+               AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]),
+               AABB([(-9, 9), (-9, 9)])]
+    for n_shards in (1, 3, 4):
+        with ShardedAABBIndex(tree, n_shards) as index:
+            assert len(index) == len(tree)
+            assert len(index.bounds) == n_shards
+            for aabb, closed in itertools.product(queries, (False, True)):
+                expected = tree.overlap_values(aabb, closed=closed)
+                out = index.overlap_values(aabb, closed)
+                assert sorted(out) == sorted(expected)
+                assert index.does_overlap(aabb, closed) == (len(expected) > 0)
+
+            many = index.overlap_values_many(queries)
+            assert [sorted(out) for out in many] == \
+                [sorted(tree.overlap_values(aabb)) for aabb in queries]
+
+
+def test_values_stay_local():
+    aabbs = [AABB([(i, i + 1)]) for i in range(10)]
+    values = [lambda x, i=i: x + i for i in range(10)]
+    tree = AABBTree.from_aabbs(aabbs, values)
+    with ShardedAABBIndex(tree, 2, dtype='int32') as index:
+        out = index.overlap_values(AABB([(3.5, 4.5)]))
+        assert sorted(f(0) for f in out) == [3, 4]
+
+
+def test_unique():
+    tree = AABBTree()
+    for i in range(4):
+        tree.add(AABB([(0, 1)]), i)
+    with ShardedAABBIndex(tree, 2) as index:
+        assert len(index.overlap_values(AABB([(0, 1)]))) == 1
+        assert len(index.overlap_values(AABB([(0, 1)]), unique=False)) == 4
+
+
+def test_close():
+    index = ShardedAABBIndex(grid_tree(4), 2)
+    workers = list(index._workers)
+    index.close()
+    assert all(not worker.is_alive() for worker in workers)
+    assert len(index) == 0
+    index.close()
+
+    with ShardedAABBIndex(AABBTree(), 2) as index:
+        assert index.overlap_values(AABB([(0, 1), (0, 1)])) == []
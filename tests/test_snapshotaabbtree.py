@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from aabbtree import AABB
+from aabbtree import AABBTree
+from aabbtree import SnapshotAABBTree
+
+from conftest import grid_aabbs
+
+
+def test_add():
+    aabbs = grid_aabbs(6)
+    query = AABB([(-1, 2.5), (1.5, 3)])
+    for leaf_size in (1, 4):
+        tree = AABBTree(leaf_size=leaf_size)
+        snap_tree = SnapshotAABBTree(leaf_size=leaf_size)
+        for i, aabb in enumerate(aabbs):
+            tree.add(aabb, i)
+            snap_tree.add(aabb, i)
+            assert snap_tree.snapshot() == tree
+            assert len(snap_tree) == i + 1
+
+        assert snap_tree.does_overlap(query)
+        assert snap_tree.overlap_values(query) == tree.overlap_values(query)
+        assert snap_tree.overlap_aabbs(query) == tree.overlap_aabbs(query)
+        assert snap_tree.overlap_values_many([query]) == \
+            [tree.overlap_values(query)]
+
+
+def test_add_raises():
+    snap_tree = SnapshotAABBTree()
+    with pytest.raises(ValueError):
+        for aabb in grid_aabbs(2):
+            snap_tree.add(aabb, method=3.14)
+
+
+def test_snapshot_unchanged():
+    snap_tree = SnapshotAABBTree()
+    for i, aabb in enumerate(grid_aabbs(4)):
+        snap_tree.add(aabb, i)
+    old = snap_tree.snapshot()
+    old_str = str(old)
+
+    snap_tree.add(AABB([(0.1, 0.2), (0.1, 0.2)]), 'new')
+    new = snap_tree.snapshot()
+    assert new is not old
+    assert str(old) == old_str
+    assert len(old) == 16
+    assert len(new) == 17
+
+    # Only the insertion path is copied
+    assert (new.left is old.left) != (new.right is old.right) or \
+        new.left is old
+
+
+def test_concurrent_readers():
+    aabbs = grid_aabbs(10)
+    query = AABB([(-1, 11), (-1, 11)])
+    snap_tree = SnapshotAABBTree()
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            snapshot = snap_tree.snapshot()
+            n = len(snapshot)
+            if len(snapshot.overlap_values(query, unique=False)) != n:
+                errors.append(n)
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    for i, aabb in enumerate(aabbs):
+        snap_tree.add(aabb, i)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert errors == []
+    assert sorted(snap_tree.overlap_values(query)) == list(range(100))
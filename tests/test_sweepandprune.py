@@ -0,0 +1,114 @@
+import itertools
+
+import pytest
+
+from aabbtree import AABB
+from aabbtree import AABBTree
+from aabbtree import SweepAndPrune
+
+
+def test_insert():
+    sap = SweepAndPrune()
+    assert len(sap) == 0
+    assert sap.overlap_values(AABB([(0, 1), (0, 1)])) == []
+    assert not sap.does_overlap(AABB([(0, 1), (0, 1)]))
+
+    handles = [sap.insert(aabb, i) for i, aabb in enumerate(moving_aabbs(0))]
+    assert len(set(handles)) == len(handles)
+    assert len(sap) == len(handles)
+    check_queries(sap, moving_aabbs(0))
+
+
+def test_update():
+    for axis in (0, 1):
+        sap = SweepAndPrune(axis)
+        handles = [sap.insert(aabb, i)
+                   for i, aabb in enumerate(moving_aabbs(0))]
+        for step in range(1, 6):
+            aabbs = moving_aabbs(step)
+            for handle, aabb in zip(handles, aabbs):
+                sap.update(handle, aabb)
+            assert list(sap._lows) == sorted(sap._lows)
+            check_queries(sap, aabbs)
+
+
+def test_remove():
+    sap = SweepAndPrune()
+    aabbs = moving_aabbs(0)
+    handles = [sap.insert(aabb, i) for i, aabb in enumerate(aabbs)]
+    for handle in handles[::2]:
+        sap.remove(handle)
+    assert len(sap) == len(aabbs) // 2
+
+    query = AABB([(-10, 30), (-10, 30)])
+    assert sorted(sap.overlap_values(query, unique=False)) == \
+        list(range(1, len(aabbs), 2))
+
+    for handle in handles[1::2]:
+        sap.remove(handle)
+    assert len(sap) == 0
+    assert sap.overlap_pairs() == []
+
+
+def test_longest_aabb():
+    sap = SweepAndPrune()
+    aabbs = moving_aabbs(0)
+    for i, aabb in enumerate(aabbs):
+        sap.insert(aabb, i)
+    long_box = AABB([(-50, 50), (0, 1)])
+    handle = sap.insert(long_box, 'long')
+    assert sap.overlap_values(AABB([(40, 41), (0, 1)])) == ['long']
+
+    # Shrinking or removing the longest AABB narrows the search again
+    sap.update(handle, AABB([(0, 1), (0, 1)]))
+    check_queries(sap, aabbs + [AABB([(0, 1), (0, 1)])])
+    assert sap._max_len == 3
+    sap.update(handle, long_box)
+    assert sap._max_len == 100
+    sap.remove(handle)
+    check_queries(sap, aabbs)
+    assert sap._max_len == 3
+
+
+def test_overlap_pairs():
+    for step, closed in itertools.product(range(3), (False, True)):
+        aabbs = moving_aabbs(step)
+        sap = SweepAndPrune()
+        for i, aabb in enumerate(aabbs):
+            sap.insert(aabb, i)
+        pairs = {tuple(sorted(p)) for p in sap.overlap_pairs(closed)}
+        expected = {(i, j)
+                    for i, j in itertools.combinations(range(len(aabbs)), 2)
+                    if aabbs[i].overlaps(aabbs[j], closed)}
+        assert pairs == expected
+        assert len(sap.overlap_pairs(closed)) == len(expected)
+
+
+def check_queries(sap, aabbs):
+    tree = AABBTree()
+    for i, aabb in enumerate(aabbs):
+        tree.add(aabb, i)
+    queries = [AABB([(-1, 2.5), (1.5, 3)]), AABB([(2, 2), (0, 9)]),
+               AABB([(20, 21), (0, 1)]), AABB([(4, 6), (4, 6)])]
+    for aabb, method, closed in itertools.product(queries, ('DFS', 'BFS'),
+                                                  (False, True)):
+        expected = tree.overlap_values(aabb, method, closed, unique=False)
+        assert sorted(sap.overlap_values(aabb, method, closed,
+                                         unique=False)) == sorted(expected)
+        assert len(sap.overlap_aabbs(aabb, method, closed)) == \
+            len(tree.overlap_aabbs(aabb, method, closed))
+        assert sap.does_overlap(aabb, method, closed) == (len(expected) > 0)
+    assert sap.overlap_values_many(queries) == \
+        [sap.overlap_values(q) for q in queries]
+    with pytest.raises(ValueError):
+        sap.overlap_values(queries[0], 'RANDOM')
+
+
+def moving_aabbs(step):
+    aabbs = []
+    for i, j in itertools.product(range(5), range(5)):
+        x = 2 * i + ((i + j + step) % 3) * 0.7
+        y = 2 * j - ((i * j + step) % 4) * 0.4
+        size = 1 + (i + 2 * j) % 3
+        aabbs.append(AABB([(x, x + size), (y, y + 1)]))
+    return aabbs